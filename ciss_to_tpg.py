@@ -5,6 +5,81 @@ Publish Bosch CISS sensor to ThingsPro Gateway
 
 '''
 Change log
+0.17.10 - 2021-01-07 - cg
+    Captures checked in the publish loop
+    
+0.17.9 - 2021-01-01 - cg
+    Output sinks rebuilt on reload, dropped values logged
+    
+0.17.8 - 2020-12-30 - cg
+    Tags published with the timestamps of the batch, event tags at the event time
+    
+0.17.7 - 2020-12-28 - cg
+    Spectral features published once per window
+    
+0.17.6 - 2020-12-24 - cg
+    Nothing published for an empty statistic window
+    
+0.17.5 - 2020-12-22 - cg
+    Anomaly gate keepalive counted per sensor
+    
+0.17.4 - 2020-12-20 - cg
+    Forward queue catch up on its own thread, queue write errors logged
+    
+0.17.3 - 2020-12-18 - cg
+    Tier windows published with their end time, tier tags rebuilt on reload
+    
+0.17.2 - 2020-12-16 - cg
+    Streaming period published like its equipment tag is created
+    
+0.17.1 - 2020-12-10 - cg
+    Equipment tags of the previous configuration built before the reload
+    
+0.17.0 - 2020-12-08 - cg
+    Packed binary snapshots for the output sinks
+    
+0.16.0 - 2020-12-04 - cg
+    Publish the streaming period of the rate control
+    
+0.15.1 - 2020-11-22 - cg
+    Equipment setup in tpg_init_equipment
+    
+0.15.0 - 2020-11-20 - cg
+    Publish, forward queue and sink metrics
+    
+0.14.0 - 2020-11-18 - cg
+    Output sinks, TagV2 sink and optional MQTT sink
+    
+0.13.0 - 2020-11-16 - cg
+    Publish in batches, store and forward queue for TagV2 outages
+    
+0.12.0 - 2020-11-14 - cg
+    Per sensor publish intervals by a deadline scheduler
+    
+0.11.0 - 2020-11-12 - cg
+    Publish node snapshots taken by the read threads
+    
+0.10.0 - 2020-11-10 - cg
+    Startup phase report
+    
+0.9.0 - 2020-11-06 - cg
+    Publish anomaly state, optional anomaly gated publishing
+    
+0.8.0 - 2020-11-04 - cg
+    Publish derived xyz channels
+    
+0.7.0 - 2020-11-02 - cg
+    Publish spectral features
+    
+0.6.0 - 2020-10-30 - cg
+    Publish aggregation tiers
+    
+0.5.0 - 2020-10-24 - cg
+    Publish sensor events
+    
+0.4.0 - 2020-10-22 - cg
+    Add live configuration reload (SIGHUP)
+    
 0.3.1 - 2020-08-05 - cg
     Add VTag auto create
     
@@ -17,28 +92,101 @@ Change log
 
 __author__ = "Christian G."
 __license__ = "MIT"
-__version__ = '0.3.1'
+__version__ = '0.17.10'
 __status__ = "beta"
 
 import sys
+import time
+import threading
 
+_startup_time = time.time()
 from lib.chgrcodebase import *
 from lib.cissUsbSensor import *
 from lib.tpg_create_vtags import TpgEquipmentApp
+from lib.cissDerived import CISS_DERIVED_NAMES
+from lib.cissForwardQueue import CissForwardQueue
+from lib.cissSinks import CissSink, create_sinks
+from lib.cissPacked import CissPackedSchema
 
 from libmxidaf_py import TagV2, Tag, Time, Value
+_imported_time = time.time()
 
 
+class TpgTagSink(CissSink):
+    '''
+    ThingsPro Gateway virtual tags (TagV2) of the equipment template
+    '''
+    def __init__(self, template_name, id='tagV2', **kwargs):
+        CissSink.__init__(self, id, **kwargs)
+        self.template_name = template_name
+        self._tagV2_obj = TagV2.instance()
+        self._time_from_timestamp = True
+        return
+    
+    def publish(self, batch, node=None):
+        '''
+        Tags are published with the timestamps of the batch, the event time
+        of events and the original time of the forward queue batches
+        '''
+        try:
+            for tag_name, value, unit, timestamp in batch:
+                at = self.tag_time(timestamp)
+                self._tagV2_obj.publish(self.template_name, str(tag_name), Tag(Value(value), at, str(unit)))
+        except Exception:
+            if self.available:
+                self.log_exception('TagV2 publish failed!')
+            return self.set_available(False)
+        self.messages_sent += len(batch)
+        self.values_sent += len(batch)
+        return self.set_available(True)
+    
+    def tag_time(self, timestamp):
+        '''
+        TagV2 time of a batch timestamp (s)
+        '''
+        if self._time_from_timestamp:
+            try:
+                return Time(int(timestamp * 1000))
+            except Exception:
+                self._time_from_timestamp = False
+                self.log_warning('TagV2 Time without timestamp support, forward with current time!')
+        return Time.now()
+
     
 class TpgCissContext(AppCissContext):
     def __init__(self, args, **kwargs):
         AppCissContext.__init__(self, args, **kwargs) 
         
-        self._tagV2_obj = None 
+        self._tpg_sink = None 
+        self._sinks = []
+        # held while publishing to the output sinks and replacing them
+        self._sinks_lock = threading.Lock()
+        # node id -> CissPackedSchema of the packed sinks
+        self._packed_schemas = {}
         self._vtag_tags_published = 0   
+        # node id -> [publishes, publish seconds, latency seconds, last latency]
+        self._publish_stats = {}
         self._vtag_template_name = None
+        self._tpg_equ = None
         
         self._tpg_publish_interval = 30000 # ms
+        self._anomaly_gate = False
+        self._anomaly_keepalive = 0
+        # (node name, sensor name) -> gated publishes
+        self._gate_ticks = {}
+        # (node name, sensor name) -> spectral window published last
+        self._spectral_published = {}
+        
+        self._tpg_lock = threading.Lock()
+        self._tpg_values_dropped = 0
+        self._forward_queue = None
+        self._forward_retry_interval = 5.0 # s
+        self._forward_retry_time = 0
+        self._forward_catchup_rate = 10.0 # batches per second
+        self._forward_catchup_time = None
+        self._forward_error = False
+        self._forward_thread = None
+        self._forward_stop = threading.Event()
         return 
         
     def init_context(self):
@@ -51,28 +199,151 @@ class TpgCissContext(AppCissContext):
         self._vtag_template_name = self._ext_conf['tpg_vtag_template'] 
         self.log_info('Virtual Tag Device set to %s', self._vtag_template_name)
            
+        self.tpg_set_publish_interval()
+        self.tpg_set_anomaly_gate()
+        self.tpg_set_forward_queue()
+        self._tpg_sink = TpgTagSink(self._vtag_template_name, logger=self.get_logger())
+        self._sinks = create_sinks(self._ext_conf.get('output_sinks', None), logger=self.get_logger())
+        
+        if not self.tpg_init_equipment():
+            return False 
+        self.startup_mark('tpg equipment')
+        
+        self._event_dispatcher.add_handler(self.tpg_publish_events)
+        return True
+    
+    def tpg_init_equipment(self):
+        '''
+        Create or update the virtual tag equipment of the nodes
+        '''
+        self._tpg_equ = TpgEquipmentApp('tpgAddEqu', mxapitoken = self.tpg_get_mx_api_token(),
+                                            equname = self._ext_conf['tpg_vtag_template'],
+                                            nodes = self._ext_conf['ciss_nodes'],
+                                            tiers = self._ext_conf.get('aggregation_tiers', None),
+                                            rate_control = bool(self._ext_conf.get('rate_control', None)),
+                                            logger = self.get_logger())
+        
+        curEqu = self._tpg_equ.tpg_check_equipment()
+        return self._tpg_equ.tpg_create_equipment(curEqu)
+    
+    def init_metrics(self, metrics):
+        AppCissContext.init_metrics(self, metrics)
+        metrics.describe('publish_total', 'counter', 'Node snapshots published')
+        metrics.describe('publish_duration_seconds', 'summary', 'Time to publish a snapshot')
+        metrics.describe('publish_latency_seconds', 'summary', 'Snapshot age when published')
+        metrics.describe('publish_latency_last_seconds', 'gauge', 'Snapshot age of the last publish')
+        metrics.describe('tpg_values_dropped_total', 'counter', 'TagV2 values dropped without forward queue')
+        metrics.describe('forward_queue_bytes', 'gauge', 'Bytes stored in the forward queue')
+        metrics.describe('forward_queue_batches_total', 'counter', 'Batches stored in the forward queue')
+        metrics.describe('forward_queue_dropped_bytes_total', 'counter', 'Bytes dropped with full forward queue')
+        metrics.describe('sink_available', 'gauge', 'Output sink available')
+        metrics.describe('sink_messages_total', 'counter', 'Output sink messages sent')
+        metrics.describe('sink_values_total', 'counter', 'Output sink values sent')
+        metrics.describe('sink_ticks_coalesced_total', 'counter', 'Output sink publishes merged into the next message')
+        metrics.add_collector(self.collect_tpg_metrics)
+        return True
+    
+    def collect_tpg_metrics(self):
+        for node, stats in list(self._publish_stats.items()):
+            labels = {'node': node}
+            yield ('publish_total', labels, stats[0])
+            yield ('publish_duration_seconds_count', labels, stats[0])
+            yield ('publish_duration_seconds_sum', labels, stats[1])
+            yield ('publish_latency_seconds_count', labels, stats[0])
+            yield ('publish_latency_seconds_sum', labels, stats[2])
+            yield ('publish_latency_last_seconds', labels, stats[3])
+        yield ('tpg_values_dropped_total', None, self._tpg_values_dropped)
+        fq = self._forward_queue
+        if fq is not None:
+            yield ('forward_queue_bytes', None, fq.pending())
+            yield ('forward_queue_batches_total', None, fq.batches_put)
+            yield ('forward_queue_dropped_bytes_total', None, fq.bytes_dropped)
+        sinks = [self._tpg_sink] + self._sinks if self._tpg_sink is not None else self._sinks
+        for sink in sinks:
+            labels = {'sink': sink.get_base_id()}
+            yield ('sink_available', labels, int(sink.available))
+            yield ('sink_messages_total', labels, sink.messages_sent)
+            yield ('sink_values_total', labels, sink.values_sent)
+            yield ('sink_ticks_coalesced_total', labels, getattr(sink, 'ticks_coalesced', None))
+    
+    def tpg_set_publish_interval(self):
         if 'tpg_publish_interval' in self._ext_conf:         
             self._tpg_publish_interval = int(self._ext_conf['tpg_publish_interval'])*1000            
         self.log_info('Publish interval set to %s ms', self._tpg_publish_interval)  
         if self._console_args.publish_interval != None:
             self._tpg_publish_interval =  self._console_args.publish_interval*1000  
             self.log_info('Publish interval set to %s ms, from console arg!', self._tpg_publish_interval)     
-        self._tagV2_obj = TagV2.instance()      
-        
-        equObj = TpgEquipmentApp('tpgAddEqu', mxapitoken = self.tpg_get_mx_api_token(),
-                                            equname = self._ext_conf['tpg_vtag_template'],
-                                            nodes = self._ext_conf['ciss_nodes'],
-                                            logger = self.get_logger())
+        return True
+    
+    def get_publish_interval(self):
+        return self._tpg_publish_interval
+    
+    def tpg_set_anomaly_gate(self):
+        self._anomaly_gate = bool(self._ext_conf.get('anomaly_gate', False))
+        self._anomaly_keepalive = int(self._ext_conf.get('anomaly_keepalive', 0))
+        if self._anomaly_gate:
+            self.log_info('Anomaly gated publishing, keepalive every %d publish intervals', self._anomaly_keepalive)
+        return True
+    
+    def tpg_set_forward_queue(self):
+        conf = self._ext_conf.get('tpg_forward_queue', None)
+        if not conf:
+            return False
+        self._forward_retry_interval = float(conf.get('retry_interval', self._forward_retry_interval))
+        self._forward_catchup_rate = float(conf.get('catchup_rate', self._forward_catchup_rate))
+        self._forward_queue = CissForwardQueue(conf.get('path', 'forward_queue'), 
+                                               max_size=int(conf.get('max_size_mb', 16))*1024*1024,
+                                               fsync_interval=conf.get('fsync_interval', 5.0),
+                                               logger=self.get_logger())
+        self.log_info('Forward queue %s, catch up %.1f batches/s', self._forward_queue.path, self._forward_catchup_rate)
+        return True
+    
+    def reload_context(self):
+        # tags of the previous configuration, built before the nodes reload
+        old_tags = self._tpg_equ.tpg_build_new_equipment(self._vtag_template_name, self._ext_conf['ciss_nodes'])
+        old_sinks = self._ext_conf.get('output_sinks', None)
+        if not AppCissContext.reload_context(self):
+            return False
+        self.tpg_set_publish_interval()
+        self.tpg_set_anomaly_gate()
+        if self._ext_conf.get('output_sinks', None) != old_sinks:
+            self.tpg_reload_sinks()
+        # rebuilt with the new sensor configuration
+        self._packed_schemas = {}
+        self._tpg_equ.set_tiers(self._ext_conf.get('aggregation_tiers', None))
         
-        curEqu = equObj.tpg_check_equipment()
-        if not equObj.tpg_create_equipment(curEqu):
-            return False 
-
+        new_tags = self._tpg_equ.tpg_build_new_equipment(self._vtag_template_name, self._ext_conf['ciss_nodes'])
+        if old_tags['equipmentTags'] == new_tags['equipmentTags']:
+            self.log_info('Virtual Tags unchanged')
+            return True
+        self.log_info('Virtual Tags changed, update equipment %s', self._vtag_template_name)
+        self._tpg_equ.set_nodes(self._ext_conf['ciss_nodes'])
+        curEqu = self._tpg_equ.tpg_check_equipment()
+        return self._tpg_equ.tpg_create_equipment(curEqu)
+    
+    def tpg_reload_sinks(self):
+        '''
+        Replace the output sinks by the sinks of the new configuration, the
+        previous sinks are kept if the new ones fail
+        '''
+        try:
+            sinks = create_sinks(self._ext_conf.get('output_sinks', None), logger=self.get_logger())
+        except Exception:
+            self.log_exception('Output sinks unchanged!')
+            return False
+        with self._sinks_lock:
+            old_sinks, self._sinks = self._sinks, sinks
+            for sink in old_sinks:
+                sink.close()
+        self.log_info('Output sinks changed to %s', [sink.get_base_id() for sink in sinks])
         return True
     
     def on_sensor_upate_callback(self, sensor):
         self.log_debug('Sensor %s Update! %s = %s', sensor.name, sensor.value_timestamp, sensor.value)
-        return self.tpg_publish_sensor(sensor)
+        batch = []
+        self.tpg_publish_sensor(sensor, batch)
+        self.tpg_gate_tick(sensor)
+        return self.tpg_forward(batch, sensor.ciss_node.name)
   
     
     def run_context(self):
@@ -81,8 +352,10 @@ class TpgCissContext(AppCissContext):
         if self._tpg_publish_interval == 0:
             for id, ciss in self._ciss.items():
                 for id, sensor in ciss.get_sensors().items():
-                    sensor.set_on_update_callback(self.on_sensor_upate_callback)      
+                    if sensor.publish_interval is None:
+                        sensor.set_on_update_callback(self.on_sensor_upate_callback)      
         
+        self.tpg_start_catch_up()
         if self._use_threading:
             return self.run_threading_loop()
         else:
@@ -91,70 +364,120 @@ class TpgCissContext(AppCissContext):
         return True
     
     
-    def run_threading_loop(self):
-        self._run = True
-        
-        max_interval_time = 5000 # 5 seconds
-         
-        for id, ciss in self._ciss.items():
-           ciss.start_read_thread()    
-                        
-        while self._run is True: 
-            time.sleep(self._tpg_publish_interval/1000)
-            for id, ciss in self._ciss.items(): 
-                if not ciss.thread_is_alive() and self._run is True:
-                    self.log_error('Sensor %s Read Thread not alive! Restart', ciss.name)
-                    ciss.start_read_thread()
-                    continue
-                ciss.calc_statistics()                       
-                if self._logger_level <= AppLogLevel.DEBUG.value:          
-                    ciss.print_sensor_values(True)
-                if self._tpg_publish_interval != 0:
-                    self.tpg_publish(ciss)             
-                            
-        return True
+    def on_snapshot(self, snapshot):
+        if self._logger_level <= AppLogLevel.DEBUG.value:          
+            snapshot.node.print_sensor_values(True, snapshot)
+        return self.tpg_publish(snapshot.node, snapshot)
     
     def run_loop(self):        
         self._run = True
         print_all = 10
         
         while self._run is True:             
+            self.check_reload()
+            self.check_startup()
             for id, ciss in self._ciss.items():           
                 ciss.read_sensor_stream_until(100, self._tpg_publish_interval, 0.01)
-                ciss.calc_statistics()
+                ciss.check_capture()
+                snapshot = ciss.take_snapshot()
                 if self._logger_level <= AppLogLevel.DEBUG.value:
                     if print_all >= 10:
-                        ciss.print_sensor_values(True) 
+                        ciss.print_sensor_values(True, snapshot) 
                         print_all = 0
                     print_all += 1
                 if self._tpg_publish_interval != 0:
-                    self.tpg_publish(ciss) 
+                    self.tpg_publish(ciss, snapshot) 
                         
         return True    
     
-    def tpg_publish(self, ciss_node):
+    def tpg_publish(self, ciss_node, snapshot=None):
         self.log_debug('tpg_publish')
         if not isinstance(ciss_node, AppCissNode):
             raise ValueError('Invalid Ciss Node object!')
-        for s_id, sensor in ciss_node.get_sensors().items():
-            self.tpg_publish_sensor(sensor)
-            if isinstance(sensor, CissXyzSensor) and (sensor.publish & 0x04):
-                self.tpg_publish_sensor(sensor.get_sensor('x'))
-                self.tpg_publish_sensor(sensor.get_sensor('y'))
-                self.tpg_publish_sensor(sensor.get_sensor('z'))  
+        if snapshot is None:
+            snapshot = ciss_node.take_snapshot()
+        start = AppUtil.monotonic()
+        batch = []
+        for s_id, sensor in snapshot.sensors.items():
+            self.tpg_publish_sensor(sensor, batch)
+            # the tag exists for each enabled inertial sensor with rate control
+            if sensor.is_xyz() and sensor.enabled:
+                self.tpg_publish_stream_period(ciss_node, s_id, sensor, batch)
+            if not self.tpg_publish_gate(sensor):
+                continue
+            if sensor.is_xyz() and (sensor.publish & 0x04):
+                self.tpg_publish_sensor(sensor.get_sensor('x'), batch)
+                self.tpg_publish_sensor(sensor.get_sensor('y'), batch)
+                self.tpg_publish_sensor(sensor.get_sensor('z'), batch)  
+            if sensor.is_xyz() and sensor.publish:
+                self.tpg_publish_spectral(sensor, batch)
+                self.tpg_publish_derived(sensor, batch)
+        for sensor in snapshot.sensors.values():
+            self.tpg_gate_tick(sensor)
+        self.tpg_forward(batch, ciss_node.name)
+        self.tpg_publish_packed(ciss_node, snapshot)
         self._vtag_tags_published += 1
+        stats = self._publish_stats.get(ciss_node.get_base_id(), None)
+        if stats is None:
+            stats = self._publish_stats[ciss_node.get_base_id()] = [0, 0.0, 0.0, 0.0]
+        latency = time.time() - snapshot.timestamp
+        stats[0] += 1
+        stats[1] += AppUtil.monotonic() - start
+        stats[2] += latency
+        stats[3] = latency
         self.log_info('Published %s Sensor data to TPG %s (%d)', ciss_node.name, self._vtag_template_name, self._vtag_tags_published) 
 
         return True
         
-    def tpg_publish_sensor(self, sensor): 
+    def tpg_publish_packed(self, ciss_node, snapshot):
+        '''
+        Encode the snapshot once for all sinks with packed format
+        '''
+        if not [sink for sink in self._sinks if sink.packed]:
+            return False
+        schema = self._packed_schemas.get(ciss_node.get_base_id(), None)
+        if schema is None:
+            schema = self._packed_schemas[ciss_node.get_base_id()] = CissPackedSchema.from_node(ciss_node, logger=self.get_logger())
+            self.log_info('Packed schema %08x of %s, %d fields, %d bytes', schema.schema_id, ciss_node.name,
+                          len(schema.fields), schema.size)
+        data = schema.encode(snapshot)
+        with self._sinks_lock:
+            for sink in self._sinks:
+                if sink.packed:
+                    sink.publish_packed(data, schema, ciss_node.name)
+        return True
+    
+    def tpg_publish_gate(self, sensor):
+        '''
+        True if all sensor values shall be published, with the anomaly gate
+        only while the sensor is anomalous or at the keepalive interval
+        '''
+        if not self._anomaly_gate or not sensor.has_anomaly_detector():
+            return True
+        if sensor.is_anomalous():
+            return True
+        ticks = self._gate_ticks.get((sensor.ciss_node.name, sensor.name), 0)
+        return self._anomaly_keepalive > 0 and ticks % self._anomaly_keepalive == 0
+    
+    def tpg_gate_tick(self, sensor):
+        '''
+        Count the publishes of a gated sensor for the keepalive, the first 
+        publish is a keepalive
+        '''
+        if not self._anomaly_gate or not sensor.has_anomaly_detector():
+            return False
+        key = (sensor.ciss_node.name, sensor.name)
+        self._gate_ticks[key] = self._gate_ticks.get(key, 0) + 1
+        return True
+    
+    def tpg_publish_sensor(self, sensor, batch): 
         if not sensor.publish:
             return True      
-        if sensor.value_timestamp is None:           
-             at = Time.now()
-        else:
-             # ToDo
-             at = Time.now()
+        if sensor.has_anomaly_detector():
+            self.tpg_publish_anomaly(sensor, batch)
+            if not self.tpg_publish_gate(sensor):
+                return True
+        at = time.time()
         if (sensor.publish & 0x02):
             if sensor.statistics: 
                 value_list = ['current', 'min', 'max', 'mean', 'std']
@@ -162,17 +485,227 @@ class TpgCissContext(AppCissContext):
                 value_list = ['current', 'min', 'max']
         else:
             value_list = ['current']
+        window = sensor.get_window()
+        if window is not None and not window.count:
+            # no values in the statistic window of the tick
+            value_list = []
         for what in value_list:
-            tValue = Value(int(sensor.get_value(what)))    
-            vtag = Tag(tValue, at, sensor.unit)
+            value = sensor.get_value(what)
+            if value is None:
+                continue
+            tag_name = TpgEquipmentApp.tpg_publish_tag_name(sensor.ciss_node.name, sensor.name, what)
+            batch.append((tag_name, int(value), sensor.unit, at))
+            self.log_debug('tagV2 publish to %s tag %s = %s', self._vtag_template_name, tag_name, batch[-1][1])
+        if (sensor.publish & 0x02):
+            self.tpg_publish_tiers(sensor, batch)
+        return True
+    
+    def tpg_publish_stream_period(self, ciss_node, s_id, sensor, batch):
+        '''
+        Streaming period (us) in effect, the sample rate is 1000000 / period
+        '''
+        if ciss_node._rate_control is None:
+            return True
+        period = ciss_node.get_stream_period(s_id)
+        if period is not None:
+            tag_name = TpgEquipmentApp.tpg_publish_tag_name(ciss_node.name, sensor.name, 'stream_period')
+            batch.append((tag_name, int(period), 'us', time.time()))
+        return True
+    
+    def tpg_publish_anomaly(self, sensor, batch):
+        at = time.time()
+        value = sensor.get_value()
+        for what, scale in (('anomaly', 1), ('anomaly_score', 100)):
             tag_name = TpgEquipmentApp.tpg_publish_tag_name(sensor.ciss_node.name, sensor.name, what)
-            self._tagV2_obj.publish(self._vtag_template_name, tag_name, vtag)            
-            self.log_debug('tagV2 publish to %s tag %s = %s', self._vtag_template_name, tag_name, str(vtag.value()))
+            batch.append((tag_name, int(value.get(what, 0) * scale), sensor.unit, at))
         return True
     
+    def tpg_publish_spectral(self, sensor, batch):
+        window = sensor.get_spectral_window()
+        key = (sensor.ciss_node.name, sensor.name)
+        if window is None or self._spectral_published.get(key, None) is window:
+            return False
+        self._spectral_published[key] = window
+        at = time.time()
+        for type in ('x', 'y', 'z'):
+            features = sensor.get_spectral_features(type)
+            if features is None:
+                return False
+            sub_sensor = sensor.get_sensor(type)
+            for what, value in features.items():
+                if what == 'crest':
+                    value = value * 100
+                tag_name = TpgEquipmentApp.tpg_publish_tag_name(sensor.ciss_node.name, sub_sensor.name, what)
+                batch.append((tag_name, int(value), sensor.unit, at))
+        return True
+    
+    def tpg_publish_derived(self, sensor, batch):
+        if not sensor.is_derived():
+            return False
+        at = time.time()
+        for what in CISS_DERIVED_NAMES:
+            value = sensor.get_value().get(what, None)
+            if value is None:
+                continue
+            tag_name = TpgEquipmentApp.tpg_publish_tag_name(sensor.ciss_node.name, sensor.name, what)
+            batch.append((tag_name, int(value), sensor.unit, at))
+        return True
+    
+    def tpg_publish_tiers(self, sensor, batch):
+        for name, window in sensor.pop_tier_windows():
+            at = window.end
+            for what, tier_what in zip(('min', 'max', 'mean', 'std'), TpgEquipmentApp.tpg_tier_value_names(name)):
+                tag_name = TpgEquipmentApp.tpg_publish_tag_name(sensor.ciss_node.name, sensor.name, tier_what)
+                batch.append((tag_name, int(window.get_value(what)), sensor.unit, at))
+            self.log_debug('tagV2 publish %s tier %s of %d samples', sensor.name, name, window.count)
+        return True
+    
+    def tpg_publish_events(self, events):
+        batches = {}
+        for event in events:
+            ciss_node = self._ciss.get(event.node, None)
+            if ciss_node is None:
+                continue
+            sensor = ciss_node.get_sensor(event.sensor)
+            tag_name = TpgEquipmentApp.tpg_publish_tag_name(ciss_node.name, sensor.name, 'event')
+            batches.setdefault(ciss_node.name, []).append((tag_name, int(event.kind), sensor.unit, event.timestamp))
+            self.log_debug('tagV2 publish event to %s tag %s = %d', self._vtag_template_name, tag_name, event.kind)
+        for node, batch in batches.items():
+            self.tpg_forward(batch, node)
+        return True
+    
+    def tpg_forward(self, batch, node=None):
+        '''
+        Publish a batch of (tag name, value, unit, timestamp) of a node to 
+        TagV2 and the output sinks. With forward queue the TagV2 batches are
+        stored while TagV2 is not available and until the stored batches 
+        are forwarded. Called from the publisher, event dispatcher and read threads.
+        '''
+        with self._tpg_lock:
+            if batch:
+                if self._forward_queue is not None and (not self._tpg_sink.available or not self._forward_queue.is_empty()):
+                    self.tpg_store(batch)
+                elif not self.tpg_send(batch):
+                    if self._forward_queue is not None:
+                        self.tpg_store(batch)
+                    else:
+                        self._tpg_values_dropped += len(batch)
+        with self._sinks_lock:
+            for sink in self._sinks:
+                sink.publish(batch, node)
+        return True
+    
+    def tpg_store(self, batch):
+        '''
+        Store a batch in the forward queue, dropped if the queue fails to 
+        write (e.g. disk full)
+        '''
+        try:
+            self._forward_queue.put(batch)
+        except (IOError, OSError):
+            self._tpg_values_dropped += len(batch)
+            if not self._forward_error:
+                self.log_exception('Forward queue %s write failed, batches dropped!', self._forward_queue.path)
+            self._forward_error = True
+            return False
+        if self._forward_error:
+            self.log_info('Forward queue %s written again, %d values dropped', self._forward_queue.path, self._tpg_values_dropped)
+        self._forward_error = False
+        return True
+    
+    def tpg_start_catch_up(self):
+        if self._forward_queue is None:
+            return False
+        self._forward_stop.clear()
+        self._forward_thread = threading.Thread(name='tpgCatchUp', target=self.run_catch_up)
+        self._forward_thread.daemon = True
+        self._forward_thread.start()
+        return True
+    
+    def tpg_stop_catch_up(self):
+        self._forward_stop.set()
+        if self._forward_thread is not None:
+            self._forward_thread.join(2.0)
+        self._forward_thread = None
+        return True
+    
+    def run_catch_up(self):
+        '''
+        Catch up thread, forwards the stored batches independent of the 
+        publishing every 1 / catchup_rate seconds, at most 10 times per second
+        '''
+        interval = max(0.1, 1.0 / self._forward_catchup_rate)
+        while not self._forward_stop.wait(interval):
+            try:
+                with self._tpg_lock:
+                    self.tpg_catch_up()
+            except Exception:
+                self.log_exception('Forward queue catch up failed!')
+        return True
+    
+    def tpg_catch_up(self):
+        '''
+        Forward the stored batches in bulk with their original timestamps,
+        catchup_rate batches per second since the last catch up
+        '''
+        fq = self._forward_queue
+        now = AppUtil.monotonic()
+        if fq.is_empty() or (not self._tpg_sink.available and now < self._forward_retry_time):
+            self._forward_catchup_time = None
+            fq.sync()
+            return False
+        if self._forward_catchup_time is None:
+            count = 1
+        else:
+            count = max(1, int((now - self._forward_catchup_time) * self._forward_catchup_rate))
+        sent = 0
+        while sent < count:
+            batches = fq.get(min(count - sent, 100))
+            if not batches:
+                break
+            done = []
+            for batch in batches:
+                if not self.tpg_send(batch[1]):
+                    break
+                done.append(batch)
+            fq.commit(done)
+            sent += len(done)
+            if len(done) < len(batches):
+                break
+        self._forward_catchup_time = now
+        fq.sync()
+        if sent and fq.is_empty():
+            self.log_info('Forward queue empty, %d batches stored since start', fq.batches_put)
+        return True
+    
+    def tpg_send(self, batch):
+        available = self._tpg_sink.available
+        if self._tpg_sink.publish(batch):
+            if not available:
+                self.log_info('TagV2 publish ok! (%d values dropped)', self._tpg_values_dropped)
+            return True
+        if available:
+            self.log_warning('TagV2 not available! %s', 'Store values until TagV2 is back'
+                             if self._forward_queue is not None else 'Values dropped')
+        self._forward_retry_time = AppUtil.monotonic() + self._forward_retry_interval
+        return False
+    
     def tpg_get_mx_api_token(self):
         return AppContext.import_file('/etc/mx-api-token', 'text') 
     
+    def do_exit(self, reason):
+        AppCissContext.do_exit(self, reason)
+        self.tpg_stop_catch_up()
+        if self._forward_queue is not None:
+            try:
+                self._forward_queue.close()
+            except (IOError, OSError):
+                self.log_exception('Forward queue %s close failed!', self._forward_queue.path)
+        with self._sinks_lock:
+            for sink in self._sinks:
+                sink.close()
+        return True
+    
 #    @staticmethod
 #    def tpg_publish_tag_name(node_name, sensor_name, which):
 #        tag_name = ('%s-%s-%s'% (node_name, sensor_name, which))
@@ -212,6 +745,8 @@ def main(assigned_args = None):
         my_app = TpgCissContext(cargs, 
                                 app_name='ciss_tpg', 
                                 logger=AppContext.initLogger(cargs.verbose_level, cargs.file_level, None, True))       
+        my_app.startup_mark('interpreter', _startup_time)
+        my_app.startup_mark('imports', _imported_time)
         if not my_app.init_context():
             # debug_print_classes() # debuging modules loaded
             return my_app.exit_context(1)
@@ -7,13 +7,28 @@ Base class implementations
 
 '''
 Change log
+1.3.2 - 2021-01-15 - cg
+    Monotonic clock of Python 2 with a timespec per call, thread safe
+    
+1.3.1 - 2021-01-09 - cg
+    Logger extra cached on first use
+    
+1.3.0 - 2020-11-14 - cg
+    Monotonic clock
+    
+1.2.0 - 2020-11-10 - cg
+    Lazy module imports, cached module checks, startup phase report
+    
+1.1.1 - 2020-11-08 - cg
+    Slotted AppBase, logger extra created on demand
+    
 1.0.0 - 2020-03-01 - cg
     Initial version
 '''
 
 __author__ = "chgrCode"
 __license__ = "MIT"
-__version__ = '1.1.0'
+__version__ = '1.3.2'
 __maintainer__ = "chgrCode"
 __credits__ = ["..."]
 __status__ = "beta"
@@ -132,6 +147,8 @@ class AppTimer(object):
 '''    
 class AppBase(object):        
     ''' Default App Base class constructor '''
+    __slots__ = ('_base_id', '_logger', '_logger_level', '_error', '_error_str', '_extra')
+    
     def __init__(self, id='base', **kwargs):
         """
         @param id, kwargs: ....
@@ -144,17 +161,26 @@ class AppBase(object):
         self._base_id = id
         self._logger = kwargs.get('logger', None)
         self._logger_level = AppLogLevel.NOTSET.value
-        self._logger_extra = {'base_id': self._base_id}        
         self._error = AppErrorCode.OK.value
         self._error_str = ''
+        self._extra = None
         
         return
     
     def get_base_id(self):
         return self._base_id
     
+    @property
+    def _logger_extra(self):
+        # created with the first log call, objects that never log have none
+        extra = self._extra
+        if extra is None:
+            extra = self._extra = {'base_id': self._base_id}
+        return extra
+    
     def set_base_id(self, id):
         self._base_id = id
+        self._extra = None
         return self._base_id
        
     def set_error_str(self, error, error_str):  
@@ -319,8 +345,35 @@ class AppContext(AppBase):
             self.log_debug('Console Args: %s', str(argc))
         signal.signal(signal.SIGINT, self.signal_exit_gracefully)
         signal.signal(signal.SIGTERM, self.signal_exit_gracefully)          
+        self._startup_marks = [('start', AppUtil.process_start_time() or time.time())]
+        self._startup_reported = False
         return
     
+    def startup_mark(self, phase, timestamp=None):
+        '''
+        Mark the end of a startup phase
+        '''
+        if self._startup_reported:
+            return False
+        self._startup_marks.append((phase, time.time() if timestamp is None else timestamp))
+        return True
+    
+    def startup_report(self):
+        '''
+        Log the duration of each startup phase and of the lazy imports
+        '''
+        if self._startup_reported:
+            return False
+        self._startup_reported = True
+        last = self._startup_marks[0][1]
+        for phase, timestamp in self._startup_marks[1:]:
+            self.log_info('Startup %-20s %8.1f ms', phase, (timestamp - last) * 1000)
+            last = timestamp
+        self.log_info('Startup %-20s %8.1f ms', 'total', (last - self._startup_marks[0][1]) * 1000)
+        for name, elapsed in sorted(AppUtil.import_times.items()):
+            self.log_info('Lazy import %-16s %8.1f ms', name, elapsed)
+        return True
+    
    
     @staticmethod
     def initLogger(console_level, file_level, logger_file, enable_global=False):    
@@ -441,9 +494,43 @@ class AppContext(AppBase):
         self.stop_run_context(signum)   
 
 
+'''
+'''
+class AppLazyModule(object):
+    '''
+    Module proxy, the module is imported on the first attribute access
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = AppUtil.import_module(self.__dict__['_name'])
+        return getattr(module, attr)
+
+
+'''
+'''
+class AppModuleAvailable(object):
+    '''
+    Class attribute which checks on first use if a module can be imported
+    '''
+    def __init__(self, name):
+        self._name = name
+        
+    def __get__(self, obj, cls=None):
+        return AppUtil.module_exists(self._name)
+
+
 '''
 '''
 class AppUtil(AppBase):
+    _module_exists = {}
+    # module name -> import time (ms) of lazy imported modules
+    import_times = {}
+    _monotonic = None
     
     '''
     '''
@@ -463,9 +550,77 @@ class AppUtil(AppBase):
     '''
     @staticmethod
     def module_exists(module):
+        if module in AppUtil._module_exists:
+            return AppUtil._module_exists[module]
         try:
-            __import__('imp').find_module(module)
-            found = True
+            try:
+                from importlib.util import find_spec
+            except ImportError:
+                __import__('imp').find_module(module)
+                found = True
+            else:
+                found = find_spec(module) is not None
         except ImportError:
             found = False
-        return found
\ No newline at end of file
+        AppUtil._module_exists[module] = found
+        return found
+    
+    @staticmethod
+    def lazy_import(module):
+        return AppLazyModule(module)
+    
+    @staticmethod
+    def import_module(module):
+        t = time.time()
+        __import__(module)
+        AppUtil.import_times[module] = (time.time() - t) * 1000
+        return sys.modules[module]
+    
+    @staticmethod
+    def monotonic():
+        '''
+        Seconds of a monotonic clock, not affected by system time changes
+        '''
+        if AppUtil._monotonic is None:
+            AppUtil._monotonic = staticmethod(AppUtil._monotonic_clock())
+        return AppUtil._monotonic()
+    
+    @staticmethod
+    def _monotonic_clock():
+        if hasattr(time, 'monotonic'):
+            return time.monotonic
+        # Python 2, clock_gettime(CLOCK_MONOTONIC) of libc (librt for glibc < 2.17)
+        try:
+            import ctypes
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+            try:
+                clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+            except AttributeError:
+                clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            def monotonic():
+                # ctypes releases the GIL, a shared timespec could be torn
+                ts = timespec()
+                if clock_gettime(1, ctypes.byref(ts)) != 0:
+                    raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+                return ts.tv_sec + ts.tv_nsec * 1e-9
+            monotonic()
+            return monotonic
+        except (ImportError, OSError, AttributeError):
+            return time.time
+    
+    @staticmethod
+    def process_start_time():
+        '''
+        Start time of the process (seconds since epoch), None if unknown
+        '''
+        try:
+            with open('/proc/self/stat') as f:
+                # skip pid and (comm), starttime is field 22
+                start_ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+            return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+        except (IOError, OSError, ValueError, IndexError):
+            return None
\ No newline at end of file
@@ -0,0 +1,278 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS sensor value aggregation
+
+O(1) per sample partial aggregates (count, sum, sum of squares, min, max)
+which are frozen into a window summary at the end of each window.
+Coarser aggregation tiers are merged from the finer tier summaries.
+Raw samples are kept in compact multi channel ring buffers.
+'''
+
+'''
+Change log
+0.3.1 - 2020-12-12 - cg
+    Batch add of the tier cascade
+    
+0.3.0 - 2020-11-08 - cg
+    Add multi channel ring buffer, slotted aggregates
+    
+0.2.0 - 2020-10-30 - cg
+    Add aggregation tier cascade
+    
+0.1.0 - 2020-10-28 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.3.1'
+__status__ = "beta"
+
+import math
+
+from array import array
+from collections import namedtuple, deque
+
+
+def tier_name(period):
+    '''
+    Short tier name used for tags, e.g. 1s, 1m, 15m, 1h
+    '''
+    if period % 3600 == 0:
+        return '%dh'% (period // 3600)
+    elif period % 60 == 0:
+        return '%dm'% (period // 60)
+    return '%ds'% period
+
+
+class CissWindow(namedtuple('CissWindow', ['start', 'end', 'count', 'min', 'max', 'sum', 'sumsq'])):
+    '''
+    Frozen summary of all samples between start and end (seconds)
+    '''
+    __slots__ = ()
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return 0.0
+        var = (self.sumsq - self.sum * self.sum / self.count) / (self.count - 1)
+        return math.sqrt(var) if var > 0 else 0.0
+
+    def get_value(self, what):
+        return getattr(self, what)
+
+
+class CissAggregate(object):
+    '''
+    Partial aggregate of the running window
+    '''
+    __slots__ = ('start', 'count', 'sum', 'sumsq', 'min', 'max')
+    
+    def __init__(self, start=None):
+        self.start = start
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = None
+        self.max = None
+        return
+
+    def add(self, value):
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        return True
+
+    def merge(self, window):
+        if not window.count:
+            return False
+        if self.count:
+            if window.min < self.min:
+                self.min = window.min
+            if window.max > self.max:
+                self.max = window.max
+        else:
+            self.min = window.min
+            self.max = window.max
+        self.count += window.count
+        self.sum += window.sum
+        self.sumsq += window.sumsq
+        return True
+
+    def freeze(self, end):
+        return CissWindow(self.start, end, self.count, self.min, self.max, self.sum, self.sumsq)
+
+
+class CissTierCascade(object):
+    '''
+    Aggregation tiers aligned to multiples of their period (seconds).
+    Only the finest tier sees raw samples, each closed window is merged
+    into the next coarser tier. Closed windows are kept in a bounded 
+    history per tier and in a bounded pending queue for publishing.
+    '''
+    __slots__ = ('periods', 'names', 'history', '_pending', '_accs', '_ends')
+    
+    def __init__(self, periods, history_size=60, max_pending=100):
+        self.periods = sorted(periods)
+        for ix in range(1, len(self.periods)):
+            if self.periods[ix] % self.periods[ix-1]:
+                raise ValueError('Tier period %s is not a multiple of %s'% (self.periods[ix], self.periods[ix-1]))
+        self.names = [tier_name(period) for period in self.periods]
+        self.history = [deque(maxlen=history_size) for period in self.periods]
+        self._pending = deque(maxlen=max_pending)
+        self._accs = [CissAggregate() for period in self.periods]
+        self._ends = [None for period in self.periods]
+        return
+
+    def add(self, value, timestamp):
+        end = self._ends[0]
+        if end is None or timestamp >= end:
+            self._roll(0, timestamp)
+        self._accs[0].add(value)
+        return True
+
+    def add_batch(self, window, values, timestamps):
+        '''
+        Add a batch of values, merged as one summary (CissWindow) if no 
+        timestamp reaches the end of the finest tier window
+        '''
+        end = self._ends[0]
+        if end is not None and max(timestamps) < end:
+            self._accs[0].merge(window)
+            return True
+        for ix in range(len(values)):
+            self.add(values[ix], timestamps[ix])
+        return True
+
+    def _roll(self, level, timestamp):
+        period = self.periods[level]
+        if self._ends[level] is not None:
+            window = self._accs[level].freeze(self._ends[level])
+            if window.count:
+                self.history[level].append(window)
+                self._pending.append((level, window))
+                if level + 1 < len(self.periods):
+                    self._accs[level+1].merge(window)
+        if level + 1 < len(self.periods):
+            end = self._ends[level+1]
+            if end is None or timestamp >= end:
+                self._roll(level+1, timestamp)
+        start = timestamp - (timestamp % period)
+        self._accs[level] = CissAggregate(start)
+        self._ends[level] = start + period
+        return True
+
+    def pop_closed(self):
+        '''
+        Returns list of (tier name, CissWindow) closed since the last call
+        '''
+        closed = []
+        while self._pending:
+            level, window = self._pending.popleft()
+            closed.append((self.names[level], window))
+        return closed
+
+
+class CissRingBuffer(object):
+    '''
+    Fixed size ring buffer of float samples for one or more channels, 
+    stored interleaved in one array (8 bytes per sample). Each channel
+    has its own write position, so the channels of a xyz sensor can be
+    filled independently.
+    '''
+    __slots__ = ('size', 'channels', '_data', '_heads', '_counts')
+    
+    def __init__(self, size, channels=1):
+        self.size = max(int(size), 1)
+        self.channels = channels
+        self._data = array('d', [0.0]) * (self.size * channels)
+        self._heads = [0] * channels
+        self._counts = [0] * channels
+        return
+    
+    def append(self, value, channel=0):
+        head = self._heads[channel]
+        self._data[head * self.channels + channel] = value
+        head += 1
+        self._heads[channel] = 0 if head == self.size else head
+        if self._counts[channel] < self.size:
+            self._counts[channel] += 1
+        return True
+    
+    def extend(self, values, channel=0):
+        for value in values:
+            self.append(value, channel)
+        return True
+    
+    def count(self, channel=0):
+        return self._counts[channel]
+    
+    def values(self, channel=0):
+        '''
+        List of the channel samples, oldest first
+        '''
+        column = self._data[channel::self.channels]
+        head = self._heads[channel]
+        if self._counts[channel] < self.size:
+            return column[:head].tolist()
+        return (column[head:] + column[:head]).tolist()
+    
+    def resize(self, size):
+        '''
+        Change the number of samples per channel, the newest samples are kept
+        '''
+        size = max(int(size), 1)
+        if size == self.size:
+            return False
+        columns = [self.values(channel)[-size:] for channel in range(self.channels)]
+        self.__init__(size, self.channels)
+        for channel, column in enumerate(columns):
+            self.extend(column, channel)
+        return True
+    
+    def view(self, channel=0):
+        return CissRingView(self, channel)
+
+
+class CissRingView(object):
+    '''
+    Deque like view of one CissRingBuffer channel
+    '''
+    __slots__ = ('buffer', 'channel')
+    
+    def __init__(self, buffer, channel=0):
+        self.buffer = buffer
+        self.channel = channel
+        return
+    
+    @property
+    def maxlen(self):
+        return self.buffer.size
+    
+    def append(self, value):
+        return self.buffer.append(value, self.channel)
+    
+    def extend(self, values):
+        return self.buffer.extend(values, self.channel)
+    
+    def resize(self, size):
+        return self.buffer.resize(size)
+    
+    def __len__(self):
+        return self.buffer.count(self.channel)
+    
+    def __iter__(self):
+        return iter(self.buffer.values(self.channel))
@@ -0,0 +1,466 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS compressed history archive
+
+The decoded stream data is stored per node and channel in chunks. A chunk
+holds up to chunk_samples samples, the timestamps (ms) as delta of delta
+and the values (scaled to integers) as delta, both zigzag varint encoded,
+optionally compressed with zlib. The chunk header holds node, channel,
+count, first and last timestamp and min/max, so chunks can be skipped
+without decoding. Fed like CissDataLog from the read threads through a
+buffer and written by a background thread.
+'''
+
+'''
+Change log
+0.2.1 - 2020-12-10 - cg
+    Partly written chunk at the end of the file cut on open
+    
+0.2.0 - 2020-11-30 - cg
+    Reader from a file offset and with an open file, chunk_header
+    
+0.1.0 - 2020-11-26 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.2.1'
+__status__ = "beta"
+
+import os
+import sys
+import glob
+import math
+import zlib
+import struct
+
+from collections import namedtuple
+
+from .chgrcodebase import *
+from .cissDataLog import CissDataLog
+
+# channel name and scale of the stream values (vendor dataStream.csv columns)
+CISS_ARCHIVE_CHANNELS = (
+    ('ax', 1), ('ay', 1), ('az', 1),
+    ('gx', 1), ('gy', 1), ('gz', 1),
+    ('mx', 1), ('my', 1), ('mz', 1),
+    ('t', 10), ('p', 100), ('h', 100),
+    ('l', 1), ('n', 1)
+    )
+_CHANNEL_INDEX = dict((name, ix) for ix, (name, scale) in enumerate(CISS_ARCHIVE_CHANNELS))
+
+_CHUNK_MAGIC = b'CZ'
+_CHUNK_VERSION = 1
+_FLAG_ZLIB = 0x01
+# magic, version, flags, channel, node name length, count, first/last timestamp (ms),
+# min, max (scaled), payload length, payload crc32
+_CHUNK_HEADER = struct.Struct('<2sBBBBHqqiiII')
+
+# chunk header and position of the payload in the archive file
+CissArchiveChunk = namedtuple('CissArchiveChunk', ['node', 'channel', 'count', 't0', 't1', 'vmin', 'vmax',
+                                                   'flags', 'offset', 'length', 'crc'])
+
+
+def encode_varints(values, out):
+    '''
+    Append the zigzag varints of the integers to bytearray out
+    '''
+    append = out.append
+    for value in values:
+        value = value << 1 if value >= 0 else ((-value) << 1) - 1
+        while value >= 0x80:
+            append((value & 0x7F) | 0x80)
+            value >>= 7
+        append(value)
+    return out
+
+
+def decode_varints(data, pos, count):
+    '''
+    Decode count zigzag varints of bytearray data from pos, returns
+    list of integers and the next position
+    '''
+    values = []
+    append = values.append
+    for ix in range(count):
+        byte = data[pos]
+        pos += 1
+        value = byte & 0x7F
+        shift = 7
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+        append((value >> 1) ^ -(value & 1))
+    return values, pos
+
+
+def encode_chunk(timestamps, values):
+    '''
+    Payload of a chunk, timestamps as delta of delta (first timestamp in
+    the header), values as delta
+    '''
+    out = bytearray()
+    deltas = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    encode_varints([b - a for a, b in zip([0] + deltas, deltas)], out)
+    encode_varints([b - a for a, b in zip([0] + values, values)], out)
+    return bytes(out)
+
+
+def decode_chunk(payload, count, t0):
+    '''
+    Returns the lists of timestamps and values of a chunk payload
+    '''
+    data = bytearray(payload)
+    dds, pos = decode_varints(data, 0, count - 1)
+    deltas, pos = decode_varints(data, pos, count)
+    timestamps = [t0]
+    delta = 0
+    t = t0
+    for dd in dds:
+        delta += dd
+        t += delta
+        timestamps.append(t)
+    values = []
+    value = 0
+    for delta in deltas:
+        value += delta
+        values.append(value)
+    return timestamps, values
+
+
+def chunk_header(node, channel, flags, count, t0, t1, vmin, vmax, payload):
+    '''
+    Header and node name of a chunk, written in front of the payload
+    '''
+    node = str(node).encode('utf-8')
+    return _CHUNK_HEADER.pack(_CHUNK_MAGIC, _CHUNK_VERSION, flags, channel, len(node), count, t0, t1, vmin, vmax,
+                              len(payload), zlib.crc32(payload) & 0xFFFFFFFF) + node
+
+
+def archive_files(file_name):
+    '''
+    Rotated files and the current file of an archive, oldest first
+    '''
+    base, ext = os.path.splitext(file_name)
+    files = sorted(glob.glob('%s-????????-??????*%s'% (base, ext)), key=os.path.getmtime)
+    if os.path.exists(file_name):
+        files.append(file_name)
+    return files
+
+
+class CissArchive(CissDataLog):
+    '''
+    chunk_samples: samples per chunk, chunk_age: seconds until a partly
+    filled chunk is written, compress: zlib pass over the chunk payload.
+    Buffer, flush and rotation options of CissDataLog.
+    '''
+    def __init__(self, file_name, id='cissArchive', **kwargs):
+        CissDataLog.__init__(self, file_name, id, **kwargs)
+        self.chunk_samples = min(int(kwargs.get('chunk_samples', 1024)), 0xFFFF)
+        self.chunk_age = float(kwargs.get('chunk_age', 60.0))
+        self.compress = bool(kwargs.get('compress', False))
+        self.samples_written = 0
+        self.chunks_written = 0
+        self.bytes_written = 0
+        # (node, channel) -> [timestamps, values, monotonic time of the first sample]
+        self._chunks = {}
+        return
+
+    def open(self):
+        if os.path.exists(self.file_name):
+            self.repair()
+        self._file = open(self.file_name, 'ab', self.buffer_size)
+        self._day = time.strftime('%Y%m%d')
+        return True
+
+    def repair(self):
+        '''
+        Cut a partly written chunk (power loss) at the end of the file,
+        the reader stops there and would not see the chunks appended after
+        it. Returns the file size
+        '''
+        size = os.path.getsize(self.file_name)
+        end = CissArchiveReader(self.file_name, logger=self.get_logger()).valid_size()
+        if end < size:
+            self.log_warning('Archive %s partly written chunk at %d, %d bytes cut', self.file_name, end, size - end)
+            with open(self.file_name, 'r+b') as f:
+                f.truncate(end)
+        return end
+
+    def close(self):
+        if self._chunks:
+            if self._file is None:
+                self.open()
+            for key in list(self._chunks.keys()):
+                self.write_chunk(key)
+        return CissDataLog.close(self)
+
+    def flush(self):
+        '''
+        Add the buffered rows to the chunks, write the full and the aged
+        chunks, called by the writer thread
+        '''
+        rows = self._rows
+        chunks = self._chunks
+        now = AppUtil.monotonic()
+        count = len(rows)
+        if self._file is None:
+            if not count and not chunks:
+                return False
+            self.open()
+        elif self.rotate_daily and time.strftime('%Y%m%d') != self._day:
+            self.rotate()
+        for ix in range(count):
+            node, timestamp, values = rows.popleft()
+            timestamp = int(timestamp * 1000)
+            for channel, value in enumerate(values):
+                if value == '' or value is None:
+                    continue
+                key = (node, channel)
+                chunk = chunks.get(key, None)
+                if chunk is None:
+                    chunk = chunks[key] = [[], [], now]
+                chunk[0].append(timestamp)
+                chunk[1].append(int(round(value * CISS_ARCHIVE_CHANNELS[channel][1])))
+                if len(chunk[0]) >= self.chunk_samples:
+                    self.write_chunk(key)
+        self.rows_written += count
+        for key, chunk in list(chunks.items()):
+            if now - chunk[2] >= self.chunk_age:
+                self.write_chunk(key)
+        self._file.flush()
+        if self.max_size and self._file.tell() >= self.max_size:
+            self.rotate()
+        return True
+
+    def write_chunk(self, key):
+        timestamps, values, first = self._chunks.pop(key)
+        payload = encode_chunk(timestamps, values)
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload, 6)
+            flags |= _FLAG_ZLIB
+        header = chunk_header(key[0], key[1], flags, len(values), timestamps[0], timestamps[-1],
+                              min(values), max(values), payload)
+        self._file.write(header)
+        self._file.write(payload)
+        self.samples_written += len(values)
+        self.chunks_written += 1
+        self.bytes_written += len(header) + len(payload)
+        return True
+
+
+class CissArchiveReader(AppBase):
+    '''
+    Read the chunks of an archive file, a partly written chunk at the end
+    (power loss) ends the file, chunks with crc error are skipped
+    '''
+    def __init__(self, file_name, id='cissArchiveReader', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.file_name = file_name
+        self.crc_errors = 0
+        return
+
+    @staticmethod
+    def channel_index(channel):
+        if channel is None or isinstance(channel, int):
+            return channel
+        if channel not in _CHANNEL_INDEX:
+            raise ValueError('Archive channel %s unknown'% channel)
+        return _CHANNEL_INDEX[channel]
+
+    def valid_size(self):
+        '''
+        End of the last complete chunk of the file
+        '''
+        end = 0
+        for chunk in self.chunks():
+            end = chunk.offset + chunk.length
+        return end
+
+    def chunks(self, node=None, channel=None, start=None, end=None, offset=0):
+        '''
+        Headers of the chunks of node and channel (all if None) with samples
+        between start and end (ms), the payload is not read. offset: file
+        position of a chunk header to start from
+        '''
+        channel = self.channel_index(channel)
+        size = _CHUNK_HEADER.size
+        with open(self.file_name, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(size)
+                if len(header) < size:
+                    break
+                magic, version, flags, ch, node_len, count, t0, t1, vmin, vmax, length, crc = _CHUNK_HEADER.unpack(header)
+                if magic != _CHUNK_MAGIC or version != _CHUNK_VERSION:
+                    self.log_warning('Archive %s invalid chunk header at %d', self.file_name, offset)
+                    break
+                name = f.read(node_len).decode('utf-8')
+                offset += size + node_len
+                if offset + length > os.fstat(f.fileno()).st_size:
+                    break
+                if ((node is None or name == node) and (channel is None or ch == channel) and
+                    (start is None or t1 >= start) and (end is None or t0 <= end)):
+                    yield CissArchiveChunk(name, ch, count, t0, t1, vmin, vmax, flags, offset, length, crc)
+                offset += length
+                f.seek(offset)
+        return
+
+    def read(self, chunk, f=None):
+        '''
+        Returns the timestamps (ms) and the scaled integer values of a chunk,
+        None on crc error. f: archive file opened by the caller
+        '''
+        if f is None:
+            with open(self.file_name, 'rb') as f:
+                f.seek(chunk.offset)
+                payload = f.read(chunk.length)
+        else:
+            f.seek(chunk.offset)
+            payload = f.read(chunk.length)
+        if zlib.crc32(payload) & 0xFFFFFFFF != chunk.crc:
+            self.crc_errors += 1
+            self.log_warning('Archive %s crc error in chunk at %d', self.file_name, chunk.offset)
+            return None
+        if chunk.flags & _FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return decode_chunk(payload, chunk.count, chunk.t0)
+
+    def samples(self, node, channel, start=None, end=None):
+        '''
+        Yields (timestamp (ms), value) of node and channel between start and end (ms)
+        '''
+        channel = self.channel_index(channel)
+        scale = float(CISS_ARCHIVE_CHANNELS[channel][1])
+        for chunk in self.chunks(node, channel, start, end):
+            decoded = self.read(chunk)
+            if decoded is None:
+                continue
+            for timestamp, value in zip(*decoded):
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield timestamp, value / scale if scale != 1 else value
+        return
+
+
+def synthetic_rows(node, seconds, rate=100.0, seed=1):
+    '''
+    Synthetic CISS stream rows (node, timestamp, values) like AppCissNode
+    decodes them, inertial frames at rate, environment and light at 1 Hz
+    '''
+    import random
+    rnd = random.Random(seed)
+    start = 1605000000.0
+    empty = [''] * 14
+    for ix in range(int(seconds * rate)):
+        timestamp = start + ix / rate + rnd.uniform(-0.001, 0.001)
+        phase = 2 * math.pi * ix / rate
+        for first, amplitude in ((0, 1000), (3, 200), (6, 40)):
+            values = list(empty)
+            values[first] = int(amplitude * math.sin(phase)) + rnd.randint(-3, 3)
+            values[first + 1] = int(amplitude * math.cos(phase)) + rnd.randint(-3, 3)
+            values[first + 2] = 1000 + rnd.randint(-3, 3) if first == 0 else rnd.randint(-3, 3)
+            yield node, timestamp, values
+        if ix % int(rate) == 0:
+            values = list(empty)
+            values[9] = round(21.5 + ix / rate / 600 + rnd.choice((-0.1, 0, 0.1)), 1)
+            values[10] = round(1013.25 + rnd.choice((-0.01, 0, 0.01)), 2)
+            values[11] = round(45.0 + rnd.choice((-0.05, 0, 0.05)), 2)
+            yield node, timestamp, values
+            values = list(empty)
+            values[12] = 300 + rnd.randint(-2, 2)
+            yield node, timestamp, values
+    return
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-d", dest="path", metavar="Directory", default='/tmp', help="Directory of the test files!")
+    parser.add_argument("-s", dest="seconds", metavar="Seconds", type=float, default=600, help="Seconds of synthetic data!")
+    parser.add_argument("-r", dest="rate", metavar="Rate", type=float, default=100, help="Inertial frames per second!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Size, encode/decode throughput and round trip on synthetic CISS data, python -m lib.cissArchive
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    rows = list(synthetic_rows('CissSIM0', cargs.seconds, cargs.rate))
+    samples = sum(len([value for value in values if value != '']) for node, timestamp, values in rows)
+
+    file_name = os.path.join(cargs.path, 'ciss_archive_test.csv')
+    for old in archive_files(file_name):
+        os.remove(old)
+    data_log = CissDataLog(file_name, max_rows=len(rows))
+    for row in rows:
+        data_log.write(*row)
+    data_log.flush()
+    data_log.close()
+    csv_size = os.path.getsize(file_name)
+    os.remove(file_name)
+    print('%d rows, %d samples, %.0f s of data'% (len(rows), samples, cargs.seconds))
+    print('%-10s %10s %8s %8s %12s %12s'% ('format', 'bytes', 'B/sample', 'ratio', 'enc sps', 'dec sps'))
+    print('%-10s %10d %8.2f %8.1f'% ('csv', csv_size, float(csv_size) / samples, 1.0))
+    # timestamp (8 bytes) and value (4 bytes) per sample
+    print('%-10s %10d %8.2f %8.1f'% ('raw', samples * 12, 12.0, csv_size / (samples * 12.0)))
+
+    ok = True
+    for compress in (False, True):
+        file_name = os.path.join(cargs.path, 'ciss_archive_test.cza')
+        for old in archive_files(file_name):
+            os.remove(old)
+        archive = CissArchive(file_name, max_rows=len(rows), compress=compress)
+        for row in rows:
+            archive.write(*row)
+        t = AppTimer()
+        t.start()
+        archive.flush()
+        archive.close()
+        encode_time = t.stop()
+        size = os.path.getsize(file_name)
+
+        reader = CissArchiveReader(file_name)
+        t = AppTimer()
+        t.start()
+        decoded = {}
+        for chunk in reader.chunks():
+            timestamps, values = reader.read(chunk)
+            decoded.setdefault(chunk.channel, []).extend(zip(timestamps, values))
+        decode_time = t.stop()
+        print('%-10s %10d %8.2f %8.1f %12.0f %12.0f'% ('delta+zlib' if compress else 'delta', size,
+              float(size) / samples, float(csv_size) / size, samples * 1000 / encode_time,
+              samples * 1000 / decode_time))
+
+        expected = {}
+        for node, timestamp, values in rows:
+            for channel, value in enumerate(values):
+                if value != '':
+                    expected.setdefault(channel, []).append((int(timestamp * 1000),
+                                                             int(round(value * CISS_ARCHIVE_CHANNELS[channel][1]))))
+        if decoded != expected:
+            ok = False
+            print('round trip FAILED')
+        os.remove(file_name)
+    if ok:
+        print('round trip ok, %d channels'% len(expected))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
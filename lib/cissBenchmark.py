@@ -0,0 +1,188 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS benchmarks
+
+Resource benchmarks of the sensor model, python -m lib.cissBenchmark
+'''
+
+'''
+Change log
+0.2.0 - 2020-11-10 - cg
+    Add startup benchmark
+    
+0.1.0 - 2020-11-08 - cg
+    Initial version, sensor memory benchmark
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.2.0'
+__status__ = "beta"
+
+import sys
+import os
+import gc
+import json
+import time
+import types
+import logging
+import threading
+
+from .chgrcodebase import *
+
+
+def deep_sizeof(root, skip=()):
+    '''
+    Bytes of root and all objects only reachable through it, classes,
+    modules, functions, loggers and the skip objects are not counted
+    '''
+    seen = set(id(obj) for obj in skip)
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (type, types.ModuleType, types.FunctionType, types.MethodType,
+                            logging.Logger, logging.Handler)):
+            continue
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def bench_memory(cargs):
+    from .cissUsbSensor import AppCissNode
+    with open(cargs.config_file) as f:
+        ext_conf = json.load(f)
+    node_conf = list(ext_conf['ciss_nodes'].values())[0]
+    print('%-8s %8s %12s %14s'% ('mode', 'window', 'bytes/node', 'bytes/sensor'))
+    for window_stats in (True, False):
+        for window in cargs.windows:
+            conf = json.loads(json.dumps(node_conf))
+            for sensor_conf in conf['sensors'].values():
+                sensor_conf['enabled'] = True
+                sensor_conf['enable_statistics'] = window
+            sensors = AppCissNode.create_sensors(None, conf['sensors'], window_stats=window_stats)
+            for ix in range(window):
+                stream_data = dict(('%s_%s'% (s_id, type), ix) for s_id in sensors for type in ('x', 'y', 'z'))
+                stream_data.update((s_id, ix) for s_id in sensors)
+                stream_data['timestamp'] = ix * 0.01
+                for sensor in sensors.values():
+                    sensor.update_value_ext(stream_data)
+            for sensor in sensors.values():
+                sensor.calc_statistics()
+            size = deep_sizeof(sensors)
+            print('%-8s %8d %12d %14d'% ('publish' if window_stats else 'samples', window, size, size // len(sensors)))
+    return True
+
+
+def ciss_frame(data_type, data):
+    '''
+    Serial stream frame: start byte, length, payload, xor checksum
+    '''
+    frame = [len(data) + 1, data_type] + list(data)
+    crc = 0
+    for value in frame:
+        crc ^= value
+    return bytearray([0xFE] + frame + [crc])
+
+
+def bench_startup_child(cargs):
+    '''
+    Time the startup phases of one process with a node on a pseudo terminal,
+    prints the phase times (ms since process start) as json
+    '''
+    import pty
+    import tty
+    marks = [('start', AppUtil.process_start_time()), ('interpreter', time.time())]
+    from .cissUsbSensor import AppCissNode
+    from .tpg_create_vtags import TpgEquipmentApp
+    if AppUtil.module_exists('libmxidaf_py'):
+        import libmxidaf_py
+    marks.append(('imports', time.time()))
+    
+    with open(cargs.config_file) as f:
+        ext_conf = json.load(f)
+    node_conf = list(ext_conf['ciss_nodes'].values())[0]
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    node_conf['com_port'] = os.ttyname(slave)
+    # discard the configuration commands sent to the node
+    reader = threading.Thread(target=lambda: [os.read(master, 1024) for ix in iter(int, 1)])
+    reader.daemon = True
+    reader.start()
+    marks.append(('config', time.time()))
+    
+    node = AppCissNode('bench', conf=node_conf, window_stats=True)
+    marks.append(('node init', time.time()))
+    
+    os.write(master, bytes(ciss_frame(0x02, [0x10, 0x00, 0x20, 0x00, 0xE8, 0x03])))
+    node.read_sensor_stream()
+    marks.append(('first frame', node.first_frame_time or time.time()))
+    print(json.dumps(dict((phase, (timestamp - marks[0][1]) * 1000) for phase, timestamp in marks[1:])))
+    return True
+
+
+def bench_startup(cargs):
+    import subprocess
+    phases = ('interpreter', 'imports', 'config', 'node init', 'first frame')
+    runs = []
+    for ix in range(cargs.runs):
+        out = subprocess.check_output([sys.executable, '-m', 'lib.cissBenchmark', 'startup', '--child',
+                                       '-c', cargs.config_file])
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+    print('%-12s %10s %10s'% ('phase', 'median ms', 'max ms'))
+    last = [0.0] * len(runs)
+    for phase in phases:
+        times = sorted(run[phase] - prev for run, prev in zip(runs, last))
+        last = [run[phase] for run in runs]
+        print('%-12s %10.1f %10.1f'% (phase, times[len(times) // 2], times[-1]))
+    first_frame = sorted(run['first frame'] for run in runs)
+    median = first_frame[len(first_frame) // 2]
+    print('time to first decoded frame: median %.1f ms, budget %d ms: %s'% 
+          (median, cargs.budget, 'ok' if median <= cargs.budget else 'EXCEEDED'))
+    return median <= cargs.budget
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("bench", choices=['memory', 'startup'], help="Benchmark to run!")
+    parser.add_argument("-c", dest="config_file", metavar="Config File", default='sensor.json', help="Configuration file to use!")
+    parser.add_argument("-w", dest="windows", metavar="Window Sizes", type=int, nargs='+', default=[10, 100, 1000], 
+                        help="Statistic window sizes!")
+    parser.add_argument("-n", dest="runs", metavar="Runs", type=int, default=5, help="Startup runs!")
+    parser.add_argument("-b", dest="budget", metavar="Budget", type=int, default=5000, 
+                        help="Time to first decoded frame budget in ms!")
+    parser.add_argument("--child", dest="child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    if cargs.bench == 'memory':
+        bench_memory(cargs)
+    elif cargs.child:
+        bench_startup_child(cargs)
+    elif not bench_startup(cargs):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
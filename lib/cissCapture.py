@@ -0,0 +1,360 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS trigger capture
+
+Raw stream data before and after a trigger. Each node keeps the decoded
+rows of the last seconds in a preallocated ring, written by the read
+thread. A trigger (event frame, software threshold or anomaly event, manual
+signal) copies the rows of the pre-trigger seconds out of the ring, the
+following rows are added until the post-trigger seconds are over. The
+complete capture is written to a CSV file by a background thread.
+'''
+
+'''
+Change log
+0.1.1 - 2021-01-07 - cg
+    Captures finished without stream data, ring grows with the actual row rate
+    
+0.1.0 - 2020-12-02 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.1'
+__status__ = "beta"
+
+import os
+import re
+import sys
+import glob
+import bisect
+import threading
+
+from array import array
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .chgrcodebase import *
+from .cissDataLog import CISS_DATA_HEADER
+
+csv = AppUtil.lazy_import('csv')
+
+
+class CissCapture(AppBase):
+    '''
+    Capture ring of one node. seconds_before/seconds_after: capture window
+    around the trigger time, rate: decoded rows per second the ring is
+    sized for (all streamed sensors of the node), margin: extra seconds in
+    the ring for triggers applied late (event dispatcher). The ring grows
+    up to max_rate rows per second if the rows come faster than rate
+    '''
+    def __init__(self, node, writer, id='cissCapture', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.node = node
+        self.seconds_before = float(kwargs.get('seconds_before', 5.0))
+        self.seconds_after = float(kwargs.get('seconds_after', 5.0))
+        self.rate = float(kwargs.get('rate', 400))
+        self.margin = float(kwargs.get('margin', 1.0))
+        self.max_rate = float(kwargs.get('max_rate', 8 * self.rate))
+        self.triggers = 0
+        self.triggers_merged = 0
+        self.captures = 0
+        self._writer = writer
+        self._size = max(1, int((self.seconds_before + self.margin) * self.rate))
+        self._max_size = max(self._size, int((self.seconds_before + self.margin) * self.max_rate))
+        self._times = array('d', [0.0]) * self._size
+        self._rows = [None] * self._size
+        self._pos = 0
+        self._full = False
+        # (reason, trigger time), set by trigger() from any thread, taken by the read thread
+        self._pending = None
+        # [reason, trigger time, end time, rows] of the running capture
+        self._capture = None
+        # taken to start and finish a capture, also by check() of the publisher
+        self._lock = threading.Lock()
+        return
+
+    def trigger(self, reason='manual', timestamp=None):
+        '''
+        Non-blocking, no lock (signal handlers, event dispatcher), applied
+        with the next row of the read thread
+        '''
+        self._pending = (reason, time.time() if timestamp is None else timestamp)
+        self.triggers += 1
+        return True
+
+    def write(self, timestamp, values):
+        '''
+        Called from the read thread for each decoded row
+        '''
+        pos = self._pos
+        self._times[pos] = timestamp
+        self._rows[pos] = values
+        pos += 1
+        if pos < self._size:
+            self._pos = pos
+        elif self.grow(timestamp):
+            self._pos = pos
+        else:
+            self._pos = 0
+            self._full = True
+        capture = self._capture
+        if capture is not None:
+            capture[3].append((timestamp, values))
+            if timestamp >= capture[2]:
+                self.finish()
+        if self._pending is not None:
+            self.start()
+        return True
+
+    def grow(self, timestamp):
+        '''
+        Double the ring at its end if it holds less than the pre-trigger
+        seconds, the rows come faster than the configured rate. The rows
+        of the full ring are in time order, the new rows are appended
+        '''
+        if self._size >= self._max_size or timestamp - self._times[0] >= self.seconds_before + self.margin:
+            return False
+        rate = self._size / max(timestamp - self._times[0], 1e-3)
+        size = min(self._size * 2, self._max_size)
+        self._times.extend(array('d', [0.0]) * (size - self._size))
+        self._rows.extend([None] * (size - self._size))
+        self._size = size
+        self._full = False
+        self.log_info('Capture %s ring grown to %d rows, %.0f rows/s', self.node, size, rate)
+        return True
+
+    def history(self, start):
+        '''
+        (timestamp, values) rows of the ring from start, oldest first
+        '''
+        pos = self._pos
+        times = self._times[pos:] + self._times[:pos]
+        first = bisect.bisect_left(times, start)
+        if not self._full:
+            first = max(first, self._size - pos)
+        if first >= self._size - pos:
+            return list(zip(times[first:], self._rows[first - self._size + pos:pos]))
+        return list(zip(times[first:], self._rows[pos + first:] + self._rows[:pos]))
+
+    def start(self):
+        reason, timestamp = self._pending
+        self._pending = None
+        with self._lock:
+            if self._capture is not None:
+                self.triggers_merged += 1
+                self.log_debug('Capture %s trigger %s merged into %s', self.node, reason, self._capture[0])
+                return False
+            self._capture = [reason, timestamp, timestamp + self.seconds_after,
+                             self.history(timestamp - self.seconds_before)]
+        self.log_info('Capture %s triggered by %s', self.node, reason)
+        if self._capture[3] and self._capture[3][-1][0] >= self._capture[2]:
+            self.finish()
+        return True
+
+    def finish(self):
+        '''
+        Hand the running capture to the writer, also for a partial capture
+        on exit
+        '''
+        with self._lock:
+            capture = self._capture
+            self._capture = None
+        if capture is None:
+            return False
+        reason, timestamp, end, rows = capture
+        self.captures += 1
+        return self._writer.put(self.node, reason, timestamp, [row for row in rows if row[0] <= end])
+
+    def check(self, now=None):
+        '''
+        Finish the capture or apply the trigger the read thread did not
+        take, the node stopped streaming. Called from the publisher thread
+        '''
+        if now is None:
+            now = time.time()
+        capture = self._capture
+        if capture is not None:
+            if now < capture[2] + self.margin:
+                return False
+            self.log_info('Capture %s finished without stream data', self.node)
+            return self.finish()
+        pending = self._pending
+        if pending is None or now < pending[1] + self.seconds_after + self.margin:
+            return False
+        self.log_info('Capture %s triggered without stream data', self.node)
+        self.start()
+        return self.finish()
+
+
+class CissCaptureWriter(AppBase):
+    '''
+    Writes the captures of all nodes to path, one CSV file per capture
+    (node-date-time-ms-reason.csv, columns of the data log), removes the
+    oldest files above max_files (0 keeps all)
+    '''
+    def __init__(self, path, id='cissCaptureWriter', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.path = path
+        self.max_files = int(kwargs.get('max_files', 100))
+        self.captures_written = 0
+        self.captures_dropped = 0
+        self.rows_written = 0
+        self._queue = queue.Queue(int(kwargs.get('max_queue', 10)))
+        self._thread = None
+        self._stop = False
+        return
+
+    def put(self, node, reason, timestamp, rows):
+        '''
+        Non-blocking, called from the read threads
+        '''
+        try:
+            self._queue.put_nowait((node, reason, timestamp, rows))
+        except queue.Full:
+            self.captures_dropped += 1
+            self.log_warning('Capture %s %s dropped, writer queue full!', node, reason)
+            return False
+        return True
+
+    def start(self):
+        if self.is_alive():
+            return True
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._stop = False
+        self._thread = threading.Thread(name=self.get_base_id(), target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.log_info('Captures to %s', self.path)
+        return True
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join(5)
+        self.write_pending()
+        return True
+
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return False
+
+    def run(self):
+        while not self._stop:
+            try:
+                capture = self._queue.get(True, 1.0)
+            except queue.Empty:
+                continue
+            self.write_capture(*capture)
+        return True
+
+    def write_pending(self):
+        while True:
+            try:
+                capture = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.write_capture(*capture)
+        return True
+
+    def file_name(self, node, reason, timestamp):
+        return os.path.join(self.path, '%s-%s-%03d-%s.csv'% (node, time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp)),
+                                                            int(timestamp * 1000) % 1000, re.sub(r'[^\w.-]', '_', reason)))
+
+    def write_capture(self, node, reason, timestamp, rows):
+        file_name = self.file_name(node, reason, timestamp)
+        try:
+            if sys.version_info[0] < 3:
+                f = open(file_name, 'wb')
+            else:
+                f = open(file_name, 'w', newline='')
+            with f:
+                writer = csv.writer(f, dialect='excel')
+                writer.writerow(CISS_DATA_HEADER)
+                # in slices, the read threads wait for the GIL while writerows runs
+                for ix in range(0, len(rows), 500):
+                    writer.writerows([[node, int(row_time * 1000)] + list(values) for row_time, values in rows[ix:ix + 500]])
+            if self.max_files:
+                files = sorted(glob.glob(os.path.join(self.path, '*.csv')), key=os.path.getmtime)
+                for old in files[:-self.max_files]:
+                    os.remove(old)
+        except (IOError, OSError):
+            self.log_exception('Capture %s not written!', file_name)
+            return False
+        self.captures_written += 1
+        self.rows_written += len(rows)
+        self.log_info('Capture %s, %d rows, %.1f s before, %.1f s after the trigger', file_name, len(rows),
+                      timestamp - rows[0][0] if rows else 0, rows[-1][0] - timestamp if rows else 0)
+        return True
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-d", dest="path", metavar="Directory", default='/tmp/ciss_captures', help="Directory of the captures!")
+    parser.add_argument("-n", dest="rows", metavar="Rows", type=int, default=100000, help="Number of rows!")
+    parser.add_argument("-r", dest="rate", metavar="Rate", type=float, default=400, help="Rows per second!")
+    parser.add_argument("-t", dest="triggers", metavar="Triggers", type=int, default=5, help="Number of triggers!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Cost per row in the read thread with triggers, python -m lib.cissCapture
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    from collections import deque
+    values = [100, -50, 1000, '', '', '', '', '', '', '', '', '', '', '']
+    start = 1605000000.0
+    stream_data = deque(maxlen=100)
+    t = AppTimer()
+    t.start()
+    for ix in range(cargs.rows):
+        stream_data.append({'id': 'CissSIM0', 'timestamp': start + ix / cargs.rate, 0: values[0], 1: values[1], 2: values[2]})
+    elapsed = t.stop()
+    print('stream_data deque : %d rows, %.2f us per row'% (cargs.rows, elapsed * 1000 / cargs.rows))
+
+    writer = CissCaptureWriter(cargs.path, max_files=cargs.triggers)
+    writer.start()
+    capture = CissCapture('CissSIM0', writer, rate=cargs.rate)
+    every = cargs.rows // (cargs.triggers + 1)
+    slowest = 0.0
+    t = AppTimer()
+    t.start()
+    for ix in range(cargs.rows):
+        if ix and ix % every == 0:
+            capture.trigger('manual', start + ix / cargs.rate)
+            t0 = AppUtil.monotonic()
+            capture.write(start + ix / cargs.rate, values)
+            slowest = max(slowest, AppUtil.monotonic() - t0)
+            continue
+        capture.write(start + ix / cargs.rate, values)
+    elapsed = t.stop()
+    capture.finish()
+    writer.stop()
+    print('CissCapture       : %d rows, %.2f us per row, ring %d rows, trigger row %.0f us'% (cargs.rows,
+          elapsed * 1000 / cargs.rows, capture._size, slowest * 1e6))
+    print('%d triggers, %d captures written (%d rows), %d dropped to %s'% (capture.triggers, writer.captures_written,
+          writer.rows_written, writer.captures_dropped, cargs.path))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
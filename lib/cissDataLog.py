@@ -0,0 +1,244 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS data logger
+
+Stream data rows in CSV files like the vendor write_to_csv, without
+opening the file per row. The read threads append the rows to a bounded
+buffer, a writer thread writes them through one long-lived file handle
+by size or time and rotates the file by size or day.
+'''
+
+'''
+Change log
+0.1.0 - 2020-11-24 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import os
+import sys
+import glob
+import threading
+
+from collections import deque
+
+from .chgrcodebase import *
+
+csv = AppUtil.lazy_import('csv')
+
+# vendor dataStream.csv header
+CISS_DATA_HEADER = [" id ", " timestamp ", " ax ", " ay ", " az ",
+                    " gx ", " gy ", " gz ", " mx ", " my ", " mz ",
+                    " t ", " p ", " h ", " l ", " n "]
+
+
+class CissDataLog(AppBase):
+    '''
+    file_name: CSV file, rotated files get a date and time suffix
+    max_rows: buffered rows, new rows are dropped while the buffer is full
+    flush_rows/flush_interval: write after rows or seconds
+    max_size (MB)/rotate_daily: rotation, max_files: rotated files kept (0 all)
+    '''
+    def __init__(self, file_name, id='cissDataLog', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.file_name = file_name
+        self.max_rows = int(kwargs.get('max_rows', 100000))
+        self.flush_rows = int(kwargs.get('flush_rows', 1000))
+        self.flush_interval = float(kwargs.get('flush_interval', 1.0))
+        self.max_size = int(float(kwargs.get('max_size', 0)) * 1024 * 1024)
+        self.rotate_daily = bool(kwargs.get('rotate_daily', False))
+        self.max_files = int(kwargs.get('max_files', 10))
+        self.buffer_size = int(kwargs.get('buffer_size', 64*1024))
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rotations = 0
+        self._rows = deque()
+        self._wakeup = threading.Event()
+        self._file = None
+        self._writer = None
+        self._day = None
+        self._thread = None
+        self._stop = False
+        return
+
+    def write(self, id, timestamp, values):
+        '''
+        Non-blocking, called from the read threads for each decoded frame
+        '''
+        rows = self._rows
+        if len(rows) >= self.max_rows:
+            self.rows_dropped += 1
+            return False
+        rows.append((id, timestamp, values))
+        if len(rows) == self.flush_rows:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        if self.is_alive():
+            return True
+        self._stop = False
+        self._thread = threading.Thread(name=self.get_base_id(), target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.log_info('Data log %s started', self.file_name)
+        return True
+
+    def stop(self):
+        self._stop = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 5)
+        self.flush()
+        self.close()
+        return True
+
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return False
+
+    def run(self):
+        while not self._stop:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, OSError):
+                self.log_exception('Data log %s write failed!', self.file_name)
+        return True
+
+    def open(self):
+        new_file = not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0
+        if sys.version_info[0] < 3:
+            self._file = open(self.file_name, 'ab', self.buffer_size)
+        else:
+            self._file = open(self.file_name, 'a', self.buffer_size, newline='')
+        self._writer = csv.writer(self._file, dialect='excel')
+        if new_file:
+            self._writer.writerow(CISS_DATA_HEADER)
+        self._day = time.strftime('%Y%m%d')
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+        return True
+
+    def rotate(self):
+        '''
+        Rename the current file with date and time suffix, remove the
+        oldest rotated files above max_files
+        '''
+        self.close()
+        base, ext = os.path.splitext(self.file_name)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        rotated_name = '%s-%s%s'% (base, stamp, ext)
+        count = 0
+        while os.path.exists(rotated_name):
+            count += 1
+            rotated_name = '%s-%s-%d%s'% (base, stamp, count, ext)
+        os.rename(self.file_name, rotated_name)
+        self.rotations += 1
+        if self.max_files:
+            rotated = sorted(glob.glob('%s-????????-??????*%s'% (base, ext)), key=os.path.getmtime)
+            for old in rotated[:-self.max_files]:
+                os.remove(old)
+        return self.open()
+
+    def flush(self):
+        '''
+        Write the buffered rows, called by the writer thread
+        '''
+        rows = self._rows
+        if not rows:
+            return False
+        if self._file is None:
+            self.open()
+        elif self.rotate_daily and time.strftime('%Y%m%d') != self._day:
+            self.rotate()
+        count = len(rows)
+        popleft = rows.popleft
+        self._writer.writerows([[id, int(timestamp*1000)] + list(values)
+                                for id, timestamp, values in (popleft() for ix in range(count))])
+        self._file.flush()
+        self.rows_written += count
+        if self.max_size and self._file.tell() >= self.max_size:
+            self.rotate()
+        return True
+
+
+def write_to_csv(file_name, id, buff, tstamp):
+    '''
+    Vendor CissUsbConnectord write_to_csv, file opened per row
+    '''
+    if not os.path.exists(file_name):
+        with open(file_name, "w") as csvOpen:
+            csvobj = csv.writer(csvOpen, dialect='excel')
+            csvobj.writerow(CISS_DATA_HEADER)
+    with open(file_name, "a") as csvOpen:
+        csvobj = csv.writer(csvOpen, dialect='excel')
+        csvobj.writerow([id, tstamp] + list(buff))
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-d", dest="path", metavar="Directory", default='/tmp', help="Directory of the CSV files!")
+    parser.add_argument("-n", dest="rows", metavar="Rows", type=int, default=20000, help="Number of rows!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Compare the time per row in the read thread, python -m lib.cissDataLog
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    values = [100, -50, 1000, '', '', '', '', '', '', '', '', '', '', '']
+    file_name = os.path.join(cargs.path, 'ciss_data_vendor.csv')
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    t = AppTimer()
+    t.start()
+    for ix in range(cargs.rows):
+        write_to_csv(file_name, 1, values, int((1605000000.0 + ix * 0.01) * 1000))
+    elapsed = t.stop()
+    print('write_to_csv : %d rows in %.1f ms, %.1f us per row'% (cargs.rows, elapsed, elapsed * 1000 / cargs.rows))
+    os.remove(file_name)
+
+    file_name = os.path.join(cargs.path, 'ciss_data_log.csv')
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    data_log = CissDataLog(file_name, max_rows=cargs.rows)
+    data_log.start()
+    t = AppTimer()
+    t.start()
+    for ix in range(cargs.rows):
+        data_log.write(1, 1605000000.0 + ix * 0.01, values)
+    elapsed = t.stop()
+    data_log.stop()
+    print('CissDataLog  : %d rows in %.1f ms, %.1f us per row, %d written, %d dropped'% (cargs.rows, elapsed,
+          elapsed * 1000 / cargs.rows, data_log.rows_written, data_log.rows_dropped))
+    os.remove(file_name)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS derived channels
+
+Buffers xyz samples and calculates the euclidean magnitude, tilt angles
+and per axis RMS in batches. Uses NumPy if available, otherwise array
+based loops.
+'''
+
+'''
+Change log
+0.3.0 - 2021-01-11 - cg
+    Buffer the samples interleaved in one array, plain sums, default batch
+    256, benchmark the best of interleaved repeated runs
+    
+0.2.1 - 2020-12-12 - cg
+    Benchmark per sample and batch euclidean magnitude with the same work
+    
+0.2.0 - 2020-11-10 - cg
+    Import NumPy on first use
+    
+0.1.0 - 2020-11-04 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.3.0'
+__status__ = "beta"
+
+import sys
+import math
+
+from array import array
+from operator import mul
+
+from .chgrcodebase import *
+from .cissAggregate import CissWindow
+
+numpy = AppUtil.lazy_import('numpy')
+
+# Published names of the derived channels
+CISS_DERIVED_NAMES = ['pitch', 'roll', 'rms_x', 'rms_y', 'rms_z']
+
+class CissDerivedStage(object):
+    _has_numpy_mod = AppModuleAvailable('numpy')
+    __slots__ = ('batch_size', 'derived', 'use_numpy', 'pitch', 'roll', 
+                 '_buf', '_limit', '_rms_count', '_rms_sumsq')
+
+    def __init__(self, batch_size=256, derived=False, use_numpy=True):
+        self.batch_size = batch_size
+        self.derived = derived
+        self.use_numpy = use_numpy and self._has_numpy_mod
+        self.pitch = 0.0
+        self.roll = 0.0
+        # x, y, z, timestamp of each sample
+        self._buf = array('d')
+        self._limit = 4 * batch_size
+        self._rms_count = 0
+        self._rms_sumsq = [0.0, 0.0, 0.0]
+        return
+
+    def add(self, x, y, z, timestamp):
+        '''
+        Returns True if the batch is full and shall be flushed
+        '''
+        buf = self._buf
+        buf.extend((x, y, z, timestamp))
+        return len(buf) >= self._limit
+
+    def flush(self):
+        '''
+        Returns (CissWindow summary, magnitudes, timestamps) of the buffered
+        samples or None if empty
+        '''
+        buf = self._buf
+        if not buf:
+            return None
+        self._buf = array('d')
+        ts = buf[3::4]
+        if self.use_numpy:
+            return self._flush_numpy(buf, ts)
+        return self._flush_array(buf[0::4], buf[1::4], buf[2::4], ts)
+
+    def _flush_numpy(self, buf, ts):
+        xyz = numpy.frombuffer(buf).reshape(-1, 4)
+        x = xyz[:, 0]
+        y = xyz[:, 1]
+        z = xyz[:, 2]
+        sq = x*x + y*y + z*z
+        mag = numpy.sqrt(sq)
+        summary = CissWindow(ts[0], ts[-1], len(ts), float(mag.min()), float(mag.max()),
+                             float(mag.sum()), float(sq.sum()))
+        if self.derived:
+            sumsq = (float(numpy.dot(x, x)), float(numpy.dot(y, y)), float(numpy.dot(z, z)))
+            self._update_derived(float(x.sum()), float(y.sum()), float(z.sum()), sumsq, len(ts))
+        return summary, mag, ts
+
+    def _flush_array(self, xs, ys, zs, ts):
+        sqrt = math.sqrt
+        sq = array('d', [x*x + y*y + z*z for x, y, z in zip(xs, ys, zs)])
+        mag = array('d', map(sqrt, sq))
+        summary = CissWindow(ts[0], ts[-1], len(ts), min(mag), max(mag), sum(mag), sum(sq))
+        if self.derived:
+            sumsq = (sum(map(mul, xs, xs)), sum(map(mul, ys, ys)), sum(map(mul, zs, zs)))
+            self._update_derived(sum(xs), sum(ys), sum(zs), sumsq, len(ts))
+        return summary, mag, ts
+
+    def _update_derived(self, sum_x, sum_y, sum_z, sumsq, count):
+        # tilt of the mean vector of the batch
+        self.pitch = math.degrees(math.atan2(sum_x, math.sqrt(sum_y*sum_y + sum_z*sum_z)))
+        self.roll = math.degrees(math.atan2(sum_y, sum_z))
+        self._rms_count += count
+        self._rms_sumsq[0] += sumsq[0]
+        self._rms_sumsq[1] += sumsq[1]
+        self._rms_sumsq[2] += sumsq[2]
+        return True
+
+    def pop_rms(self):
+        '''
+        Returns the per axis RMS since the last call
+        '''
+        if not self._rms_count:
+            return None
+        rms = [math.sqrt(sumsq / self._rms_count) for sumsq in self._rms_sumsq]
+        self._rms_count = 0
+        self._rms_sumsq = [0.0, 0.0, 0.0]
+        return rms
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-n", dest="count", metavar="Samples", type=int, default=100000, help="Number of samples!")
+    parser.add_argument("-b", dest="batch_size", metavar="Batch Size", type=int, default=256, help="Batch size!")
+    parser.add_argument("-r", dest="repeat", metavar="Repeat", type=int, default=5, help="Runs, the best is taken!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Benchmark the per sample euclidean magnitude against the batch stage, both
+into a statistics window, and the batch stage with the derived channels,
+python -m lib.cissDerived
+'''
+def main(assigned_args = None):
+    # type: (List)
+    from .cissUsbSensor import CissSensor, CissXyzSensor
+    cargs = main_argparse(assigned_args)
+    samples = [{'Accl_x': (ix*7) % 2000 - 1000, 'Accl_y': (ix*13) % 2000 - 1000, 'Accl_z': 1000,
+                'timestamp': ix * 0.0005} for ix in range(cargs.count)]
+
+    def run_scalar():
+        sqrt = math.sqrt
+        sensor = CissSensor(None, 'Accl', window_stats=True)
+        for data in samples:
+            x, y, z = data['Accl_x'], data['Accl_y'], data['Accl_z']
+            sensor.update_value(sqrt(x*x + y*y + z*z), data['timestamp'])
+
+    def run_batch(derived, use_numpy):
+        sensor = CissSensor(None, 'Accl', window_stats=True)
+        stage = CissDerivedStage(cargs.batch_size, derived, use_numpy)
+        for data in samples:
+            if stage.add(data['Accl_x'], data['Accl_y'], data['Accl_z'], data['timestamp']):
+                sensor.update_batch(*stage.flush())
+
+    runs = [('per sample euclidean           ', run_scalar)]
+    for derived in (False, True):
+        for use_numpy in (False, True):
+            if use_numpy and not CissDerivedStage._has_numpy_mod:
+                continue
+            runs.append(('batch euclidean %s%s'% ('numpy' if use_numpy else 'array', 
+                         ' + derived' if derived else '          '), 
+                         (lambda derived=derived, use_numpy=use_numpy: run_batch(derived, use_numpy))))
+    # the runs are interleaved, the best of each is taken
+    best = [None] * len(runs)
+    for ix in range(max(cargs.repeat, 1)):
+        for jx, (name, run) in enumerate(runs):
+            t = AppTimer()
+            t.start()
+            run()
+            elapsed = t.stop()
+            if best[jx] is None or elapsed < best[jx]:
+                best[jx] = elapsed
+    for jx, (name, run) in enumerate(runs):
+        print('%s: %.3f us per sample'% (name, best[jx] * 1000 / cargs.count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS device hotplug watcher
+
+Watches serial device nodes (e.g. /dev/ttyACM0, /dev/serial/by-id/...)
+through Linux inotify and notifies registered callbacks when a device
+appears or disappears. A device directory which does not exist (yet),
+e.g. /dev/serial/by-id without any USB serial device, is watched through
+its nearest existing parent until it is created. Falls back to a slow
+existence poll if inotify is not available on the platform.
+'''
+
+'''
+Change log
+0.1.1 - 2020-12-14 - cg
+    Watch missing and removed device directories through their parent
+    
+0.1.0 - 2020-10-20 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.1'
+__status__ = "beta"
+
+import os
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+from .chgrcodebase import *
+
+
+# inotify event masks (linux/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+
+IN_DEVICE_ADDED = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+IN_DEVICE_REMOVED = IN_DELETE | IN_MOVED_FROM
+IN_WATCH_MASK = IN_DEVICE_ADDED | IN_DEVICE_REMOVED | IN_DELETE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class CissDeviceWatcher(AppBase):
+    _libc = _load_inotify()
+
+    def __init__(self, id='cissDevWatch', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self._poll_interval = kwargs.get('poll_interval', 1.0)
+        self._use_inotify = kwargs.get('use_inotify', True) and self._libc is not None
+        self._devices = {}
+        self._present = {}
+        self._watch_dirs = {}
+        self._fd = None
+        self._thread = None
+        self._stop = False
+        self._lock = threading.Lock()
+        return
+
+    def add_device(self, path, callback):
+        '''
+        Register callback(path, present) for the device node path.
+        '''
+        path = os.path.abspath(path)
+        with self._lock:
+            self._devices.setdefault(path, []).append(callback)
+            self._present[path] = os.path.exists(path)
+        if self._fd is not None:
+            self._watch_device_dir(path)
+        self.log_info('Watching device %s (present %s)', path, self._present[path])
+        return True
+
+    def is_present(self, path):
+        return self._present.get(os.path.abspath(path), False)
+
+    def start(self):
+        if self.is_alive():
+            return True
+        self._stop = False
+        if self._use_inotify:
+            self._fd = self._libc.inotify_init()
+            if self._fd < 0:
+                self.log_error('inotify_init failed (errno %d)! Fallback to polling', ctypes.get_errno())
+                self._fd = None
+                self._use_inotify = False
+        if self._fd is not None:
+            for path in list(self._devices.keys()):
+                self._watch_device_dir(path)
+            target = self._run_inotify
+        else:
+            target = self._run_poll
+        self._thread = threading.Thread(name=self.get_base_id(), target=target)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join(self._poll_interval + 1)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._watch_dirs = {}
+        return True
+
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return False
+
+    def _add_watch(self, watch_dir):
+        if watch_dir in self._watch_dirs.values():
+            return True
+        wd = self._libc.inotify_add_watch(self._fd, watch_dir.encode('utf-8'), IN_WATCH_MASK)
+        if wd < 0:
+            self.log_error('Failed to watch %s (errno %d)', watch_dir, ctypes.get_errno())
+            return False
+        self._watch_dirs[wd] = watch_dir
+        self.log_debug('inotify watch %d on %s', wd, watch_dir)
+        return True
+
+    def _watch_device_dir(self, path):
+        '''
+        Watch the directory of a device, the nearest existing parent
+        directory while it does not exist. Returns True if the device
+        directory itself is watched
+        '''
+        device_dir = os.path.dirname(path)
+        watch_dir = device_dir
+        while not os.path.isdir(watch_dir) and os.path.dirname(watch_dir) != watch_dir:
+            watch_dir = os.path.dirname(watch_dir)
+        return self._add_watch(watch_dir) and watch_dir == device_dir
+
+    def _check_watches(self):
+        '''
+        Watch the device directories created since the last check, the
+        devices of a new watch are updated (created before the watch)
+        '''
+        watched = set(self._watch_dirs.values())
+        for path in list(self._devices.keys()):
+            if os.path.dirname(path) in watched:
+                continue
+            if self._watch_device_dir(path):
+                self._update(path)
+        return True
+
+    def _run_inotify(self):
+        self.log_info('Device watcher started (inotify)!')
+        while not self._stop:
+            try:
+                ready, _, _ = select.select([self._fd], [], [], self._poll_interval)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            buf = os.read(self._fd, 4096)
+            self._process_events(buf)
+        self.log_info('Device watcher stopped!')
+        return True
+
+    def _process_events(self, buf):
+        changed = set()
+        device_dirs = set(os.path.dirname(path) for path in self._devices.keys())
+        # device directories watched through a parent
+        pending = device_dirs - set(self._watch_dirs.values())
+        check = False
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset+length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & IN_IGNORED:
+                # directory removed, watched again through its parent
+                watch_dir = self._watch_dirs.pop(wd, None)
+                if watch_dir in device_dirs:
+                    changed.update(path for path in self._devices.keys() if os.path.dirname(path) == watch_dir)
+                check = True
+                continue
+            watch_dir = self._watch_dirs.get(wd, None)
+            if watch_dir is None or not name:
+                continue
+            path = os.path.join(watch_dir, name)
+            if path in self._devices:
+                changed.add(path)
+            elif pending or watch_dir not in device_dirs:
+                check = True
+        for path in changed:
+            self._update(path)
+        if check:
+            self._check_watches()
+        return True
+
+    def _run_poll(self):
+        self.log_info('Device watcher started (polling %s s)!', self._poll_interval)
+        while not self._stop:
+            for path in list(self._devices.keys()):
+                self._update(path)
+            time.sleep(self._poll_interval)
+        self.log_info('Device watcher stopped!')
+        return True
+
+    def _update(self, path):
+        present = os.path.exists(path)
+        with self._lock:
+            if self._present.get(path, None) == present:
+                return False
+            self._present[path] = present
+            callbacks = list(self._devices.get(path, []))
+        self.log_info('Device %s %s', path, 'added' if present else 'removed')
+        for callback in callbacks:
+            try:
+                callback(path, present)
+            except Exception:
+                self.log_exception('Device %s callback failed!', path)
+        return True
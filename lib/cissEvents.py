@@ -0,0 +1,395 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS event detection pipeline
+
+Decodes CISS event detection frames (0x7A) through a lookup table into
+compact event records and dispatches them from a non-blocking queue to
+registered handlers (ThingsPro tags, event log, ...).
+Software threshold events are evaluated on streamed samples by 
+CissEventEngine and use the same records.
+CissAnomalyDetector flags streamed samples deviating from an EWMA 
+baseline (z-score or CUSUM).
+'''
+
+'''
+Change log
+0.3.3 - 2020-12-30 - cg
+    Event log flushed with each batch of events
+    
+0.3.2 - 2020-12-12 - cg
+    Quiet range check of the event engine, batch update of the anomaly detector
+    
+0.3.1 - 2020-11-10 - cg
+    Import csv on first use
+    
+0.3.0 - 2020-11-06 - cg
+    Add streaming anomaly detector
+    
+0.2.0 - 2020-10-26 - cg
+    Add software event engine
+    
+0.1.0 - 2020-10-24 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.3.3'
+__status__ = "beta"
+
+import os
+import math
+import threading
+
+from collections import namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .chgrcodebase import *
+
+csv = AppUtil.lazy_import('csv')
+
+
+class CissEventKind(IntEnum):
+    NONE = 0
+    OVERSHOOT = 1
+    RATE_OF_CHANGE = 2
+    UNDERSHOOT = 3
+
+
+# timestamp (s), node id, sensor index (SnIx value), CissEventKind value
+CissEvent = namedtuple('CissEvent', ['timestamp', 'node', 'sensor', 'kind'])
+
+# Sensor order of the 2 bit event fields, byte 0 and byte 1 (LSB first)
+_EVENT_SENSORS = (
+    ('Accl', 'Gyro', 'Magn', 'Temp'),
+    ('Humi', 'Pres', 'Ligh', 'Nois')
+    )
+
+
+def _build_event_table(sensors):
+    table = []
+    for byte in range(256):
+        events = []
+        for ix, sensor in enumerate(sensors):
+            kind = (byte >> (ix*2)) & 0x03
+            if kind == CissEventKind.OVERSHOOT or kind == CissEventKind.UNDERSHOOT:
+                events.append((sensor, int(kind)))
+        table.append(tuple(events))
+    return tuple(table)
+
+# Precomputed (sensor, kind) tuples for every value of event byte 0 and 1
+EVENT_TABLE = (_build_event_table(_EVENT_SENSORS[0]), _build_event_table(_EVENT_SENSORS[1]))
+
+
+def decode_event_frame(node, data, timestamp):
+    '''
+    Decode the 2 byte event bitfield into a list of CissEvent records
+    '''
+    return [CissEvent(timestamp, node, sensor, kind)
+            for sensor, kind in EVENT_TABLE[0][data[0]] + EVENT_TABLE[1][data[1]]]
+
+
+# plain int event kinds for the per sample path
+_EV_NONE = CissEventKind.NONE.value
+_EV_OVERSHOOT = CissEventKind.OVERSHOOT.value
+_EV_RATE = CissEventKind.RATE_OF_CHANGE.value
+_EV_UNDERSHOOT = CissEventKind.UNDERSHOOT.value
+
+
+class CissEventEngine(object):
+    '''
+    Software threshold event detection for one sensor channel.
+    high/low: thresholds (None disables), hysteresis: distance a value has 
+    to move back inside a threshold to clear the event, rate: max absolute
+    change per second (None disables).
+    '''
+    def __init__(self, high=None, low=None, hysteresis=0, rate=None):
+        self.high = high
+        self.low = low
+        self.hysteresis = abs(hysteresis)
+        self.rate = rate
+        self.state = _EV_NONE
+        # precalculated levels, value outside [_low, _high] changes the state
+        self._high = float('inf') if high is None else high
+        self._low = float('-inf') if low is None else low
+        self._high_clear = self._high - self.hysteresis
+        self._low_clear = self._low + self.hysteresis
+        self._rate_active = False
+        self._last_value = None
+        self._last_timestamp = None
+        return
+    
+    def get_config(self):
+        return (self.high, self.low, self.hysteresis, self.rate)
+    
+    def is_quiet(self, vmin, vmax):
+        '''
+        True if no value between vmin and vmax changes the state, a batch
+        of values in this range needs no update
+        '''
+        if self.rate is not None:
+            return False
+        if self.state == _EV_NONE:
+            return vmin >= self._low and vmax <= self._high
+        elif self.state == _EV_OVERSHOOT:
+            return vmin >= self._high_clear
+        return vmax <= self._low_clear
+    
+    def update(self, value, timestamp):
+        '''
+        Returns the new CissEventKind value on an event, otherwise None
+        '''
+        event = None
+        if self.state == _EV_NONE:
+            if value > self._high:
+                event = self.state = _EV_OVERSHOOT
+            elif value < self._low:
+                event = self.state = _EV_UNDERSHOOT
+        elif self.state == _EV_OVERSHOOT:
+            if value < self._high_clear:
+                event = self.state = _EV_NONE
+        elif value > self._low_clear:
+            event = self.state = _EV_NONE
+            
+        if self.rate is not None:
+            if self._last_timestamp is not None and timestamp > self._last_timestamp:
+                active = abs(value - self._last_value) > self.rate * (timestamp - self._last_timestamp)
+                if active and not self._rate_active and event is None:
+                    event = _EV_RATE
+                self._rate_active = active
+            self._last_value = value
+            self._last_timestamp = timestamp
+        return event
+
+
+class CissAnomalyDetector(object):
+    '''
+    Streaming anomaly detection for one sensor channel, O(1) per sample.
+    The baseline is an exponentially weighted mean and variance (alpha).
+    method 'zscore': score is the absolute z-score of the sample.
+    method 'cusum': score is the two sided CUSUM of the z-score with 
+    allowed drift per sample, the sums restart after each alarm.
+    Score above threshold sets the anomalous state, which is cleared 
+    after hold seconds without score above threshold. No scores during
+    the first warmup samples, min_std limits the z-score of flat signals.
+    '''
+    _methods = ('zscore', 'cusum')
+    
+    def __init__(self, method='zscore', alpha=0.01, threshold=None, drift=1.0, 
+                 warmup=None, hold=10.0, min_std=1.0):
+        if method not in self._methods:
+            raise ValueError('Anomaly method %s unknown'% method)
+        if alpha <= 0 or alpha >= 1:
+            raise ValueError('Anomaly alpha %s out of range (0, 1)'% alpha)
+        self.method = method
+        self.alpha = alpha
+        if threshold is None:
+            threshold = 5.0 if method == 'zscore' else 10.0
+        self.threshold = threshold
+        self.drift = drift
+        self.warmup = int(1 / alpha) if warmup is None else warmup
+        self.hold = hold
+        self.min_std = min_std
+        self.state = 0
+        self.score = 0.0
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self._cusum = method == 'cusum'
+        self._pos = 0.0
+        self._neg = 0.0
+        self._peak = 0.0
+        self._min_var = min_std * min_std
+        self._last_anomaly = None
+        return
+    
+    def get_config(self):
+        return (self.method, self.alpha, self.threshold, self.drift, self.warmup, self.hold, self.min_std)
+    
+    def update(self, value, timestamp):
+        '''
+        Returns the new state (1 anomalous, 0 normal) on a change, otherwise None
+        '''
+        self.count += 1
+        if self.count == 1:
+            self.mean = float(value)
+            return None
+        diff = value - self.mean
+        var = self.var
+        z = diff / math.sqrt(var if var > self._min_var else self._min_var)
+        incr = self.alpha * diff
+        self.mean += incr
+        self.var = (1 - self.alpha) * (var + diff * incr)
+        if self.count <= self.warmup:
+            return None
+        
+        if self._cusum:
+            self._pos = max(0.0, self._pos + z - self.drift)
+            self._neg = max(0.0, self._neg - z - self.drift)
+            score = self._pos if self._pos > self._neg else self._neg
+        else:
+            score = abs(z)
+        self.score = score
+        if score > self._peak:
+            self._peak = score
+        if score > self.threshold:
+            self._last_anomaly = timestamp
+            if self._cusum:
+                self._pos = self._neg = 0.0
+            if not self.state:
+                self.state = 1
+                return 1
+        elif self.state and timestamp - self._last_anomaly >= self.hold:
+            self.state = 0
+            return 0
+        return None
+    
+    def update_batch(self, values, timestamps):
+        '''
+        update() of each value, the baseline depends on the previous value.
+        Returns the list of (state, timestamp) changes
+        '''
+        changes = []
+        update = self.update
+        for ix in range(len(values)):
+            state = update(values[ix], timestamps[ix])
+            if state is not None:
+                changes.append((state, timestamps[ix]))
+        return changes
+    
+    def pop_score(self):
+        '''
+        Returns the peak score since the last call
+        '''
+        peak = self._peak
+        self._peak = 0.0
+        return peak
+
+
+class CissEventDispatcher(AppBase):
+
+    def __init__(self, id='cissEvents', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self._queue = queue.Queue(kwargs.get('max_queue_size', 1000))
+        self._max_batch_size = kwargs.get('max_batch_size', 100)
+        self._wait_timeout = kwargs.get('wait_timeout', 1.0)
+        self._handlers = []
+        self._thread = None
+        self._stop = False
+        self.events_dropped = 0
+        self.events_dispatched = 0
+        return
+
+    def add_handler(self, handler):
+        '''
+        Add handler(events), called from the dispatcher thread with a list of CissEvent
+        '''
+        self._handlers.append(handler)
+        return True
+
+    def put_events(self, events):
+        '''
+        Non-blocking, called from the serial read threads
+        '''
+        for event in events:
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.events_dropped += 1
+        return True
+
+    def get_queue_size(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self.is_alive():
+            return True
+        self._stop = False
+        self._thread = threading.Thread(name=self.get_base_id(), target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join(self._wait_timeout + 1)
+        self.dispatch(self.get_batch(0))
+        return True
+
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return False
+
+    def get_batch(self, timeout):
+        events = []
+        try:
+            if timeout:
+                events.append(self._queue.get(True, timeout))
+            while len(events) < self._max_batch_size:
+                events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def dispatch(self, events):
+        if not events:
+            return False
+        for handler in self._handlers:
+            try:
+                handler(events)
+            except Exception:
+                self.log_exception('Event handler failed!')
+        self.events_dispatched += len(events)
+        return True
+
+    def run(self):
+        self.log_info('Event dispatcher started!')
+        while not self._stop:
+            self.dispatch(self.get_batch(self._wait_timeout))
+        self.log_info('Event dispatcher stopped! dispatched %d, dropped %d',
+                      self.events_dispatched, self.events_dropped)
+        return True
+
+
+class CissEventLog(AppBase):
+
+    def __init__(self, file_name, id='cissEventLog', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self._file_name = file_name
+        self._file = None
+        self._writer = None
+        return
+
+    def open(self):
+        new_file = not os.path.exists(self._file_name) or os.path.getsize(self._file_name) == 0
+        self._file = open(self._file_name, 'a')
+        self._writer = csv.writer(self._file, dialect='excel')
+        if new_file:
+            self._writer.writerow([" id ", " timestamp ", "Event"])
+        self.log_info('Event log %s opened', self._file_name)
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return True
+
+    def write_events(self, events):
+        '''
+        Write a batch of the dispatcher, flushed at once, events are rare
+        and the log shall not lag behind
+        '''
+        if self._file is None:
+            self.open()
+        self._writer.writerows([(event.node, int(event.timestamp*1000),
+                                 '%s : %s'% (event.sensor, CissEventKind(event.kind).name.lower()))
+                                for event in events])
+        self._file.flush()
+        return True
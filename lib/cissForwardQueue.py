@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS store and forward queue
+
+Bounded append-only queue of publish batches on disk. Each batch is one
+JSON line in a segment file, the segments are rotated at segment_size
+and the oldest segments are dropped above max_size. Appends go through
+a file buffer and are fsynced together at most every fsync_interval
+seconds, the read position is saved with the same sync. Batches are
+delivered at least once, after a crash the batches since the last sync
+can be delivered again.
+'''
+
+'''
+Change log
+0.1.0 - 2020-11-16 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import os
+import sys
+import json
+
+from .chgrcodebase import *
+
+_SEGMENT_EXT = '.q'
+_CURSOR_FILE = 'cursor'
+
+
+class CissForwardQueue(AppBase):
+
+    def __init__(self, path, id='forwardQueue', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.path = path
+        self.max_size = int(kwargs.get('max_size', 16*1024*1024))
+        self.segment_size = int(kwargs.get('segment_size', 1024*1024))
+        self.fsync_interval = float(kwargs.get('fsync_interval', 5.0))
+        self.buffer_size = int(kwargs.get('buffer_size', 64*1024))
+        self.batches_put = 0
+        self.batches_dropped = 0
+        self.bytes_dropped = 0
+        self.fsyncs = 0
+        self._segments = []
+        self._sizes = {}
+        self._writer = None
+        self._write_seq = 0
+        self._reader = None
+        self._read_seq = None
+        self._read_offset = 0
+        self._cursor_dirty = False
+        self._unsynced = False
+        self._last_sync = AppUtil.monotonic()
+        self.open()
+        return
+
+    def _segment_file(self, seq):
+        return os.path.join(self.path, '%08d%s'% (seq, _SEGMENT_EXT))
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in os.listdir(self.path):
+            if name.endswith(_SEGMENT_EXT):
+                seq = int(name[:-len(_SEGMENT_EXT)])
+                self._segments.append(seq)
+                self._sizes[seq] = os.path.getsize(self._segment_file(seq))
+        self._segments.sort()
+        self._read_cursor()
+        # a new segment per start, the last one may end with a partly written batch
+        self._new_segment()
+        self.log_info('Forward queue %s opened, %d bytes pending', self.path, self.pending())
+        return True
+
+    def close(self):
+        self.sync(True)
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        return True
+
+    def _read_cursor(self):
+        self._read_seq = self._segments[0] if self._segments else None
+        self._read_offset = 0
+        try:
+            with open(os.path.join(self.path, _CURSOR_FILE)) as f:
+                seq, offset = [int(value) for value in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return False
+        if seq in self._sizes:
+            self._read_seq = seq
+            self._read_offset = min(offset, self._sizes[seq])
+            # segments before the cursor are already forwarded
+            for old in [old for old in self._segments if old < seq]:
+                self._remove_segment(old)
+        return True
+
+    def _write_cursor(self):
+        if self._read_seq is None:
+            return False
+        file_name = os.path.join(self.path, _CURSOR_FILE)
+        with open(file_name + '.tmp', 'w') as f:
+            f.write('%d %d\n'% (self._read_seq, self._read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(file_name + '.tmp', file_name)
+        self._cursor_dirty = False
+        return True
+
+    def _new_segment(self):
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+        self._write_seq = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(self._write_seq)
+        self._sizes[self._write_seq] = 0
+        self._writer = open(self._segment_file(self._write_seq), 'ab', self.buffer_size)
+        if self._read_seq is None:
+            self._read_seq = self._write_seq
+            self._read_offset = 0
+        return True
+
+    def _remove_segment(self, seq):
+        try:
+            os.remove(self._segment_file(seq))
+        except OSError:
+            pass
+        self._segments.remove(seq)
+        del self._sizes[seq]
+        return True
+
+    def _next_read_segment(self):
+        '''
+        Continue with the next segment, the finished one is removed
+        '''
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._remove_segment(self._read_seq)
+        self._read_seq = self._segments[0]
+        self._read_offset = 0
+        self._cursor_dirty = True
+        return True
+
+    def pending(self):
+        '''
+        Bytes of batches not forwarded yet
+        '''
+        return sum(self._sizes.values()) - self._read_offset
+
+    def is_empty(self):
+        return self.pending() <= 0
+
+    def put(self, batch):
+        '''
+        Append a batch (JSON serialisable), synced with the next sync()
+        '''
+        line = (json.dumps(batch, separators=(',', ':')) + '\n').encode('utf-8')
+        if self._sizes[self._write_seq] and self._sizes[self._write_seq] + len(line) > self.segment_size:
+            self._new_segment()
+        self._writer.write(line)
+        self._sizes[self._write_seq] += len(line)
+        self._unsynced = True
+        self.batches_put += 1
+        while self.pending() > self.max_size and self._read_seq != self._write_seq:
+            self.bytes_dropped += self._sizes[self._read_seq] - self._read_offset
+            self.log_warning('Forward queue full, oldest segment %d dropped', self._read_seq)
+            self._next_read_segment()
+        self.sync()
+        return True
+
+    def get(self, count=1):
+        '''
+        Returns up to count batches from the read position, commit(batches)
+        removes them from the queue
+        '''
+        batches = []
+        offset = self._read_offset
+        seq = self._read_seq
+        if seq == self._write_seq:
+            self._writer.flush()
+        while len(batches) < count:
+            if offset >= self._sizes[seq]:
+                if batches or seq == self._write_seq:
+                    break
+                # nothing left in this segment
+                self._next_read_segment()
+                seq = self._read_seq
+                offset = 0
+                if seq == self._write_seq:
+                    self._writer.flush()
+                continue
+            if self._reader is None:
+                self._reader = open(self._segment_file(seq), 'rb')
+            self._reader.seek(offset)
+            line = self._reader.readline()
+            if not line.endswith(b'\n'):
+                # partly written batch before a crash
+                offset = self._sizes[seq]
+                continue
+            offset += len(line)
+            try:
+                batches.append((offset, json.loads(line.decode('utf-8'))))
+            except ValueError:
+                self.batches_dropped += 1
+                self.log_warning('Forward queue invalid batch in segment %d dropped', seq)
+        if not batches and offset != self._read_offset:
+            self._read_offset = offset
+            self._cursor_dirty = True
+        return batches
+
+    def commit(self, batches):
+        '''
+        Remove the batches returned by get() from the queue
+        '''
+        if not batches:
+            return False
+        self._read_offset = batches[-1][0]
+        self._cursor_dirty = True
+        if self._read_offset >= self._sizes[self._read_seq] and self._read_seq != self._write_seq:
+            self._next_read_segment()
+        return True
+
+    def sync(self, force=False):
+        '''
+        fsync the appended batches and the read position, at most every
+        fsync_interval seconds if not forced
+        '''
+        if not self._unsynced and not self._cursor_dirty:
+            return False
+        now = AppUtil.monotonic()
+        if not force and now - self._last_sync < self.fsync_interval:
+            return False
+        if self._unsynced:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._unsynced = False
+        if self._cursor_dirty:
+            self._write_cursor()
+        self._last_sync = now
+        self.fsyncs += 1
+        return True
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-d", dest="path", metavar="Directory", default='/tmp/ciss_forward_queue', help="Queue directory!")
+    parser.add_argument("-n", dest="count", metavar="Batches", type=int, default=2000, help="Number of batches!")
+    parser.add_argument("-t", dest="tags", metavar="Tags", type=int, default=40, help="Tags per batch!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Benchmark coalesced against per batch fsync, python -m lib.cissForwardQueue
+'''
+def main(assigned_args = None):
+    # type: (List)
+    import shutil
+    import time
+    cargs = main_argparse(assigned_args)
+    batch = [['CissACM0-ACCL-%d'% ix, 1000 + ix, 'mg', 1605000000.0 + ix] for ix in range(cargs.tags)]
+    for fsync_interval in (0, 5.0):
+        shutil.rmtree(cargs.path, True)
+        fq = CissForwardQueue(cargs.path, fsync_interval=fsync_interval)
+        t = AppTimer()
+        t.start()
+        for ix in range(cargs.count):
+            fq.put(batch)
+        elapsed = t.stop()
+        fq.sync(True)
+        print('fsync interval %.1f s: %d batches, %d bytes in %.1f ms, %d fsyncs'%
+              (fsync_interval, cargs.count, fq.pending(), elapsed, fq.fsyncs))
+        t = AppTimer()
+        t.start()
+        count = 0
+        while True:
+            batches = fq.get(100)
+            if not batches:
+                break
+            count += len(batches)
+            fq.commit(batches)
+        elapsed = t.stop()
+        fq.close()
+        print('drained %d batches in %.1f ms'% (count, elapsed))
+    shutil.rmtree(cargs.path, True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
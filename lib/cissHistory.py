@@ -0,0 +1,605 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS history query
+
+Read back the archive of lib/cissArchive.py (or the SQLite history sink)
+as N points of a sensor channel of a node in a time range. A sparse time
+index, one entry per chunk, is kept next to each archive file (.idx) and
+updated when the file grows, so a query only reads the chunks of the range.
+The buckets (time, min, max, mean, count) are streamed in time order,
+chunk by chunk, without loading the range into memory.
+'''
+
+'''
+Change log
+0.1.1 - 2021-01-03 - cg
+    Only index files of the archive files removed
+    
+0.1.0 - 2020-11-30 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.1'
+__status__ = "beta"
+
+import os
+import sys
+import json
+import glob
+import heapq
+import bisect
+
+from array import array
+
+from .chgrcodebase import *
+from .cissArchive import (CISS_ARCHIVE_CHANNELS, CissArchive, CissArchiveChunk, CissArchiveReader, archive_files,
+                          chunk_header, synthetic_rows)
+
+sqlite3 = AppUtil.lazy_import('sqlite3')
+
+_INDEX_VERSION = 1
+# column name and array type code of the index, one entry per chunk
+_INDEX_COLUMNS = (('t0', 'd'), ('t1', 'd'), ('offset', 'd'), ('length', 'I'), ('count', 'I'),
+                  ('crc', 'I'), ('vmin', 'i'), ('vmax', 'i'), ('flags', 'B'))
+
+
+class CissHistoryIndex(AppBase):
+    '''
+    Chunk index of one archive file, per (node, channel) columns sorted by
+    first timestamp. Stored in file_name.idx with the scanned size, a grown
+    file is scanned from there, a replaced file (rotation) from the start.
+    '''
+    def __init__(self, file_name, id='cissHistoryIndex', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.file_name = file_name
+        self.index_name = file_name + '.idx'
+        self.write_index = bool(kwargs.get('write_index', True))
+        self.size = 0
+        self.inode = None
+        # (node, channel) -> dict of columns, or (position, count) until loaded
+        self._keys = {}
+        self._t1max = {}
+        self._data_pos = 0
+        return
+
+    def keys(self):
+        return list(self._keys.keys())
+
+    def load(self):
+        '''
+        Read the header of the index file, the columns are read per key on
+        first use
+        '''
+        try:
+            with open(self.index_name, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                self._data_pos = f.tell()
+        except (IOError, OSError, ValueError):
+            return False
+        if header.get('version', None) != _INDEX_VERSION or header.get('byteorder', None) != sys.byteorder:
+            return False
+        self.size = header['size']
+        self.inode = header['inode']
+        self._keys = dict(((node, channel), (pos, count)) for node, channel, pos, count in header['keys'])
+        self._t1max = {}
+        return True
+
+    def columns(self, key):
+        '''
+        Columns of a key, t1max is the running maximum of t1 for the start
+        of a range
+        '''
+        columns = self._keys.get(key, None)
+        if columns is None:
+            return None
+        if isinstance(columns, tuple):
+            pos, count = columns
+            columns = {}
+            with open(self.index_name, 'rb') as f:
+                f.seek(self._data_pos + pos)
+                for name, typecode in _INDEX_COLUMNS:
+                    columns[name] = array(typecode)
+                    columns[name].fromfile(f, count)
+            self._keys[key] = columns
+        if key not in self._t1max:
+            t1max = array('d')
+            last = None
+            for t1 in columns['t1']:
+                last = t1 if last is None or t1 > last else last
+                t1max.append(last)
+            self._t1max[key] = t1max
+        return columns
+
+    def update(self):
+        '''
+        Scan the new chunks of the archive file, returns True if the index
+        has changed
+        '''
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return False
+        if not self.size and self.inode is None:
+            self.load()
+        if self.inode != stat.st_ino or stat.st_size < self.size:
+            self.size = 0
+            self.inode = stat.st_ino
+            self._keys = {}
+            self._t1max = {}
+        if stat.st_size == self.size:
+            return False
+        for key in list(self._keys.keys()):
+            self.columns(key)
+        new_keys = {}
+        end = self.size
+        for chunk in CissArchiveReader(self.file_name, logger=self.get_logger()).chunks(offset=self.size):
+            key = (chunk.node, chunk.channel)
+            columns = self._keys.get(key, None)
+            if columns is None:
+                columns = self._keys[key] = dict((name, array(typecode)) for name, typecode in _INDEX_COLUMNS)
+            for name, typecode in _INDEX_COLUMNS:
+                columns[name].append(getattr(chunk, name))
+            new_keys[key] = True
+            end = chunk.offset + chunk.length
+        if end == self.size:
+            return False
+        self.size = end
+        for key in new_keys:
+            self._sort(key)
+            self._t1max.pop(key, None)
+        if self.write_index:
+            try:
+                self.save()
+            except (IOError, OSError):
+                self.log_warning('History index %s not written!', self.index_name)
+        return True
+
+    def _sort(self, key):
+        columns = self._keys[key]
+        t0 = columns['t0']
+        if all(t0[ix] <= t0[ix + 1] for ix in range(len(t0) - 1)):
+            return False
+        order = sorted(range(len(t0)), key=t0.__getitem__)
+        for name, typecode in _INDEX_COLUMNS:
+            columns[name] = array(typecode, [columns[name][ix] for ix in order])
+        return True
+
+    def save(self):
+        keys = []
+        pos = 0
+        for key in sorted(self._keys.keys()):
+            count = len(self._keys[key]['t0'])
+            keys.append([key[0], key[1], pos, count])
+            pos += sum(array(typecode).itemsize * count for name, typecode in _INDEX_COLUMNS)
+        header = {'version': _INDEX_VERSION, 'byteorder': sys.byteorder, 'size': self.size,
+                  'inode': self.inode, 'keys': keys}
+        temp_name = self.index_name + '.tmp'
+        with open(temp_name, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for key in sorted(self._keys.keys()):
+                for name, typecode in _INDEX_COLUMNS:
+                    self._keys[key][name].tofile(f)
+        os.rename(temp_name, self.index_name)
+        self._data_pos = len(json.dumps(header).encode('utf-8')) + 1
+        return True
+
+    def range(self, key):
+        '''
+        First and last timestamp (ms) of a key, None if not in the file
+        '''
+        columns = self.columns(key)
+        if columns is None or not columns['t0']:
+            return None
+        return int(columns['t0'][0]), int(self._t1max[key][-1])
+
+    def find(self, key, start=None, end=None):
+        '''
+        Yields (t0, position) of the chunks of a key with samples between
+        start and end (ms), sorted by t0
+        '''
+        columns = self.columns(key)
+        if columns is None:
+            return
+        first = 0 if start is None else bisect.bisect_left(self._t1max[key], start)
+        last = len(columns['t0']) if end is None else bisect.bisect_right(columns['t0'], end)
+        t0 = columns['t0']
+        for ix in range(first, last):
+            yield int(t0[ix]), ix
+        return
+
+    def chunk(self, key, ix):
+        columns = self._keys[key]
+        return CissArchiveChunk(key[0], key[1], columns['count'][ix], int(columns['t0'][ix]), int(columns['t1'][ix]),
+                                columns['vmin'][ix], columns['vmax'][ix], columns['flags'][ix],
+                                int(columns['offset'][ix]), columns['length'][ix], columns['crc'][ix])
+
+
+def index_files(file_name):
+    '''
+    Index files of the rotated files and the current file of an archive,
+    with or without archive file
+    '''
+    base, ext = os.path.splitext(file_name)
+    return glob.glob('%s-????????-??????*%s.idx'% (base, ext)) + glob.glob(file_name + '.idx')
+
+
+class CissHistory(AppBase):
+    '''
+    Queries over an archive and its rotated files. write_index: keep the
+    index files next to the archive files (otherwise in memory only)
+    '''
+    def __init__(self, file_name, id='cissHistory', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.file_name = file_name
+        self.write_index = bool(kwargs.get('write_index', True))
+        self.chunks_read = 0
+        self.crc_errors = 0
+        self._indexes = {}
+        return
+
+    def refresh(self):
+        '''
+        Index new archive files and new chunks, drop removed files and
+        their index files
+        '''
+        files = archive_files(self.file_name)
+        for file_name in list(self._indexes.keys()):
+            if file_name not in files:
+                del self._indexes[file_name]
+        if self.write_index:
+            for index_name in index_files(self.file_name):
+                if index_name[:-4] not in files:
+                    os.remove(index_name)
+        for file_name in files:
+            index = self._indexes.get(file_name, None)
+            if index is None:
+                index = self._indexes[file_name] = CissHistoryIndex(file_name, write_index=self.write_index,
+                                                                    logger=self.get_logger())
+            index.update()
+        return files
+
+    def keys(self):
+        '''
+        Sorted (node, channel name) of the archive
+        '''
+        keys = set()
+        for index in self._indexes.values():
+            keys.update(index.keys())
+        return sorted((node, CISS_ARCHIVE_CHANNELS[channel][0]) for node, channel in keys)
+
+    def range(self, node, channel):
+        '''
+        First and last timestamp (ms) of node and channel, None if not archived
+        '''
+        key = (node, CissArchiveReader.channel_index(channel))
+        ranges = [r for r in (index.range(key) for index in self._indexes.values()) if r is not None]
+        if not ranges:
+            return None
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def chunks(self, node, channel, start=None, end=None):
+        '''
+        Yields (archive file name, chunk) of node and channel with samples
+        between start and end (ms), sorted by first timestamp over all files
+        '''
+        key = (node, CissArchiveReader.channel_index(channel))
+        sources = []
+        for file_name in sorted(self._indexes.keys()):
+            sources.append(self._find(file_name, key, start, end))
+        for t0, file_name, ix in heapq.merge(*sources):
+            yield file_name, self._indexes[file_name].chunk(key, ix)
+        return
+
+    def _find(self, file_name, key, start, end):
+        for t0, ix in self._indexes[file_name].find(key, start, end):
+            yield t0, file_name, ix
+        return
+
+    def samples(self, node, channel, start=None, end=None):
+        '''
+        Yields (timestamp (ms), value) of node and channel between start and
+        end (ms), in time order of the chunks
+        '''
+        for file_name, chunk, timestamps, values in self._read(node, channel, start, end):
+            scale = float(CISS_ARCHIVE_CHANNELS[chunk.channel][1])
+            for timestamp, value in zip(timestamps, values):
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield timestamp, value / scale if scale != 1 else value
+        return
+
+    def _read(self, node, channel, start, end, skip=None):
+        '''
+        Yields (file name, chunk, timestamps, values), timestamps and values
+        are None for the chunks skip(chunk) returns True for
+        '''
+        readers = {}
+        files = {}
+        try:
+            for file_name, chunk in self.chunks(node, channel, start, end):
+                if skip is not None and skip(chunk):
+                    yield file_name, chunk, None, None
+                    continue
+                if file_name not in files:
+                    readers[file_name] = CissArchiveReader(file_name, logger=self.get_logger())
+                    files[file_name] = open(file_name, 'rb')
+                decoded = readers[file_name].read(chunk, files[file_name])
+                self.chunks_read += 1
+                if decoded is None:
+                    self.crc_errors += 1
+                    continue
+                yield file_name, chunk, decoded[0], decoded[1]
+        finally:
+            for f in files.values():
+                f.close()
+        return
+
+    def query(self, node, channel, start=None, end=None, points=500, mean=True):
+        '''
+        Yields up to points buckets (bucket start (ms), min, max, mean, count)
+        of node and channel between start and end (ms, default the archived
+        range), empty buckets are left out. mean=False: chunks within one
+        bucket are taken from the index without reading them, mean is None.
+        '''
+        self.refresh()
+        channel = CissArchiveReader.channel_index(channel)
+        if start is None or end is None:
+            archived = self.range(node, channel)
+            if archived is None:
+                return
+            start = archived[0] if start is None else start
+            end = archived[1] if end is None else end
+        start = int(start)
+        end = int(end)
+        if end < start:
+            return
+        width = max(1, -(-(end - start + 1) // max(1, int(points))))
+        scale = float(CISS_ARCHIVE_CHANNELS[channel][1])
+
+        def within(chunk):
+            return (not mean and chunk.t0 >= start and chunk.t1 <= end and
+                    (chunk.t0 - start) // width == (chunk.t1 - start) // width)
+
+        # bucket index -> [min, max, sum, count]
+        buckets = {}
+        for file_name, chunk, timestamps, values in self._read(node, channel, start, end, within):
+            # buckets before the first timestamp of the chunk are complete
+            first = (max(chunk.t0, start) - start) // width
+            for ix in sorted(ix for ix in buckets if ix < first):
+                yield self._bucket(start, width, ix, buckets.pop(ix), scale)
+            if timestamps is None:
+                ix = (chunk.t0 - start) // width
+                bucket = buckets.get(ix, None)
+                if bucket is None:
+                    buckets[ix] = [chunk.vmin, chunk.vmax, None, chunk.count]
+                else:
+                    bucket[0] = min(bucket[0], chunk.vmin)
+                    bucket[1] = max(bucket[1], chunk.vmax)
+                    bucket[3] += chunk.count
+                continue
+            bucket = None
+            bucket_ix = None
+            for timestamp, value in zip(timestamps, values):
+                if timestamp < start or timestamp > end:
+                    continue
+                ix = (timestamp - start) // width
+                if ix != bucket_ix:
+                    bucket_ix = ix
+                    bucket = buckets.get(ix, None)
+                    if bucket is None:
+                        bucket = buckets[ix] = [value, value, 0 if mean else None, 0]
+                if value < bucket[0]:
+                    bucket[0] = value
+                elif value > bucket[1]:
+                    bucket[1] = value
+                if bucket[2] is not None:
+                    bucket[2] += value
+                bucket[3] += 1
+        for ix in sorted(buckets.keys()):
+            yield self._bucket(start, width, ix, buckets[ix], scale)
+        return
+
+    @staticmethod
+    def _bucket(start, width, ix, bucket, scale):
+        vmin, vmax, total, count = bucket
+        mean = float(total) / count / scale if total is not None else None
+        if scale != 1:
+            vmin /= scale
+            vmax /= scale
+        return start + ix * width, vmin, vmax, mean, count
+
+
+def sqlite_query(path, name, start, end, points=500):
+    '''
+    Buckets (bucket start (ms), min, max, mean, count) of a tag of the
+    SQLite history sink, aggregated by SQLite over the (sensor, time) index
+    '''
+    db = sqlite3.connect(path)
+    try:
+        row = db.execute('SELECT id FROM sensors WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return []
+        if start is None or end is None:
+            first, last = db.execute('SELECT min(time), max(time) FROM samples WHERE sensor = ?', row).fetchone()
+            if first is None:
+                return []
+            start = first if start is None else start
+            end = last if end is None else end
+        start = int(start)
+        end = int(end)
+        width = max(1, -(-(end - start + 1) // max(1, int(points))))
+        rows = db.execute('SELECT (time - ?) / ?, min(value), max(value), avg(value), count(*) FROM samples '
+                          'WHERE sensor = ? AND time BETWEEN ? AND ? GROUP BY 1 ORDER BY 1',
+                          (start, width, row[0], start, end)).fetchall()
+    finally:
+        db.close()
+    return [(start + ix * width, vmin, vmax, mean, count) for ix, vmin, vmax, mean, count in rows]
+
+
+def parse_time(text):
+    '''
+    Epoch seconds or local YYYY-mm-dd[THH:MM[:SS]] to ms, None for None
+    '''
+    if text is None:
+        return None
+    try:
+        return int(float(text) * 1000)
+    except ValueError:
+        pass
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(text, format)) * 1000)
+        except ValueError:
+            continue
+    raise ValueError('Time %s invalid'% text)
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp / 1000.0)) + '.%03d'% (timestamp % 1000)
+
+
+def generate_archive(file_name, size, nodes=4, compress=True):
+    '''
+    Archive of about size bytes for the benchmark, one chunk per channel of
+    synthetic data is repeated with shifted timestamps for each node.
+    Returns the bytes written and the last timestamp (ms).
+    '''
+    template_name = file_name + '.template'
+    archive = CissArchive(template_name, max_rows=10**7, compress=compress, chunk_samples=1024)
+    for row in synthetic_rows('CissSIM0', 1100, rate=100):
+        archive.write(*row)
+    archive.flush()
+    archive.close()
+    # channel -> (chunk, payload, time until the next chunk)
+    templates = {}
+    with open(template_name, 'rb') as f:
+        for chunk in CissArchiveReader(template_name).chunks():
+            if chunk.channel not in templates and chunk.count > 1000:
+                f.seek(chunk.offset)
+                period = (chunk.t1 - chunk.t0) // (chunk.count - 1)
+                templates[chunk.channel] = (chunk, f.read(chunk.length), chunk.t1 - chunk.t0 + period)
+    os.remove(template_name)
+    start = min(chunk.t0 for chunk, payload, span in templates.values())
+    # (t0, channel, node) of the next chunks
+    queue = [(start, channel, node) for channel in templates for node in range(nodes)]
+    heapq.heapify(queue)
+    written = 0
+    with open(file_name, 'wb') as out:
+        while written < size:
+            t0, channel, node = heapq.heappop(queue)
+            chunk, payload, span = templates[channel]
+            header = chunk_header('CissSIM%d'% node, channel, chunk.flags, chunk.count, t0, t0 + chunk.t1 - chunk.t0,
+                                  chunk.vmin, chunk.vmax, payload)
+            out.write(header)
+            out.write(payload)
+            written += len(header) + len(payload)
+            heapq.heappush(queue, (t0 + span, channel, node))
+    return written, t0
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-f", dest="file", metavar="Archive", default='ciss_archive.cza', help="Archive file!")
+    parser.add_argument("--db", dest="db", metavar="Database", default=None, help="SQLite history sink database instead of the archive!")
+    parser.add_argument("-n", dest="node", metavar="Node", default=None, help="Node, e.g. cissACM0 (SQLite: tag name)!")
+    parser.add_argument("-c", dest="channel", metavar="Channel", default=None, help="Channel ax ... n!")
+    parser.add_argument("-s", dest="start", metavar="Start", default=None, help="Start, epoch seconds or YYYY-mm-ddTHH:MM:SS!")
+    parser.add_argument("-e", dest="end", metavar="End", default=None, help="End, epoch seconds or YYYY-mm-ddTHH:MM:SS!")
+    parser.add_argument("-p", dest="points", metavar="Points", type=int, default=500, help="Number of points!")
+    parser.add_argument("--no-mean", dest="mean", action="store_false", help="Min/max only, whole chunks from the index!")
+    parser.add_argument("-b", dest="bench", metavar="MB", type=int, default=0, help="Benchmark on a generated archive of MB in -f!")
+    parser.add_argument("-N", dest="nodes", metavar="Nodes", type=int, default=4, help="Benchmark nodes!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+def bench_history(cargs):
+    '''
+    Index build, index load and query latency on a generated archive
+    '''
+    import random
+    for old in archive_files(cargs.file) + index_files(cargs.file):
+        os.remove(old)
+    t = AppTimer()
+    t.start()
+    size, last = generate_archive(cargs.file, cargs.bench * 1024 * 1024, cargs.nodes)
+    print('archive: %.0f MB, %d nodes, generated in %.1f s'% (size / 1e6, cargs.nodes, t.stop() / 1000))
+    t = AppTimer()
+    t.start()
+    history = CissHistory(cargs.file)
+    history.refresh()
+    print('index build: %.1f s, %.1f MB'% (t.stop() / 1000, os.path.getsize(cargs.file + '.idx') / 1e6))
+    t = AppTimer()
+    t.start()
+    history = CissHistory(cargs.file)
+    history.refresh()
+    first, last = history.range('CissSIM0', 'ax')
+    print('index load: %.1f ms, %.1f days per node'% (t.stop(), (last - first) / 86400000.0))
+    rnd = random.Random(1)
+    ok = True
+    for span, mean in ((60, True), (3600, True), (86400, True), (86400, False), (None, False)):
+        if span is not None and span * 1000 > last - first:
+            continue
+        times = []
+        for ix in range(5):
+            node = 'CissSIM%d'% rnd.randrange(cargs.nodes)
+            channel = rnd.choice(('ax', 'gy', 'mz'))
+            start = first if span is None else rnd.randint(first, last - span * 1000)
+            end = last if span is None else start + span * 1000
+            t = AppTimer()
+            t.start()
+            buckets = list(history.query(node, channel, start, end, cargs.points, mean))
+            times.append(t.stop())
+            if span == 60:
+                expected = [value for timestamp, value in history.samples(node, channel, start, end)]
+                if (sum(count for t0, vmin, vmax, avg, count in buckets) != len(expected) or
+                    min(vmin for t0, vmin, vmax, avg, count in buckets) != min(expected)):
+                    ok = False
+        times.sort()
+        print('query %-8s %-8s %4d points: median %7.1f ms, max %7.1f ms'% (
+              'all' if span is None else '%d s'% span, 'min/max' if not mean else 'mean', len(buckets),
+              times[len(times) // 2], times[-1]))
+    print('bucket check %s'% ('ok' if ok else 'FAILED'))
+    return ok
+
+'''
+Query the archive, python -m lib.cissHistory -f ciss_archive.cza -n cissACM0 -c ax -s 2020-11-30T12:00 -e 2020-11-30T13:00
+Benchmark, python -m lib.cissHistory -f /tmp/ciss_history_test.cza -b 1024
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    if cargs.bench:
+        return 0 if bench_history(cargs) else 1
+    start = parse_time(cargs.start)
+    end = parse_time(cargs.end)
+    if cargs.db:
+        buckets = sqlite_query(cargs.db, cargs.node, start, end, cargs.points)
+    else:
+        history = CissHistory(cargs.file)
+        history.refresh()
+        if cargs.node is None or cargs.channel is None:
+            for node, channel in history.keys():
+                first, last = history.range(node, channel)
+                print('%s %-2s %s %s'% (node, channel, format_time(first), format_time(last)))
+            return 0
+        buckets = history.query(cargs.node, cargs.channel, start, end, cargs.points, cargs.mean)
+    print('time,min,max,mean,count')
+    for timestamp, vmin, vmax, mean, count in buckets:
+        print('%s,%s,%s,%s,%d'% (format_time(timestamp), vmin, vmax, '' if mean is None else '%.3f'% mean, count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
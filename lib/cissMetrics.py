@@ -0,0 +1,152 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS metrics exporter
+
+Prometheus text format metrics on http://host:port/metrics or on a UNIX
+socket. Collectors are called by the server thread on each request and
+only read counters, the read threads just increment them.
+'''
+
+'''
+Change log
+0.1.0 - 2020-11-20 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import os
+import threading
+
+from .chgrcodebase import *
+
+_SUFFIXES = ('_sum', '_count', '_total')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}'% ','.join('%s="%s"'% (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                            for key, value in sorted(labels.items()))
+
+
+class CissMetrics(AppBase):
+
+    def __init__(self, id='metrics', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.prefix = kwargs.get('prefix', 'ciss_')
+        self.requests = 0
+        self._meta = {}
+        self._collectors = []
+        self._server = None
+        self._thread = None
+        self._unix_socket = None
+        return
+
+    def describe(self, name, type, help):
+        '''
+        type: counter, gauge or summary (samples name_sum, name_count)
+        '''
+        self._meta[self.prefix + name] = (type, help)
+        return True
+
+    def add_collector(self, collector):
+        '''
+        collector() returns an iterable of (name, labels dict, value)
+        '''
+        self._collectors.append(collector)
+        return True
+
+    def _family(self, name):
+        if name in self._meta:
+            return name
+        for suffix in _SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in self._meta:
+                return name[:-len(suffix)]
+        return name
+
+    def render(self):
+        families = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    if value is None:
+                        continue
+                    name = self.prefix + name
+                    value = repr(value) if isinstance(value, float) else str(int(value))
+                    families.setdefault(self._family(name), []).append('%s%s %s'% (name, _format_labels(labels), value))
+            except Exception:
+                self.log_exception('Metrics collector %s failed!', collector)
+        lines = []
+        for family in sorted(families.keys()):
+            if family in self._meta:
+                type, help = self._meta[family]
+                lines.append('# HELP %s %s'% (family, help))
+                lines.append('# TYPE %s %s'% (family, type))
+            lines.extend(families[family])
+        return '\n'.join(lines) + '\n'
+
+    def start(self, conf):
+        '''
+        conf: host and port or unix_socket
+        '''
+        try:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+            from socketserver import UnixStreamServer, ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+            from SocketServer import UnixStreamServer, ThreadingMixIn
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                metrics.requests += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        if conf.get('unix_socket', None):
+            self._unix_socket = conf['unix_socket']
+            if os.path.exists(self._unix_socket):
+                os.remove(self._unix_socket)
+            class Server(ThreadingMixIn, UnixStreamServer):
+                daemon_threads = True
+            self._server = Server(self._unix_socket, Handler)
+            address = self._unix_socket
+        else:
+            class Server(ThreadingMixIn, HTTPServer):
+                daemon_threads = True
+            self._server = Server((conf.get('host', '127.0.0.1'), int(conf.get('port', 9105))), Handler)
+            address = 'http://%s:%d/metrics'% self._server.server_address[:2]
+        self._thread = threading.Thread(name=self.get_base_id(), target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self.log_info('Metrics on %s', address)
+        return True
+
+    def stop(self):
+        if self._server is None:
+            return False
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        if self._unix_socket and os.path.exists(self._unix_socket):
+            os.remove(self._unix_socket)
+        return True
+
+    def is_alive(self):
+        if self._thread is not None:
+            return self._thread.is_alive()
+        return False
@@ -0,0 +1,291 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS packed binary snapshots
+
+A node snapshot encoded as one fixed layout binary message: header (magic,
+version, schema id, snapshot seq and timestamp) followed by the fields of
+all sensors of the node in a precomputed order, value timestamps as double,
+all other values (current, min, max, mean, std of the value/magnitude and
+the x, y, z axes, anomaly, derived and spectral values as configured) as
+float32. The field order is the schema of the node, described by a JSON
+document and identified by its crc32 in each message. The encoder fills a
+reusable buffer with one struct.pack_into per snapshot, sensors not part of
+the snapshot and values not set are NaN.
+'''
+
+'''
+Change log
+0.1.1 - 2020-12-28 - cg
+    Spectral features of the snapshot window
+    
+0.1.0 - 2020-12-08 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.1'
+__status__ = "beta"
+
+import sys
+import json
+import zlib
+import struct
+
+from .chgrcodebase import *
+
+CISS_PACKED_MAGIC = b'CP'
+CISS_PACKED_VERSION = 1
+# magic, version, flags, schema id, snapshot seq, snapshot timestamp
+_HEADER = '<2sBBIId'
+_HEADER_STRUCT = struct.Struct(_HEADER)
+_NAN = float('nan')
+_STATS = ('current', 'min', 'max', 'mean', 'std')
+_AXES = ('x', 'y', 'z')
+_NO_VALUES = {}
+# value sources of a sensor: values, x, y, z values, x, y, z spectral features
+_NO_SOURCES = (_NO_VALUES,) * 7
+
+
+def packed_schema_id(data, offset=0):
+    '''
+    Schema id of a packed message, None if data is no packed message
+    '''
+    if len(data) - offset < _HEADER_STRUCT.size:
+        return None
+    magic, version, flags, schema_id, seq, timestamp = _HEADER_STRUCT.unpack_from(data, offset)
+    if magic != CISS_PACKED_MAGIC or version != CISS_PACKED_VERSION:
+        return None
+    return schema_id
+
+
+class CissPackedSchema(AppBase):
+    '''
+    Field layout of the packed snapshots of a node. from_node() builds the
+    encoder of a node, from_description() the decoder of a received
+    schema document
+    '''
+    def __init__(self, node, fields, units, id='cissPackedSchema', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.node = node
+        # field name, struct type
+        self.fields = list(fields)
+        self.units = list(units)
+        self.names = [name for name, type in self.fields]
+        self.format = ''.join(type for name, type in self.fields)
+        self._struct = struct.Struct(_HEADER + self.format)
+        self.size = self._struct.size
+        self.schema_id = zlib.crc32(json.dumps([CISS_PACKED_VERSION, node, self.format, self.names]).encode('utf-8')) & 0xFFFFFFFF
+        self.buffer = bytearray(self.size)
+        self._view = memoryview(self.buffer)
+        # (sensor index, source, value name) per field, encoder only
+        self._getters = None
+        self._sensor_ids = None
+        return
+
+    @classmethod
+    def from_node(cls, node, **kwargs):
+        '''
+        Schema of the sensors of an AppCissNode as configured
+        '''
+        fields = []
+        units = []
+        getters = []
+
+        def add(name, type, unit, ix, source, key):
+            fields.append((name, type))
+            units.append(unit)
+            getters.append((ix, source, key))
+
+        sensor_ids = sorted(node.get_sensors().keys())
+        for ix in sensor_ids:
+            sensor = node.get_sensor(ix)
+            add('%s.timestamp'% ix, 'd', 's', ix, 0, 'timestamp')
+            for what in _STATS:
+                add('%s.%s'% (ix, what), 'f', sensor.unit, ix, 0, what)
+            if sensor.has_anomaly_detector():
+                add('%s.anomaly'% ix, 'f', '', ix, 0, 'anomaly')
+                add('%s.anomaly_score'% ix, 'f', '', ix, 0, 'anomaly_score')
+            if not sensor.is_xyz():
+                continue
+            for source, axis in enumerate(_AXES, 1):
+                for what in _STATS:
+                    add('%s.%s.%s'% (ix, axis, what), 'f', sensor.unit, ix, source, what)
+            if sensor.is_derived():
+                for what in ('pitch', 'roll', 'rms_x', 'rms_y', 'rms_z'):
+                    add('%s.%s'% (ix, what), 'f', 'deg' if what in ('pitch', 'roll') else sensor.unit, ix, 0, what)
+            spectral = getattr(sensor, '_spectral', None)
+            if spectral is not None:
+                for source, axis in enumerate(_AXES, 4):
+                    for what in spectral.names:
+                        add('%s.%s.%s'% (ix, axis, what), 'f', 'Hz' if what == 'dom_freq' else sensor.unit, ix, source, what)
+        schema = cls(node.get_base_id(), fields, units, **kwargs)
+        schema._getters = getters
+        schema._sensor_ids = sensor_ids
+        return schema
+
+    @classmethod
+    def from_description(cls, description, **kwargs):
+        '''
+        Decoder of a schema document (describe())
+        '''
+        if description.get('version', None) != CISS_PACKED_VERSION:
+            raise AppBaseError('Packed schema version %s not supported!'% description.get('version', None))
+        schema = cls(description['node'], zip(description['fields'], description['format']),
+                     description['units'], **kwargs)
+        if schema.schema_id != description['schema']:
+            raise AppBaseError('Packed schema %s of node %s invalid!'% (description['schema'], description['node']))
+        return schema
+
+    def describe(self):
+        '''
+        JSON serializable schema document, sent to the consumers before the
+        first message and after a change
+        '''
+        return {'magic': CISS_PACKED_MAGIC.decode('ascii'), 'version': CISS_PACKED_VERSION, 'schema': self.schema_id,
+                'node': self.node, 'header': _HEADER, 'size': self.size,
+                'format': self.format, 'fields': self.names, 'units': self.units}
+
+    def encode(self, snapshot):
+        '''
+        Pack a CissNodeSnapshot into the buffer, returns a memoryview of
+        the buffer, valid until the next encode
+        '''
+        sensors = snapshot.sensors
+        sources = {}
+        for ix in self._sensor_ids:
+            sensor = sensors.get(ix, None)
+            if sensor is None:
+                sources[ix] = _NO_SOURCES
+            elif sensor.children is not None:
+                children = sensor.children
+                spectral = [sensor.get_spectral_features(axis) or _NO_VALUES for axis in _AXES]
+                sources[ix] = (sensor.values, children['x'].values, children['y'].values, children['z'].values,
+                               spectral[0], spectral[1], spectral[2])
+            else:
+                sources[ix] = (sensor.values,)
+        values = [sources[ix][source].get(key, None) for ix, source, key in self._getters]
+        self._struct.pack_into(self.buffer, 0, CISS_PACKED_MAGIC, CISS_PACKED_VERSION, 0, self.schema_id,
+                               snapshot.seq & 0xFFFFFFFF, snapshot.timestamp,
+                               *[_NAN if value is None or value == '' else value for value in values])
+        return self._view
+
+    def decode(self, data, offset=0):
+        '''
+        Returns seq, timestamp and the tuple of field values of a message
+        '''
+        values = self._struct.unpack_from(data, offset)
+        if values[0] != CISS_PACKED_MAGIC or values[1] != CISS_PACKED_VERSION or values[3] != self.schema_id:
+            raise AppBaseError('Packed message of schema %s, expected %s!'% (values[3], self.schema_id))
+        return values[4], values[5], values[6:]
+
+    def to_dict(self, values):
+        return dict(zip(self.names, values))
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-c", dest="config_file", metavar="Config File", default='sensor.json', help="Node configuration!")
+    parser.add_argument("-n", dest="snapshots", metavar="Snapshots", type=int, default=2000, help="Snapshots encoded!")
+    parser.add_argument("--schema", dest="schema", action="store_true", help="Print the schema document of the node!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+
+def bench_node(config_file):
+    '''
+    Node of the first node configuration with values and statistics on a
+    pseudo terminal
+    '''
+    import os
+    import pty
+    from .cissUsbSensor import AppCissNode
+    with open(config_file) as f:
+        ext_conf = json.load(f)
+    node_id, node_conf = sorted(ext_conf['ciss_nodes'].items())[0]
+    master, slave = pty.openpty()
+    node_conf['com_port'] = os.ttyname(slave)
+    node = AppCissNode(node_id, conf=node_conf, window_stats=True)
+    start = time.time()
+    for ix in range(200):
+        stream_data = {'timestamp': start + ix * 0.01}
+        for s_id in node.get_sensors():
+            stream_data[s_id] = 20.0 + ix % 7 * 0.1
+            for axis in _AXES:
+                stream_data['%s_%s'% (s_id, axis)] = 1000 + ix % 13
+        for sensor in node.get_sensors().values():
+            sensor.update_value_ext(stream_data)
+    return node
+
+
+'''
+Encode and decode cost and size against per tag publishing and JSON,
+python -m lib.cissPacked -c sensor.json
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    from .tpg_create_vtags import TpgEquipmentApp
+    node = bench_node(cargs.config_file)
+    snapshot = node.take_snapshot()
+    schema = CissPackedSchema.from_node(node)
+    if cargs.schema:
+        print(json.dumps(schema.describe(), indent=1))
+        return 0
+
+    def tag_batch():
+        # values of tpg_publish_sensor, statistics of the sensors and axes
+        batch = []
+        at = time.time()
+        for s_id, sensor in snapshot.sensors.items():
+            sensors = [sensor] + ([sensor.get_sensor(axis) for axis in _AXES] if sensor.is_xyz() else [])
+            for item in sensors:
+                for what in _STATS:
+                    batch.append((TpgEquipmentApp.tpg_publish_tag_name(node.name, item.name, what),
+                                  int(item.get_value(what)), item.unit, at))
+        return batch
+
+    def timed(function, count):
+        t = AppTimer()
+        t.start()
+        for ix in range(count):
+            result = function()
+        return t.stop() * 1000 / count, result
+
+    count = cargs.snapshots
+    print('%-10s %7s %11s %11s %8s'% ('format', 'values', 'encode us', 'decode us', 'bytes'))
+    build, batch = timed(tag_batch, count)
+    # TagV2 publish: one call per tag, name and value
+    print('%-10s %7d %11.1f %11s %8d'% ('per tag', len(batch), build, '-', sum(len(tag[0]) + 8 for tag in batch)))
+
+    def json_encode():
+        batch = tag_batch()
+        return json.dumps({'node': node.name, 'timestamp': snapshot.timestamp,
+                           'values': dict((tag[0], tag[1]) for tag in batch)}, separators=(',', ':'))
+
+    encode, payload = timed(json_encode, count)
+    decode, message = timed(lambda: json.loads(payload), count)
+    print('%-10s %7d %11.1f %11.1f %8d'% ('json', len(message['values']), encode, decode, len(payload)))
+
+    encode, view = timed(lambda: schema.encode(snapshot), count)
+    payload = view.tobytes()
+    decode, values = timed(lambda: schema.to_dict(schema.decode(payload)[2]), count)
+    print('%-10s %7d %11.1f %11.1f %8d'% ('packed', len(values), encode, decode, len(payload)))
+    decode, values = timed(lambda: schema.decode(payload), count)
+    print('%-10s %7d %11s %11.1f %8s'% (' tuple', len(values[2]), '', decode, ''))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS streaming rate control
+
+Lowers the inertial streaming rate of a node while the host falls behind
+and restores it when the load is gone. The read thread reports the time
+it spends decoding, every interval the controller compares the bytes
+waiting in the serial buffer (backlog) and the decode load with high and
+low limits. Sustained overload steps the rate down by factor, a longer
+calm period steps it up again. A step up followed by overload doubles
+the calm period needed for the next one.
+'''
+
+'''
+Change log
+0.1.0 - 2020-12-04 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import sys
+
+from .chgrcodebase import *
+
+
+class CissRateController(AppBase):
+    '''
+    backlog_high/backlog_low: serial buffer bytes, load_high: decode time
+    per interval, load_low: max. decode load expected after a step up
+    (load * factor), overload_intervals/recover_intervals: intervals the
+    condition has to last, max_level: steps down (period * factor ** level)
+    '''
+    def __init__(self, node, id='cissRateControl', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.node = node
+        self.interval = float(kwargs.get('interval', 1.0))
+        self.backlog_high = int(kwargs.get('backlog_high', 1024))
+        self.backlog_low = int(kwargs.get('backlog_low', 128))
+        self.load_high = float(kwargs.get('load_high', 0.8))
+        self.load_low = float(kwargs.get('load_low', 0.6))
+        self.overload_intervals = int(kwargs.get('overload_intervals', 3))
+        self.recover_intervals = int(kwargs.get('recover_intervals', 10))
+        self.factor = float(kwargs.get('factor', 2.0))
+        self.max_level = int(kwargs.get('max_level', 3))
+        self.level = 0
+        self.changes = 0
+        self.backlog = 0
+        self.load = 0.0
+        self._busy = 0.0
+        self._overloaded = 0
+        self._recovered = 0
+        # multiplier of recover_intervals, doubled by a step up that did not hold
+        self._hold = 1
+        self._last = AppUtil.monotonic()
+        self._last_change = None
+        self._last_step = 0
+        return
+
+    def add_busy(self, seconds):
+        '''
+        Decode time of a frame, called from the read thread
+        '''
+        self._busy += seconds
+        return True
+
+    def is_due(self, now=None):
+        return (AppUtil.monotonic() if now is None else now) - self._last >= self.interval
+
+    def reset(self):
+        '''
+        Nominal rate applied by a configuration change
+        '''
+        self.level = 0
+        self._overloaded = 0
+        self._recovered = 0
+        self._hold = 1
+        self._last_step = 0
+        return True
+
+    def update(self, backlog, now=None):
+        '''
+        Evaluate the interval, returns the new level on a change, else None
+        '''
+        now = AppUtil.monotonic() if now is None else now
+        elapsed = now - self._last
+        self._last = now
+        last_backlog = self.backlog
+        self.backlog = backlog
+        self.load = min(1.0, self._busy / elapsed) if elapsed > 0 else 0.0
+        self._busy = 0.0
+        # a backlog draining after a step down is not counted as overload
+        if (backlog >= self.backlog_high and backlog >= last_backlog) or self.load >= self.load_high:
+            self._overloaded += 1
+            self._recovered = 0
+        elif backlog <= self.backlog_low and self.load * self.factor <= self.load_low:
+            self._recovered += 1
+            self._overloaded = 0
+        else:
+            self._overloaded = 0
+            self._recovered = 0
+        if self._overloaded >= self.overload_intervals and self.level < self.max_level:
+            if self._last_step < 0 and now - self._last_change < self.recover_intervals * self._hold * self.interval:
+                self._hold = min(self._hold * 2, 16)
+            return self.set_level(self.level + 1, now)
+        if self._recovered >= self.recover_intervals * self._hold and self.level > 0:
+            return self.set_level(self.level - 1, now)
+        if self._last_change is not None and now - self._last_change > 4 * self.recover_intervals * self._hold * self.interval:
+            self._hold = 1
+        return None
+
+    def set_level(self, level, now=None):
+        self._last_step = 1 if level > self.level else -1
+        self.log_info('Node %s streaming rate level %d -> %d, backlog %d bytes, load %.2f', self.node,
+                      self.level, level, self.backlog, self.load)
+        self.level = level
+        self.changes += 1
+        self._overloaded = 0
+        self._recovered = 0
+        self._last_change = AppUtil.monotonic() if now is None else now
+        return level
+
+    def get_period(self, period):
+        '''
+        Streaming period (us) of the level for the configured period
+        '''
+        return int(period * self.factor ** self.level)
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-r", dest="rate", metavar="Frames", type=float, default=300, help="Offered frames per second at level 0!")
+    parser.add_argument("-c", dest="capacity", metavar="Frames", type=float, default=100, help="Frames per second the host reads!")
+    parser.add_argument("-s", dest="seconds", metavar="Seconds", type=int, default=120, help="Simulated seconds!")
+    parser.add_argument("-o", dest="overload", metavar="Seconds", type=int, nargs=2, default=[20, 80],
+                        help="Overload phase, capacity outside of it is 10 times higher!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Simulated overload phase, python -m lib.cissRateControl
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    frame_size = 10
+    controller = CissRateController('CissSIM0')
+    # simulated time
+    controller._last = 0.0
+    backlog = 0.0
+    lost = 0.0
+    buffer_size = 4096
+    print('%4s %6s %8s %8s %6s %5s'% ('s', 'level', 'offered', 'read', 'backlog', 'lost'))
+    for second in range(cargs.seconds):
+        capacity = cargs.capacity if cargs.overload[0] <= second < cargs.overload[1] else cargs.capacity * 10
+        offered = cargs.rate / controller.factor ** controller.level
+        read = min(capacity, offered + backlog / frame_size)
+        backlog += (offered - read) * frame_size
+        if backlog > buffer_size:
+            lost += (backlog - buffer_size) / frame_size
+            backlog = buffer_size
+        controller.add_busy(read / capacity * 0.5)
+        controller.update(int(backlog), second + 1)
+        if second % 5 == 0:
+            print('%4d %6d %8.0f %8.0f %6d %5.0f'% (second, controller.level, offered, read, backlog, lost))
+    print('%d rate changes, %.0f frames lost'% (controller.changes, lost))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS publish scheduler
+
+Deadline scheduler on a monotonic clock. Each key has its own interval,
+the next due times are kept in a heap. Deadlines are aligned to multiples
+of the interval and advance by the interval, independent of the time the
+work takes, so ticks do not drift. Ticks missed by an overrun are skipped.
+'''
+
+'''
+Change log
+0.1.0 - 2020-11-14 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import sys
+import time
+import heapq
+
+from .chgrcodebase import *
+
+
+class CissScheduler(object):
+    '''
+    Not thread safe, used by one thread only
+    '''
+    __slots__ = ('clock', 'missed', '_heap', '_entries', '_seq')
+
+    def __init__(self, clock=None):
+        self.clock = AppUtil.monotonic if clock is None else clock
+        self.missed = 0
+        self._heap = []
+        # key -> heap entry [due, seq, key, interval], key None if removed
+        self._entries = {}
+        self._seq = 0
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, interval):
+        '''
+        Schedule key every interval seconds, replaces an existing schedule
+        '''
+        if interval <= 0:
+            raise ValueError('Invalid interval %s for %s'% (interval, key))
+        self.remove(key)
+        now = self.clock()
+        due = now - (now % interval) + interval
+        self._seq += 1
+        entry = [due, self._seq, key, interval]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        return True
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        return True
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+        return True
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def next_due(self):
+        '''
+        Next due time on the scheduler clock, None if empty
+        '''
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now=None):
+        '''
+        Returns list of keys due, each one once even if ticks were missed
+        '''
+        if now is None:
+            now = self.clock()
+        heap = self._heap
+        due_keys = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if entry[2] is None:
+                continue
+            due_keys.append(entry[2])
+            interval = entry[3]
+            due = entry[0] + interval
+            if due <= now:
+                missed = int((now - due) // interval) + 1
+                self.missed += missed
+                due += missed * interval
+            entry[0] = due
+            heapq.heappush(heap, entry)
+        return due_keys
+
+    def wait(self, max_wait=None):
+        '''
+        Sleep until the next due time, at most max_wait seconds,
+        returns the list of keys due
+        '''
+        due = self.next_due()
+        if due is None:
+            if max_wait:
+                time.sleep(max_wait)
+            return []
+        delay = due - self.clock()
+        if max_wait is not None and delay > max_wait:
+            delay = max_wait
+        if delay > 0:
+            time.sleep(delay)
+        return self.pop_due()
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-i", dest="intervals", metavar="Interval", type=float, nargs='+', default=[0.1, 0.25, 1.0], help="Intervals in seconds!")
+    parser.add_argument("-w", dest="work", metavar="Work", type=float, default=0.02, help="Work time per tick in seconds!")
+    parser.add_argument("-n", dest="seconds", metavar="Seconds", type=float, default=5, help="Seconds to run!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Compare the tick drift of sleep and work with the scheduler, python -m lib.cissScheduler
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    interval = cargs.intervals[0]
+    ticks = int(cargs.seconds / interval)
+    start = AppUtil.monotonic()
+    for ix in range(ticks):
+        time.sleep(interval)
+        time.sleep(cargs.work)
+    drift = AppUtil.monotonic() - start - ticks * interval
+    print('sleep %.3f s: %d ticks, drift %.1f ms'% (interval, ticks, drift * 1000))
+
+    scheduler = CissScheduler()
+    for interval in cargs.intervals:
+        scheduler.add(interval, interval)
+    counts = dict((interval, 0) for interval in cargs.intervals)
+    late_max = 0.0
+    cpu = time.clock() if hasattr(time, 'clock') else time.process_time()
+    start = AppUtil.monotonic()
+    end = start + cargs.seconds
+    while AppUtil.monotonic() < end:
+        due_time = scheduler.next_due()
+        keys = scheduler.wait(end - AppUtil.monotonic())
+        if keys:
+            late_max = max(late_max, AppUtil.monotonic() - due_time)
+        for key in keys:
+            counts[key] += 1
+        time.sleep(cargs.work)
+    cpu = (time.clock() if hasattr(time, 'clock') else time.process_time()) - cpu
+    for interval in cargs.intervals:
+        print('scheduler %.3f s: %d ticks of %d'% (interval, counts[interval], int(cargs.seconds / interval)))
+    print('max lateness %.1f ms, missed %d, CPU %.1f ms'% (late_max * 1000, scheduler.missed, cpu * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
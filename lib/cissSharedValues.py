@@ -0,0 +1,477 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS shared memory latest values
+
+Table of the latest values and statistics per node and sensor in a memory
+mapped file (tmpfs), read by other processes on the gateway without any
+call into the gateway. The layout is fixed at startup: header, directory
+(node, sensor, name, unit, channels) and one record per node and sensor
+with the current, min, max, mean and std of the channels (value or
+magnitude, x, y, z). The read thread writes the current values per frame,
+the statistics are written with the snapshots.
+
+Each record starts with a sequence counter: the writer makes it odd, writes
+the values and makes it even again. A reader copies the record and accepts
+it if the counter was even and is unchanged after the copy, else it reads
+again, so a record is never seen partly written.
+'''
+
+'''
+Change log
+0.1.0 - 2020-12-06 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import os
+import sys
+import mmap
+import struct
+import threading
+
+from collections import namedtuple
+
+from .chgrcodebase import *
+
+_MAGIC = b'CISSVAL\0'
+_VERSION = 1
+_STATE_CLOSED = 0
+_STATE_OPEN = 1
+# magic, version, record size, record count, directory offset, records offset, state, pid, created
+_HEADER = struct.Struct('<8sHHIIIIId')
+_HEADER_SIZE = 64
+# node id, sensor index, sensor name, unit, channels
+_DIRECTORY = struct.Struct('<24s8s16s8sI4x')
+# seq, timestamp, samples, current[4], stats timestamp, min[4], max[4], mean[4], std[4]
+_RECORD = struct.Struct('<QdQ4dd4d4d4d4d')
+_STATE = struct.Struct('<I')
+_SEQ = struct.Struct('<Q')
+_BODY = struct.Struct('<dQ4dd4d4d4d4d')
+_CURRENT = struct.Struct('<dQ')
+_CURRENT_XYZ = struct.Struct('<3d')
+_CURRENT_VALUE = struct.Struct('<d')
+_OFS_STATE = 24
+# offsets in the record
+_OFS_TIMESTAMP = 8
+_OFS_CURRENT = 24
+_CHANNELS = 4
+_NAN = float('nan')
+
+# channel index of the sensor types
+_TYPE_CHANNEL = {None: 0, 'x': 1, 'y': 2, 'z': 3}
+
+# record of a sensor, current..std are tuples of the channels (value or magnitude, x, y, z)
+CissSharedValue = namedtuple('CissSharedValue', ['node', 'sensor', 'name', 'unit', 'seq', 'timestamp', 'samples',
+                                                 'stats_timestamp', 'current', 'min', 'max', 'mean', 'std'])
+
+
+def _float(value):
+    if value is None or value == '':
+        return _NAN
+    return float(value)
+
+
+def _text(value, size):
+    return str(value).encode('utf-8')[:size]
+
+
+class CissSharedValues(AppBase):
+    '''
+    Writer of the table. Passed to the nodes before the layout is known,
+    create() builds the table of the nodes, writes before are ignored.
+    The writers of a node (read thread, overdue snapshots) are serialized
+    by a lock per node, the readers never wait.
+    '''
+    def __init__(self, path, id='cissSharedValues', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.path = path
+        self.frames = bool(kwargs.get('frames', True))
+        self.writes = 0
+        self._map = None
+        self._file = None
+        # (node, sensor index) -> [record offset, node lock]
+        self._records = {}
+        return
+
+    def create(self, nodes):
+        '''
+        Create the table of nodes (id -> AppCissNode), the file is replaced
+        by a rename, readers of a previous table see it closed
+        '''
+        layout = []
+        for node_id in sorted(nodes.keys()):
+            for ix, sensor in sorted(nodes[node_id].get_sensors().items()):
+                layout.append((node_id, ix, sensor.name, sensor.unit, _CHANNELS if sensor.is_xyz() else 1))
+        directory_offset = _HEADER_SIZE
+        records_offset = directory_offset + len(layout) * _DIRECTORY.size
+        records_offset += -records_offset % 64
+        size = records_offset + len(layout) * _RECORD.size
+        size += -size % mmap.PAGESIZE
+        buffer = bytearray(size)
+        _HEADER.pack_into(buffer, 0, _MAGIC, _VERSION, _RECORD.size, len(layout), directory_offset,
+                          records_offset, _STATE_OPEN, os.getpid(), time.time())
+        records = {}
+        locks = {}
+        for ix, (node_id, sensor, name, unit, channels) in enumerate(layout):
+            _DIRECTORY.pack_into(buffer, directory_offset + ix * _DIRECTORY.size, _text(node_id, 24),
+                                 _text(sensor, 8), _text(name, 16), _text(unit, 8), channels)
+            offset = records_offset + ix * _RECORD.size
+            _RECORD.pack_into(buffer, offset, 0, 0.0, 0, *([_NAN] * 4 + [0.0] + [_NAN] * 16))
+            records[(node_id, sensor)] = [offset, locks.setdefault(node_id, threading.Lock())]
+        temp_name = '%s.tmp'% self.path
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_name, 'wb') as f:
+                f.write(buffer)
+            f = open(temp_name, 'r+b')
+            shared_map = mmap.mmap(f.fileno(), size)
+            os.rename(temp_name, self.path)
+        except (IOError, OSError, mmap.error):
+            self.log_exception('Shared values %s not created!', self.path)
+            return False
+        self.close()
+        self._file = f
+        self._records = records
+        self._map = shared_map
+        self.log_info('Shared values %s, %d records, %d bytes', self.path, len(layout), size)
+        return True
+
+    def close(self):
+        '''
+        Mark the table closed, the values stay readable
+        '''
+        if self._map is None:
+            return False
+        shared_map = self._map
+        self._map = None
+        self._records = {}
+        _STATE.pack_into(shared_map, _OFS_STATE, _STATE_CLOSED)
+        shared_map.close()
+        self._file.close()
+        self._file = None
+        return True
+
+    def write_current(self, node, sensor):
+        '''
+        Current value(s) of a sensor, called from the read thread per frame
+        '''
+        record = self._records.get((node, sensor.get_base_id()), None)
+        if record is None or not self.frames:
+            return False
+        offset, lock = record
+        shared_map = self._map
+        if sensor.is_xyz():
+            x_sensor = sensor.get_sensor('x')
+            timestamp = x_sensor.value_timestamp
+            samples = x_sensor._value_ucount
+            values = (x_sensor.value, sensor.get_sensor('y').value, sensor.get_sensor('z').value)
+            value_offset = offset + _OFS_CURRENT + 8
+            pack = _CURRENT_XYZ.pack_into
+        else:
+            timestamp = sensor.value_timestamp
+            samples = sensor._value_ucount
+            values = (sensor.value,)
+            value_offset = offset + _OFS_CURRENT
+            pack = _CURRENT_VALUE.pack_into
+        with lock:
+            seq = _SEQ.unpack_from(shared_map, offset)[0] + 1
+            _SEQ.pack_into(shared_map, offset, seq)
+            _CURRENT.pack_into(shared_map, offset + _OFS_TIMESTAMP, _float(timestamp), samples)
+            pack(shared_map, value_offset, *[_float(value) for value in values])
+            _SEQ.pack_into(shared_map, offset, seq + 1)
+        self.writes += 1
+        return True
+
+    def write_snapshot(self, snapshot):
+        '''
+        Values and statistics of the sensors of a CissNodeSnapshot
+        '''
+        if self._map is None:
+            return False
+        node = snapshot.node.get_base_id()
+        shared_map = self._map
+        for ix, sensor in snapshot.sensors.items():
+            record = self._records.get((node, ix), None)
+            if record is None:
+                continue
+            offset, lock = record
+            values = [sensor.get_value()]
+            if sensor.is_xyz():
+                values.extend(sensor.get_value(None, type) for type in ('x', 'y', 'z'))
+                timestamp = values[1]['timestamp']
+                samples = sensor.get_sensor('x')._value_ucount
+            else:
+                values.extend([{}] * (_CHANNELS - 1))
+                timestamp = values[0]['timestamp']
+                samples = sensor._value_ucount
+            body = [_float(timestamp), samples]
+            body.extend(_float(value.get('current', None)) for value in values)
+            body.append(snapshot.timestamp)
+            for what in ('min', 'max', 'mean', 'std'):
+                body.extend(_float(value.get(what, None)) for value in values)
+            with lock:
+                seq = _SEQ.unpack_from(shared_map, offset)[0] + 1
+                _SEQ.pack_into(shared_map, offset, seq)
+                _BODY.pack_into(shared_map, offset + _OFS_TIMESTAMP, *body)
+                _SEQ.pack_into(shared_map, offset, seq + 1)
+            self.writes += 1
+        return True
+
+
+class CissSharedValuesReader(AppBase):
+    '''
+    Reader of the table, no lock and no call into the gateway. retries:
+    copies of a record tried while it is written, after the first ones
+    the reader sleeps retry_sleep seconds (a writer descheduled in the
+    middle of a write on a single core)
+    '''
+    def __init__(self, path, id='cissSharedValuesReader', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.path = path
+        self.retries = int(kwargs.get('retries', 100))
+        self.retry_sleep = float(kwargs.get('retry_sleep', 0.0001))
+        self.read_retries = 0
+        self.read_failures = 0
+        self.pid = None
+        self.created = None
+        self._map = None
+        self._inode = None
+        # (node, sensor index) -> (record offset, name, unit, channels)
+        self._index = {}
+        self.open()
+        return
+
+    def open(self):
+        self.close()
+        with open(self.path, 'rb') as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, count, directory_offset, records_offset, state, pid, created = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION or record_size != _RECORD.size:
+            self.close()
+            raise AppBaseError('Shared values %s, unknown format!'% self.path)
+        self.pid = pid
+        self.created = created
+        index = {}
+        for ix in range(count):
+            node, sensor, name, unit, channels = _DIRECTORY.unpack_from(self._map, directory_offset + ix * _DIRECTORY.size)
+            node, sensor, name, unit = [text.rstrip(b'\0').decode('utf-8') for text in (node, sensor, name, unit)]
+            index[(node, sensor)] = (records_offset + ix * _RECORD.size, name, unit, channels)
+        self._index = index
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._index = {}
+        return True
+
+    def is_open(self):
+        '''
+        True while the gateway writes the table
+        '''
+        return _STATE.unpack_from(self._map, _OFS_STATE)[0] == _STATE_OPEN
+
+    def check(self):
+        '''
+        Map the new table after a gateway restart, True if reopened
+        '''
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return False
+        if inode == self._inode:
+            return False
+        self.open()
+        return True
+
+    def keys(self):
+        '''
+        (node, sensor index) of the records
+        '''
+        return sorted(self._index.keys())
+
+    def read(self, node, sensor):
+        '''
+        Consistent copy of a record as CissSharedValue, None if the record
+        is written for all retries
+        '''
+        offset, name, unit, channels = self._index[(node, sensor)]
+        shared_map = self._map
+        for retry in range(self.retries):
+            values = _RECORD.unpack_from(shared_map, offset)
+            seq = values[0]
+            if not seq & 1 and _SEQ.unpack_from(shared_map, offset)[0] == seq:
+                self.read_retries += retry
+                return CissSharedValue(node, sensor, name, unit, seq, values[1], values[2], values[7],
+                                       values[3:3 + channels], values[8:8 + channels], values[12:12 + channels],
+                                       values[16:16 + channels], values[20:20 + channels])
+            if retry >= 2:
+                time.sleep(self.retry_sleep)
+        self.read_retries += self.retries
+        self.read_failures += 1
+        return None
+
+    def get_value(self, node, sensor, what='current', type=None):
+        '''
+        Single value like AppCissNode.get_sensor_value, type x, y, z of xyz
+        sensors, None the value or magnitude
+        '''
+        value = self.read(node, sensor)
+        if value is None:
+            return None
+        if what in ('timestamp', 'samples', 'stats_timestamp'):
+            return getattr(value, what)
+        return getattr(value, what)[_TYPE_CHANNEL[type]]
+
+    def read_all(self):
+        return [self.read(node, sensor) for node, sensor in self.keys()]
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-f", dest="path", metavar="File", default='/dev/shm/ciss_values', help="Shared values file!")
+    parser.add_argument("-b", dest="bench", action="store_true", help="Benchmark a writer process and a reader on a test table!")
+    parser.add_argument("-r", dest="rate", metavar="Frames", type=float, default=1000, help="Benchmark frames per second written, 0 as fast as possible!")
+    parser.add_argument("-s", dest="seconds", metavar="Seconds", type=float, default=3.0, help="Benchmark duration!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+
+class _BenchSensor(object):
+    '''
+    Sensor attributes used by the writer, all values of a frame set to
+    the frame number, a torn read would show different values
+    '''
+    def __init__(self, ix, xyz):
+        self.ix = ix
+        self.name = ix
+        self.unit = 'n/a'
+        self.value = 0
+        self.value_timestamp = None
+        self._value_ucount = 0
+        self._xyz = [_BenchSensor('%s_%s'% (ix, type), False) for type in ('x', 'y', 'z')] if xyz else None
+
+    def get_base_id(self):
+        return self.ix
+
+    def is_xyz(self):
+        return self._xyz is not None
+
+    def get_sensor(self, type):
+        return self._xyz['xyz'.index(type)]
+
+    def set(self, value, timestamp):
+        for sensor in [self] + (self._xyz or []):
+            sensor.value = value
+            sensor.value_timestamp = timestamp
+            sensor._value_ucount = value
+
+
+class _BenchNode(object):
+    def __init__(self, sensors):
+        self._sensors = sensors
+
+    def get_sensors(self):
+        return self._sensors
+
+
+def bench(cargs):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(prefix='ciss_values_'), 'ciss_values')
+    sensors = {'Accl': _BenchSensor('Accl', True), 'Temp': _BenchSensor('Temp', False)}
+    writer = CissSharedValues(path)
+    writer.create({'CissSIM0': _BenchNode(sensors)})
+    # the readers are other processes, a thread would wait for the GIL in the middle of a write
+    import multiprocessing
+    stop = multiprocessing.Event()
+    writes = multiprocessing.Value('d', 0)
+
+    def write():
+        frame = 0
+        start = AppUtil.monotonic()
+        while not stop.is_set():
+            frame += 1
+            for sensor in sensors.values():
+                sensor.set(frame, float(frame))
+                writer.write_current('CissSIM0', sensor)
+            if cargs.rate:
+                delay = start + frame / cargs.rate - AppUtil.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        writes.value = writer.writes
+
+    process = multiprocessing.Process(target=write)
+    process.start()
+    reader = CissSharedValuesReader(path)
+    reads = 0
+    torn = 0
+    slowest = 0.0
+    end = AppUtil.monotonic() + cargs.seconds
+    t = AppTimer()
+    t.start()
+    while AppUtil.monotonic() < end:
+        t0 = AppUtil.monotonic()
+        value = reader.read('CissSIM0', 'Accl')
+        slowest = max(slowest, AppUtil.monotonic() - t0)
+        reads += 1
+        if value is not None and value.seq and not (value.timestamp == value.samples == value.current[1] ==
+                                                     value.current[2] == value.current[3]):
+            torn += 1
+    elapsed = t.stop()
+    stop.set()
+    process.join()
+    print('writer : %d writes, %.0f writes/s'% (writes.value, writes.value / cargs.seconds))
+    print('reader : %d reads, %.2f us per read, slowest %.0f us, %d retries, %d failed, %d torn'% (reads,
+          elapsed * 1000 / reads, slowest * 1e6, reader.read_retries, reader.read_failures, torn))
+    reader.close()
+    writer.close()
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    return 0
+
+'''
+Print the table, python -m lib.cissSharedValues -f /dev/shm/ciss_values
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    if cargs.bench:
+        return bench(cargs)
+    reader = CissSharedValuesReader(cargs.path)
+    print('%s, pid %d, %s'% (cargs.path, reader.pid, 'open' if reader.is_open() else 'closed'))
+    print('%-10s %-6s %-8s %8s %19s %10s %10s %10s %10s %10s'% ('node', 'sensor', 'name', 'samples', 'time', 'current',
+          'min', 'max', 'mean', 'std'))
+    for value in reader.read_all():
+        if value is None:
+            continue
+        for ix in range(len(value.current)):
+            print('%-10s %-6s %-8s %8d %19s %10.2f %10.2f %10.2f %10.2f %10.2f'% (value.node if not ix else '',
+                  value.sensor if not ix else '', value.name if not ix else ' %s'% 'mxyz'[ix],
+                  value.samples, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value.timestamp)) if value.timestamp > 0 else '-',
+                  value.current[ix], value.min[ix], value.max[ix], value.mean[ix], value.std[ix]))
+    reader.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,611 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS output sinks
+
+Sinks take publish batches, lists of (tag name, value, unit, timestamp).
+CissMqttSink packs all values of a node per publish into one MQTT message
+and coalesces the publishes of a node while the broker has not taken the
+last message. CissLoopbackClient is an in-process stand-in for the paho
+MQTT client. CissSqliteSink keeps a local history in SQLite. Sinks with
+packed format take the packed binary snapshots of the nodes instead
+(CissPackedSchema), CissUdpSink sends them as datagrams.
+'''
+
+'''
+Change log
+0.3.3 - 2021-01-13 - cg
+    Retention deletes by rowid up to the first value not expired
+    
+0.3.2 - 2021-01-05 - cg
+    Retention selects the rows to delete by time
+    
+0.3.1 - 2021-01-01 - cg
+    Sink interface publish without error
+    
+0.3.0 - 2020-12-08 - cg
+    Packed snapshot format for the MQTT sink, UDP sink
+    
+0.2.0 - 2020-11-28 - cg
+    Add SQLite history sink
+    
+0.1.0 - 2020-11-18 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.3.3'
+__status__ = "beta"
+
+import sys
+import json
+import socket
+import threading
+
+from collections import deque
+
+from .chgrcodebase import *
+
+mqtt = AppUtil.lazy_import('paho.mqtt.client')
+sqlite3 = AppUtil.lazy_import('sqlite3')
+
+
+class CissSink(AppBase):
+    '''
+    Output sink interface
+    '''
+    def __init__(self, id='sink', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.available = True
+        self.messages_sent = 0
+        self.values_sent = 0
+        # takes packed snapshots instead of the batches
+        self.packed = False
+        return
+
+    def publish(self, batch, node=None):
+        '''
+        Publish a batch of the node, returns False if the sink is not available
+        '''
+        return True
+
+    def publish_packed(self, data, schema, node=None):
+        '''
+        Publish a packed snapshot of the node, data is the buffer of schema
+        (CissPackedSchema), valid until the next snapshot of the node
+        '''
+        return True
+
+    def set_available(self, available):
+        if available != self.available:
+            if available:
+                self.log_info('Sink %s available!', self.get_base_id())
+            else:
+                self.log_warning('Sink %s not available!', self.get_base_id())
+            self.available = available
+        return available
+
+    def close(self):
+        return True
+
+
+class CissMqttSink(CissSink):
+    '''
+    One JSON message per node and publish to topic (with {node}),
+    {"node": node, "timestamp": s, "values": {tag name: value}}.
+    While the last message of a node is not taken by the broker, new
+    batches of the node are merged into one pending message (latest
+    value per tag). With format packed the packed snapshots are sent
+    instead, the pending one replaced by the next, the schema document
+    is published retained to schema_topic before the first message and
+    after a change.
+    '''
+    _has_mqtt_mod = AppModuleAvailable('paho')
+
+    def __init__(self, id='mqtt', **kwargs):
+        CissSink.__init__(self, id, **kwargs)
+        conf = kwargs.get('conf', {})
+        self.host = conf.get('host', 'localhost')
+        self.port = int(conf.get('port', 1883))
+        self.topic = conf.get('topic', 'ciss/{node}')
+        self.qos = int(conf.get('qos', 0))
+        self.packed = conf.get('format', 'json') == 'packed'
+        self.schema_topic = conf.get('schema_topic', self.topic + '/schema')
+        self.ticks_coalesced = 0
+        self.bytes_sent = 0
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._inflight = {}
+        # node -> schema id published
+        self._schemas = {}
+        self._client = kwargs.get('client', None)
+        if self._client is None:
+            if not self._has_mqtt_mod:
+                raise AppBaseError('paho-mqtt Module not found!')
+            self._client = mqtt.Client(conf.get('client_id', ''))
+            self._client.max_inflight_messages_set(int(conf.get('max_inflight', 20)))
+            self._client.connect_async(self.host, self.port, int(conf.get('keepalive', 60)))
+            self._client.loop_start()
+        self._client.on_publish = self.on_publish
+        self.log_info('MQTT sink %s:%d topic %s, qos %d, %s', self.host, self.port, self.topic, self.qos,
+                      'packed' if self.packed else 'json')
+        return
+
+    def publish(self, batch, node=None):
+        if not batch or self.packed:
+            return True
+        node = node or 'ciss'
+        with self._lock:
+            pending = self._pending.get(node, None)
+            if pending is None:
+                pending = self._pending[node] = {}
+            else:
+                self.ticks_coalesced += 1
+            for tag_name, value, unit, timestamp in batch:
+                pending[tag_name] = (value, timestamp)
+            return self._send(node)
+
+    def publish_packed(self, data, schema, node=None):
+        if not self.packed:
+            return True
+        node = node or 'ciss'
+        with self._lock:
+            if self._schemas.get(node, None) != schema.schema_id:
+                info = self._client.publish(self.schema_topic.format(node=node), json.dumps(schema.describe()), 1, True)
+                if info.rc != 0:
+                    return self.set_available(False)
+                self._schemas[node] = schema.schema_id
+            if node in self._pending:
+                self.ticks_coalesced += 1
+            self._pending[node] = (data.tobytes(), len(schema.fields))
+            return self._send(node)
+
+    def _send(self, node):
+        info = self._inflight.get(node, None)
+        if info is not None and not info.is_published():
+            # broker is slow, coalesce with the next publish
+            return True
+        values = self._pending.pop(node, None)
+        if not values:
+            return True
+        if self.packed:
+            payload, count = values
+        else:
+            count = len(values)
+            payload = json.dumps({'node': node,
+                                  'timestamp': max([value[1] for value in values.values()]),
+                                  'values': dict((name, value[0]) for name, value in values.items())},
+                                 separators=(',', ':'))
+        info = self._client.publish(self.topic.format(node=node), payload, self.qos)
+        if info.rc != 0:
+            self._pending[node] = values
+            return self.set_available(False)
+        self._inflight[node] = info
+        self.messages_sent += 1
+        self.values_sent += count
+        self.bytes_sent += len(payload)
+        return self.set_available(True)
+
+    def on_publish(self, client, userdata, mid):
+        '''
+        Send the coalesced batches of a node once the broker took the last message
+        '''
+        with self._lock:
+            for node, info in list(self._inflight.items()):
+                if info.mid == mid and node in self._pending:
+                    self._send(node)
+        return True
+
+    def close(self):
+        with self._lock:
+            for node in list(self._pending.keys()):
+                self._inflight.pop(node, None)
+                self._send(node)
+        if hasattr(self._client, 'loop_stop'):
+            self._client.disconnect()
+            self._client.loop_stop()
+        return True
+
+
+class CissSqliteSink(CissSink):
+    '''
+    Local history of the published values. Tag names are kept in table
+    sensors, the values in samples (sensor, time ms, value) with a
+    (sensor, time) index. The values are inserted in one transaction per 
+    batch_rows rows or commit_interval seconds, WAL journal. Values older 
+    than retention_days are deleted every retention_interval seconds in 
+    transactions of delete_chunk rows, at most delete_time seconds per run.
+    '''
+    _has_sqlite_mod = AppModuleAvailable('sqlite3')
+
+    def __init__(self, id='sqlite', **kwargs):
+        CissSink.__init__(self, id, **kwargs)
+        conf = kwargs.get('conf', {})
+        if not self._has_sqlite_mod:
+            raise AppBaseError('sqlite3 Module not found!')
+        self.path = conf.get('path', 'ciss_history.db')
+        self.batch_rows = int(conf.get('batch_rows', 1000))
+        self.commit_interval = float(conf.get('commit_interval', 5.0))
+        self.retention_days = float(conf.get('retention_days', 7))
+        self.retention_interval = float(conf.get('retention_interval', 60))
+        self.delete_chunk = int(conf.get('delete_chunk', 2000))
+        self.delete_time = float(conf.get('delete_time', 0.05))
+        self.commits = 0
+        self.rows_deleted = 0
+        self.values_dropped = 0
+        # longest delete transaction (s)
+        self.delete_max = 0.0
+        self._lock = threading.RLock()
+        self._rows = []
+        self._sensors = {}
+        self._last_commit = AppUtil.monotonic()
+        self._last_retention = 0
+        # autocommit, transactions are started explicitly
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sensors (id INTEGER PRIMARY KEY, name TEXT UNIQUE, node TEXT, unit TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS samples (sensor INTEGER, time INTEGER, value REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS samples_sensor_time ON samples (sensor, time)')
+        for sensor_id, name in self._db.execute('SELECT id, name FROM sensors'):
+            self._sensors[name] = sensor_id
+        self.log_info('SQLite sink %s, %d sensors, retention %.1f days', self.path, len(self._sensors), self.retention_days)
+        return
+
+    def sensor_id(self, name, node=None, unit=None):
+        sensor_id = self._sensors.get(name, None)
+        if sensor_id is None:
+            self._db.execute('INSERT OR IGNORE INTO sensors (name, node, unit) VALUES (?, ?, ?)', (name, node, unit))
+            sensor_id = self._sensors[name] = self._db.execute('SELECT id FROM sensors WHERE name = ?', (name,)).fetchone()[0]
+        return sensor_id
+
+    def publish(self, batch, node=None):
+        if not batch:
+            return True
+        with self._lock:
+            try:
+                rows = self._rows
+                for tag_name, value, unit, timestamp in batch:
+                    rows.append((self.sensor_id(tag_name, node, unit), int(timestamp * 1000), value))
+                self.messages_sent += 1
+                self.values_sent += len(batch)
+                if len(rows) >= self.batch_rows or AppUtil.monotonic() - self._last_commit >= self.commit_interval:
+                    self.commit()
+            except sqlite3.Error:
+                if self.available:
+                    self.log_exception('SQLite sink %s write failed!', self.path)
+                self.values_dropped += len(self._rows)
+                self._rows = []
+                return self.set_available(False)
+        return self.set_available(True)
+
+    def commit(self):
+        '''
+        Insert the pending rows in one transaction, delete the expired
+        values if due
+        '''
+        with self._lock:
+            if self._rows:
+                self._db.execute('BEGIN')
+                try:
+                    self._db.executemany('INSERT INTO samples (sensor, time, value) VALUES (?, ?, ?)', self._rows)
+                    self._db.execute('COMMIT')
+                except sqlite3.Error:
+                    self._db.execute('ROLLBACK')
+                    raise
+                self._rows = []
+                self.commits += 1
+            self._last_commit = AppUtil.monotonic()
+            if self.retention_days and self._last_commit - self._last_retention >= self.retention_interval:
+                self._last_retention = self._last_commit
+                self.enforce_retention()
+        return True
+
+    def enforce_retention(self, now=None):
+        '''
+        Delete values older than retention_days in short transactions,
+        oldest rows first. The rows are deleted in rowid order up to the
+        first value not expired, found by a scan from the oldest row that
+        stops there (there is no time index). Values written after a newer
+        value are kept until that value has expired.
+        Returns the number of rows deleted.
+        '''
+        cutoff = int(((time.time() if now is None else now) - self.retention_days * 86400) * 1000)
+        deleted = 0
+        start = AppUtil.monotonic()
+        with self._lock:
+            row = self._db.execute('SELECT rowid FROM samples WHERE time >= ? ORDER BY rowid LIMIT 1', (cutoff,)).fetchone()
+            if row is None:
+                # all values expired
+                row = self._db.execute('SELECT max(rowid) + 1 FROM samples').fetchone()
+            bound = row[0]
+            if bound is None:
+                return 0
+            while True:
+                t = AppUtil.monotonic()
+                count = self._db.execute('DELETE FROM samples WHERE rowid IN '
+                                         '(SELECT rowid FROM samples WHERE rowid < ? ORDER BY rowid LIMIT ?)',
+                                         (bound, self.delete_chunk)).rowcount
+                self.delete_max = max(self.delete_max, AppUtil.monotonic() - t)
+                deleted += count
+                if count < self.delete_chunk or AppUtil.monotonic() - start >= self.delete_time:
+                    break
+        self.rows_deleted += deleted
+        return deleted
+
+    def query(self, name, start=None, end=None):
+        '''
+        Values of a tag between start and end (s), list of (timestamp (s), value)
+        '''
+        with self._lock:
+            sensor_id = self._sensors.get(name, None)
+            if sensor_id is None:
+                return []
+            rows = self._db.execute('SELECT time, value FROM samples WHERE sensor = ? AND time BETWEEN ? AND ? ORDER BY time',
+                                    (sensor_id, int(start * 1000) if start is not None else 0,
+                                     int(end * 1000) if end is not None else 2**62)).fetchall()
+        return [(timestamp / 1000.0, value) for timestamp, value in rows]
+
+    def sensors(self):
+        with self._lock:
+            return sorted(self._sensors.keys())
+
+    def close(self):
+        with self._lock:
+            try:
+                self.commit()
+            except sqlite3.Error:
+                self.log_exception('SQLite sink %s commit failed!', self.path)
+            self._db.close()
+        return True
+
+
+class CissUdpSink(CissSink):
+    '''
+    Packed snapshots as UDP datagrams to host:port, the schema document
+    (JSON) of a node is sent before the first snapshot, after a change and
+    every schema_interval seconds
+    '''
+    def __init__(self, id='udp', **kwargs):
+        CissSink.__init__(self, id, **kwargs)
+        conf = kwargs.get('conf', {})
+        self.address = (conf.get('host', '127.0.0.1'), int(conf.get('port', 50700)))
+        self.schema_interval = float(conf.get('schema_interval', 60))
+        self.bytes_sent = 0
+        self.packed = True
+        # node -> (schema id, time sent)
+        self._schemas = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.log_info('UDP sink %s:%d', *self.address)
+        return
+
+    def publish(self, batch, node=None):
+        return True
+
+    def publish_packed(self, data, schema, node=None):
+        node = node or 'ciss'
+        try:
+            sent = self._schemas.get(node, None)
+            now = AppUtil.monotonic()
+            if sent is None or sent[0] != schema.schema_id or now - sent[1] >= self.schema_interval:
+                self._socket.sendto(json.dumps(schema.describe()).encode('utf-8'), self.address)
+                self._schemas[node] = (schema.schema_id, now)
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            if self.available:
+                self.log_exception('UDP sink %s:%d send failed!', *self.address)
+            return self.set_available(False)
+        self.messages_sent += 1
+        self.values_sent += len(schema.fields)
+        self.bytes_sent += len(data)
+        return self.set_available(True)
+
+    def close(self):
+        self._socket.close()
+        return True
+
+
+# sink name of the configuration -> class
+_sink_types = {
+    'mqtt': CissMqttSink,
+    'sqlite': CissSqliteSink,
+    'udp': CissUdpSink
+    }
+
+
+def create_sinks(conf, **kwargs):
+    '''
+    Sinks of the configuration, dict sink type -> sink configuration
+    '''
+    sinks = []
+    for name, sink_conf in (conf or {}).items():
+        if name not in _sink_types:
+            raise AppBaseError('Output sink %s unknown!'% name)
+        if sink_conf and sink_conf.get('enabled', True):
+            sinks.append(_sink_types[name](name, conf=sink_conf, **kwargs))
+    return sinks
+
+
+class CissLoopbackMessage(object):
+    __slots__ = ('mid', 'rc', '_published')
+
+    def __init__(self, mid, rc=0):
+        self.mid = mid
+        self.rc = rc
+        self._published = False
+
+    def is_published(self):
+        return self._published
+
+
+class CissLoopbackClient(object):
+    '''
+    In-process stand-in for paho.mqtt.client.Client. Messages are kept in
+    messages (topic, payload), a message is taken by the broker after
+    cost_per_message + cost_per_byte * bytes seconds of broker time,
+    deliver(now) completes all messages up to now.
+    '''
+    def __init__(self, cost_per_message=0.0, cost_per_byte=0.0):
+        self.cost_per_message = cost_per_message
+        self.cost_per_byte = cost_per_byte
+        self.messages = []
+        self.broker_time = 0.0
+        self.on_publish = None
+        self._mid = 0
+        self._queue = deque()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self._mid += 1
+        info = CissLoopbackMessage(self._mid)
+        self.messages.append((topic, payload))
+        self.broker_time += self.cost_per_message + self.cost_per_byte * len(payload)
+        self._queue.append((self.broker_time, info))
+        return info
+
+    def deliver(self, now=None):
+        while self._queue and (now is None or self._queue[0][0] <= now):
+            done, info = self._queue.popleft()
+            info._published = True
+            if self.on_publish is not None:
+                self.on_publish(self, None, info.mid)
+        return True
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-H", dest="host", metavar="Broker", default=None, help="MQTT broker, in-process stand-in if not set!")
+    parser.add_argument("-n", dest="ticks", metavar="Ticks", type=int, default=1000, help="Number of publish ticks!")
+    parser.add_argument("-t", dest="tags", metavar="Tags", type=int, default=60, help="Tags per node and tick!")
+    parser.add_argument("-s", dest="sqlite", metavar="Database", default=None, help="SQLite benchmark with a simulated week in Database!")
+    parser.add_argument("-i", dest="interval", metavar="Seconds", type=float, default=30, help="SQLite publish interval!")
+    parser.add_argument("-D", dest="days", metavar="Days", type=float, default=7, help="SQLite simulated days!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+def bench_sqlite(cargs):
+    '''
+    Insert a simulated week, time range queries and retention
+    '''
+    import os
+    import random
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(cargs.sqlite + suffix):
+            os.remove(cargs.sqlite + suffix)
+    sink = CissSqliteSink(conf={'path': cargs.sqlite, 'retention_days': 0, 'batch_rows': 5000})
+    names = ['CissSIM0-S%02d-mean'% ix for ix in range(cargs.tags)]
+    ticks = int(cargs.days * 86400 / cargs.interval)
+    start = time.time() - cargs.days * 86400
+    t = AppTimer()
+    t.start()
+    for tick in range(ticks):
+        timestamp = start + tick * cargs.interval
+        sink.publish([(name, 1000 + (tick + ix) % 100, 'mg', timestamp) for ix, name in enumerate(names)], 'CissSIM0')
+    sink.commit()
+    elapsed = t.stop()
+    rows = ticks * len(names)
+    print('insert: %d rows (%.0f days, %d tags every %.0f s) in %.1f s, %.0f rows/s, %d commits, %.1f MB'% (rows,
+          cargs.days, len(names), cargs.interval, elapsed / 1000, rows * 1000 / elapsed, sink.commits,
+          (os.path.getsize(cargs.sqlite) + os.path.getsize(cargs.sqlite + '-wal')) / 1e6))
+    rnd = random.Random(1)
+    for span in (3600, 86400):
+        times = []
+        for ix in range(50):
+            begin = start + rnd.uniform(0, cargs.days * 86400 - span)
+            t = AppTimer()
+            t.start()
+            values = sink.query(rnd.choice(names), begin, begin + span)
+            times.append(t.stop())
+        times.sort()
+        print('query %5d s: %d values, median %.2f ms, p95 %.2f ms'% (span, len(values), times[len(times) // 2],
+              times[int(len(times) * 0.95)]))
+    sink.retention_days = cargs.days - 1
+    sink.delete_time = 3600
+    t = AppTimer()
+    t.start()
+    deleted = sink.enforce_retention(start + cargs.days * 86400)
+    elapsed = t.stop()
+    print('retention: %d rows deleted in %.1f s, chunks of %d rows, longest transaction %.1f ms'% (deleted, elapsed / 1000,
+          sink.delete_chunk, sink.delete_max * 1000))
+    # steady state, one run without and 20 runs with the values of one
+    # retention interval expired
+    end = start + cargs.days * 86400
+    times = []
+    deleted = 0
+    for ix in range(21):
+        t = AppTimer()
+        t.start()
+        deleted += sink.enforce_retention(end + ix * sink.retention_interval)
+        times.append(t.stop())
+    runs = sorted(times[1:])
+    print('retention steady state: no rows expired %.2f ms, %d runs of %.0f s (%d rows) median %.2f ms, max %.2f ms'% (
+          times[0], len(runs), sink.retention_interval, deleted, runs[len(runs) // 2], runs[-1]))
+    sink.close()
+    return True
+
+'''
+Compare per tag publishing with packed node messages, python -m lib.cissSinks
+SQLite history benchmark, python -m lib.cissSinks -s /tmp/ciss_history.db
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    if cargs.sqlite:
+        bench_sqlite(cargs)
+        return 0
+    batch = [('CissACM0-ACCL-%d'% ix, 1000 + ix, 'mg', 1605000000.0) for ix in range(cargs.tags)]
+
+    def new_client():
+        if cargs.host is None:
+            # 50 us per message and 10 ns per byte of broker time
+            return CissLoopbackClient(50e-6, 10e-9)
+        client = mqtt.Client()
+        client.connect(cargs.host)
+        client.loop_start()
+        return client
+
+    client = new_client()
+    t = AppTimer()
+    t.start()
+    for tick in range(cargs.ticks):
+        for tag_name, value, unit, timestamp in batch:
+            client.publish('ciss/CissACM0/%s'% tag_name, json.dumps({'value': value, 'timestamp': timestamp}), 0)
+    elapsed = t.stop()
+    print('per tag : %d messages in %.1f ms, %.0f values/s%s'% (cargs.ticks * cargs.tags, elapsed,
+          cargs.ticks * cargs.tags * 1000 / elapsed,
+          ', broker %.1f ms'% (client.broker_time * 1000) if cargs.host is None else ''))
+
+    sink = CissMqttSink(client=new_client(), conf={'host': cargs.host or 'loopback'})
+    t = AppTimer()
+    t.start()
+    for tick in range(cargs.ticks):
+        sink.publish(batch, 'CissACM0')
+        if cargs.host is None:
+            sink._client.deliver()
+    elapsed = t.stop()
+    print('packed  : %d messages in %.1f ms, %.0f values/s%s'% (sink.messages_sent, elapsed,
+          sink.values_sent * 1000 / elapsed,
+          ', broker %.1f ms'% (sink._client.broker_time * 1000) if cargs.host is None else ''))
+
+    if cargs.host is None:
+        # broker takes 3 ticks per message
+        sink = CissMqttSink(client=CissLoopbackClient(3.0), conf={'host': 'slow loopback'})
+        for tick in range(cargs.ticks):
+            sink.publish(batch, 'CissACM0')
+            sink._client.deliver(tick)
+        print('slow    : %d ticks in %d messages, %d ticks coalesced'% (cargs.ticks, sink.messages_sent, sink.ticks_coalesced))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
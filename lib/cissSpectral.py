@@ -0,0 +1,248 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS spectral features
+
+Optional NumPy based frequency domain features (band RMS, dominant
+frequency, RMS and crest factor) per axis of a CISS xyz sensor, computed
+on overlapping windows at a configurable hop. The read thread only fills
+the windows, the features of a window are computed on first use by the
+publisher, at the sample rate measured over the window.
+'''
+
+'''
+Change log
+0.3.0 - 2020-12-28 - cg
+    Features computed on first use, at the measured sample rate
+    
+0.2.0 - 2020-11-10 - cg
+    Import NumPy on first use
+    
+0.1.0 - 2020-11-02 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.3.0'
+__status__ = "beta"
+
+import sys
+
+from .chgrcodebase import *
+
+numpy = AppUtil.lazy_import('numpy')
+
+SPECTRAL_AXES = ('x', 'y', 'z')
+SPECTRAL_DEF_BANDS = 4
+
+
+def spectral_value_names(conf):
+    '''
+    Published feature names for a spectral configuration
+    '''
+    bands = conf.get('bands', None)
+    band_count = len(bands) if bands else SPECTRAL_DEF_BANDS
+    return ['rms', 'crest', 'dom_freq'] + ['band%d'% ix for ix in range(band_count)]
+
+
+class CissSpectralWindow(object):
+    '''
+    Samples of a full window, the features are calculated on the first
+    get_features(), not by the thread that filled the window
+    '''
+    __slots__ = ('stage', 'data', 'sample_rate', 'features')
+
+    def __init__(self, stage, data, sample_rate):
+        self.stage = stage
+        self.data = data
+        self.sample_rate = sample_rate
+        self.features = None
+        return
+
+    def get_features(self, axis):
+        features = self.features
+        if features is None:
+            features = self.features = self.stage.compute(self.data, self.sample_rate)
+        return features[axis]
+
+
+class CissSpectralStage(AppBase):
+    _has_numpy_mod = AppModuleAvailable('numpy')
+
+    def __init__(self, id='spectral', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        if not self._has_numpy_mod:
+            raise AppBaseError('NumPy Module not found!')
+        conf = kwargs.get('conf', {})
+        self.conf = conf
+        self.sample_rate = float(kwargs.get('sample_rate', 10))
+        self.window_size = int(conf.get('window', 256))
+        self.hop = int(conf.get('hop', self.window_size // 2))
+        if self.hop <= 0 or self.hop > self.window_size:
+            raise AppBaseError('Invalid spectral hop %d for window %d'% (self.hop, self.window_size))
+        bands = conf.get('bands', None)
+        if not bands:
+            step = self.sample_rate / 2 / SPECTRAL_DEF_BANDS
+            bands = [(ix*step, (ix+1)*step) for ix in range(SPECTRAL_DEF_BANDS)]
+        self.names = spectral_value_names(conf)
+        # measured sample rate within this deviation calculates at the nominal rate
+        self.rate_tolerance = float(conf.get('rate_tolerance', 0.02))
+
+        self._bands = bands
+        self._window = numpy.hanning(self.window_size)
+        self._power_norm = 2.0 / (self.window_size * numpy.sum(self._window**2))
+        self._freqs, self._band_slices = self.calc_bins(self.sample_rate)
+        self._buffer = numpy.zeros((3, self.window_size))
+        self._times = numpy.zeros(self.window_size)
+        self._filled = 0
+        self._pending = ([], [], [], [])
+        self.window = None
+        self.windows = 0
+        self.compute_ms = 0.0
+        self.compute_max_ms = 0.0
+        self._hop_ms = self.hop * 1000.0 / self.sample_rate
+        self.log_info('Spectral stage %s window %d, hop %d, %.1f Hz, bands %s',
+                      id, self.window_size, self.hop, self.sample_rate, bands)
+        return
+
+    def add(self, x, y, z, timestamp=None):
+        pending = self._pending
+        pending[0].append(x)
+        pending[1].append(y)
+        pending[2].append(z)
+        pending[3].append(timestamp or 0.0)
+        if len(pending[0]) >= self.hop:
+            self._shift()
+        return True
+
+    def _shift(self):
+        hop = self.hop
+        self._buffer[:, :-hop] = self._buffer[:, hop:]
+        self._buffer[:, -hop:] = self._pending[:3]
+        self._times[:-hop] = self._times[hop:]
+        self._times[-hop:] = self._pending[3]
+        self._pending = ([], [], [], [])
+        self._filled = min(self._filled + hop, self.window_size)
+        if self._filled >= self.window_size:
+            self.window = CissSpectralWindow(self, self._buffer.copy(), self.measure_rate())
+            self.windows += 1
+        return True
+
+    def measure_rate(self):
+        '''
+        Sample rate of the timestamps of the window, the nominal rate 
+        without timestamps or within the rate tolerance
+        '''
+        duration = self._times[-1] - self._times[0]
+        if not self._times[0] or duration <= 0:
+            return self.sample_rate
+        rate = (self.window_size - 1) / duration
+        if abs(rate / self.sample_rate - 1.0) <= self.rate_tolerance:
+            return self.sample_rate
+        return rate
+
+    def calc_bins(self, sample_rate):
+        '''
+        Frequencies of the FFT bins and the bin slices of the bands (Hz)
+        '''
+        freqs = numpy.fft.rfftfreq(self.window_size, 1.0 / sample_rate)
+        band_slices = [slice(numpy.searchsorted(freqs, low), numpy.searchsorted(freqs, high, side='right'))
+                       for low, high in self._bands]
+        return freqs, band_slices
+
+    def compute(self, data, sample_rate=None):
+        '''
+        Features of a window, timed against the hop time
+        '''
+        t = AppTimer()
+        t.start()
+        features = self.calc_features(data, sample_rate)
+        self.compute_ms = t.stop()
+        self.compute_max_ms = max(self.compute_max_ms, self.compute_ms)
+        if self.compute_ms > self._hop_ms / 2:
+            self.log_warning('Spectral window took %.2f ms of %.2f ms hop time!', self.compute_ms, self._hop_ms)
+        return features
+
+    def calc_features(self, data, sample_rate=None):
+        '''
+        Returns dict axis -> dict feature name -> value
+        '''
+        if sample_rate is None or sample_rate == self.sample_rate:
+            freqs, band_slices = self._freqs, self._band_slices
+        else:
+            freqs, band_slices = self.calc_bins(sample_rate)
+        data = data - data.mean(axis=1)[:, None]
+        rms = numpy.sqrt(numpy.mean(data**2, axis=1))
+        peak = numpy.max(numpy.abs(data), axis=1)
+        power = numpy.abs(numpy.fft.rfft(data * self._window, axis=1))**2 * self._power_norm
+        dom_freq = freqs[numpy.argmax(power[:, 1:], axis=1) + 1]
+        bands = [numpy.sqrt(power[:, band].sum(axis=1)) for band in band_slices]
+        features = {}
+        for ix, axis in enumerate(SPECTRAL_AXES):
+            values = [rms[ix], peak[ix] / rms[ix] if rms[ix] else 0.0, dom_freq[ix]]
+            values.extend([band[ix] for band in bands])
+            features[axis] = dict(zip(self.names, [float(value) for value in values]))
+        return features
+
+    def get_window(self):
+        '''
+        Latest full window, None before the first
+        '''
+        return self.window
+
+    def get_features(self, axis):
+        if self.window is None:
+            return None
+        return self.window.get_features(axis)
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-r", dest="sample_rate", metavar="Sample Rate", type=float, default=2000, help="Sample rate in Hz!")
+    parser.add_argument("-w", dest="window", metavar="Window", type=int, default=256, help="FFT window size!")
+    parser.add_argument("-s", dest="hop", metavar="Hop", type=int, default=128, help="Window hop size!")
+    parser.add_argument("-n", dest="seconds", metavar="Seconds", type=int, default=10, help="Seconds of samples to process!")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    return parser.parse_args(assigned_args)
+
+'''
+Benchmark the spectral stage against the sample rate, python -m lib.cissSpectral
+'''
+def main(assigned_args = None):
+    # type: (List)
+    import math
+    cargs = main_argparse(assigned_args)
+    stage = CissSpectralStage(conf={'window': cargs.window, 'hop': cargs.hop}, sample_rate=cargs.sample_rate)
+    count = int(cargs.sample_rate * cargs.seconds)
+    samples = [(int(1000*math.sin(2*math.pi*50*ix/cargs.sample_rate)),
+                int(500*math.sin(2*math.pi*120*ix/cargs.sample_rate)),
+                1000) for ix in range(count)]
+    t = AppTimer()
+    t.start()
+    window = None
+    for x, y, z in samples:
+        stage.add(x, y, z)
+        if stage.window is not window:
+            window = stage.window
+            window.get_features('x')
+    elapsed = t.stop()
+    print('%d samples, %d windows in %.1f ms (%.2f us per sample, %.3f ms per window, max %.3f ms)'%
+          (count, stage.windows, elapsed, elapsed * 1000 / count, stage.compute_ms, stage.compute_max_ms))
+    print('Stream time %.1f ms, CPU load %.2f %%'% (cargs.seconds * 1000.0, elapsed / (cargs.seconds * 10.0)))
+    print('x: %s'% stage.get_features('x'))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,550 @@
+#!/usr/bin/env python2
+'''
+Bosch CISS virtual node stress test
+
+Runs the gateway (TpgCissContext with a fake TagV2, or AppCissContext)
+against N virtual nodes. Each virtual node is a pseudo terminal, a load
+generator process writes valid CISS stream frames to the master side at
+the configured rate per stream. The rates are raised step by step until
+frames get lost or the publish latency exceeds its limit, then the last
+good step and the bottleneck stage are reported.
+python -m lib.cissStress -n 4 -r acc=50 gyr=50 mag=50
+'''
+
+'''
+Change log
+0.1.0 - 2020-11-22 - cg
+    Initial version
+'''
+
+__author__ = "Christian G."
+__license__ = "MIT"
+__version__ = '0.1.0'
+__status__ = "beta"
+
+import sys
+import os
+import json
+import time
+import types
+import errno
+import struct
+import select
+import tempfile
+import threading
+import multiprocessing
+
+from .chgrcodebase import *
+from .cissBenchmark import ciss_frame
+
+# stream -> default frames per second, as configured by CISSNode
+CISS_STREAM_RATES = (
+    ('acc', 10.0),
+    ('mag', 10.0),
+    ('gyr', 10.0),
+    ('env', 1.0),
+    ('light', 1.0)
+    )
+
+# inertial stream -> sensor configuration of the stream period
+_STREAM_SENSORS = {'acc': 'Accl', 'mag': 'Magn', 'gyr': 'Gyro'}
+
+
+def ciss_stream_frames(stream, variants=8):
+    '''
+    Frames of a stream with varying values
+    '''
+    frames = []
+    for ix in range(variants):
+        if stream in ('acc', 'mag', 'gyr'):
+            data_type = {'acc': 0x02, 'mag': 0x03, 'gyr': 0x04}[stream]
+            data = struct.pack('<hhh', 100 * ix, -50 * ix, 1000 + ix)
+        elif stream == 'env':
+            # temperature, pressure and humidity in one frame
+            data_type = 0x05
+            data = struct.pack('<hBiBh', 215 + ix, 0x06, 101325 + ix, 0x07, 4500 + 10 * ix)
+        else:
+            data_type = 0x08
+            data = struct.pack('<I', 300 + ix)
+        frames.append(bytes(ciss_frame(data_type, bytearray(data))))
+    return frames
+
+
+class CissFakeTagV2(object):
+    '''
+    Stand-in for libmxidaf_py.TagV2, publish takes cost seconds (busy, like
+    a call into the tag service)
+    '''
+    _instance = None
+
+    def __init__(self, cost=0.0):
+        self.cost = cost
+        self.published = 0
+        self.busy = 0.0
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def publish(self, template_name, tag_name, tag):
+        self.published += 1
+        if self.cost:
+            start = AppUtil.monotonic()
+            end = start + self.cost
+            while AppUtil.monotonic() < end:
+                pass
+            self.busy += AppUtil.monotonic() - start
+        return True
+
+
+class _FakeValue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class _FakeTime(object):
+    def __init__(self, ms=None):
+        self.ms = int(time.time() * 1000) if ms is None else ms
+
+    @staticmethod
+    def now():
+        return _FakeTime()
+
+
+class _FakeTag(object):
+    def __init__(self, value, at, unit):
+        self.value = value
+        self.at = at
+        self.unit = unit
+
+
+def install_fake_tagv2():
+    '''
+    Provide libmxidaf_py with the fake TagV2 if the ThingsPro library is
+    not installed, returns False if the real library is used
+    '''
+    if AppUtil.module_exists('libmxidaf_py'):
+        return False
+    module = types.ModuleType('libmxidaf_py')
+    module.TagV2 = CissFakeTagV2
+    module.Tag = _FakeTag
+    module.Value = _FakeValue
+    module.Time = _FakeTime
+    sys.modules['libmxidaf_py'] = module
+    return True
+
+
+def _run_load(masters, streams, scale, sent, overruns, stop, tick):
+    '''
+    Load generator process, writes the frames due per tick to the pseudo
+    terminals. A frame not taken by a full terminal is lost like on a
+    serial overrun.
+    '''
+    import fcntl
+    for fd in masters:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    carry = [[0.0] * len(streams) for fd in masters]
+    positions = [[0] * len(streams) for fd in masters]
+    last = AppUtil.monotonic()
+    while not stop.is_set():
+        try:
+            readable = select.select(masters, [], [], tick)[0]
+        except select.error:
+            readable = []
+        for fd in readable:
+            # discard the configuration commands of the nodes
+            try:
+                os.read(fd, 4096)
+            except OSError:
+                pass
+        now = AppUtil.monotonic()
+        elapsed = now - last
+        last = now
+        factor = scale.value
+        for node, fd in enumerate(masters):
+            frames = []
+            for ix, (rate, variants) in enumerate(streams):
+                carry[node][ix] += rate * factor * elapsed
+                count = int(carry[node][ix])
+                if not count:
+                    continue
+                carry[node][ix] -= count
+                pos = positions[node][ix]
+                frames.extend(variants[(pos + n) % len(variants)] for n in range(count))
+                positions[node][ix] = pos + count
+            if not frames:
+                continue
+            try:
+                written = os.write(fd, b''.join(frames))
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                written = 0
+            complete = 0
+            for frame in frames:
+                if written < len(frame):
+                    break
+                written -= len(frame)
+                complete += 1
+            sent[node] += complete
+            overruns[node] += len(frames) - complete
+    return True
+
+
+class CissVirtualNodes(AppBase):
+    '''
+    Pseudo terminals of the virtual nodes and the load generator process,
+    rates: list of (stream, frames per second)
+    '''
+    def __init__(self, count, rates, id='virtualNodes', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        import pty
+        import tty
+        self.rates = rates
+        self.tick = kwargs.get('tick', 0.005)
+        self.ports = []
+        self._masters = []
+        self._slaves = []
+        for ix in range(count):
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            self._masters.append(master)
+            self._slaves.append(slave)
+            self.ports.append(os.ttyname(slave))
+        self._scale = multiprocessing.Value('d', 0.0, lock=False)
+        self._sent = multiprocessing.Array('d', count, lock=False)
+        self._overruns = multiprocessing.Array('d', count, lock=False)
+        self._stop = multiprocessing.Event()
+        self._process = None
+        return
+
+    def frames_per_second(self):
+        '''
+        Frames per second and node at scale 1
+        '''
+        return sum(rate for stream, rate in self.rates)
+
+    def start(self):
+        '''
+        Start the load generator, before the gateway threads are started
+        '''
+        streams = [(rate, ciss_stream_frames(stream)) for stream, rate in self.rates]
+        self._process = multiprocessing.Process(target=_run_load,
+                                                args=(self._masters, streams, self._scale, self._sent,
+                                                      self._overruns, self._stop, self.tick))
+        self._process.daemon = True
+        self._process.start()
+        return True
+
+    def set_scale(self, scale):
+        self._scale.value = scale
+        return True
+
+    def get_counters(self):
+        '''
+        Returns lists of the frames sent and lost by overruns per node
+        '''
+        return list(self._sent), list(self._overruns)
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def stop(self):
+        self._stop.set()
+        if self._process is not None:
+            self._process.join(2)
+        for fd in self._masters + self._slaves:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._masters = []
+        self._slaves = []
+        return True
+
+
+def stress_context_class(tpg=True):
+    '''
+    Gateway context measuring the publish latency, with tpg the
+    TpgCissContext without equipment setup
+    '''
+    if tpg:
+        install_fake_tagv2()
+        from ciss_to_tpg import TpgCissContext as base
+    else:
+        from .cissUsbSensor import AppCissContext as base
+
+    class CissStressContext(base):
+        def __init__(self, args, **kwargs):
+            base.__init__(self, args, **kwargs)
+            self.stress_tagv2 = CissFakeTagV2(kwargs.get('tag_cost', 0.0))
+            # (snapshot age, publish seconds) per publish
+            self.stress_publishes = []
+            return
+
+        def init_context(self):
+            if not base.init_context(self):
+                return False
+            if tpg:
+                self._tpg_sink._tagV2_obj = self.stress_tagv2
+            return True
+
+        def tpg_init_equipment(self):
+            return True
+
+        def on_snapshot(self, snapshot):
+            start = AppUtil.monotonic()
+            if tpg:
+                base.on_snapshot(self, snapshot)
+            self.stress_publishes.append((time.time() - snapshot.timestamp, AppUtil.monotonic() - start))
+            return True
+
+    return CissStressContext
+
+
+class CissStressTest(AppBase):
+    '''
+    Ramp the rates of the virtual nodes by factor per step until a limit
+    is exceeded, max_loss: frame loss (%), max_latency: snapshot age at
+    publish (s)
+    '''
+    def __init__(self, cargs, id='stress', **kwargs):
+        AppBase.__init__(self, id, **kwargs)
+        self.cargs = cargs
+        self.rates = [(stream, float(cargs.rates.get(stream, rate))) for stream, rate in CISS_STREAM_RATES]
+        self.nodes = CissVirtualNodes(cargs.nodes, self.rates, logger=kwargs.get('logger', None))
+        self.context = None
+        self.results = []
+        self._config_file = None
+        self._thread = None
+        return
+
+    def write_config(self):
+        with open(self.cargs.config_file) as f:
+            ext_conf = json.load(f)
+        node_conf = list(ext_conf['ciss_nodes'].values())[0]
+        nodes = {}
+        for ix, port in enumerate(self.nodes.ports):
+            conf = json.loads(json.dumps(node_conf))
+            conf['name'] = 'CissSIM%d'% ix
+            conf['com_port'] = port
+            for stream, rate in self.rates:
+                sensor_conf = conf['sensors'].get(_STREAM_SENSORS.get(stream, None), None)
+                if sensor_conf is not None and rate:
+                    sensor_conf['stream_period'] = int(1000000 / rate)
+            nodes['cissSIM%d'% ix] = conf
+        ext_conf['ciss_nodes'] = nodes
+        ext_conf['tpg_publish_interval'] = self.cargs.publish_interval
+        ext_conf['event_log'] = ''
+        ext_conf['device_watch'] = False
+        ext_conf.pop('metrics', None)
+        ext_conf.pop('tpg_forward_queue', None)
+        ext_conf.pop('output_sinks', None)
+        fd, self._config_file = tempfile.mkstemp(prefix='ciss_stress_', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ext_conf, f, indent=1)
+        return self._config_file
+
+    def start(self):
+        self.nodes.start()
+        self.write_config()
+        context_class = stress_context_class(not self.cargs.app)
+        if self.cargs.app:
+            from .cissUsbSensor import main_argparse
+        else:
+            from ciss_to_tpg import main_argparse
+        args = main_argparse(['-c', self._config_file])
+        self.context = context_class(args, app_name='ciss_stress', tag_cost=self.cargs.tag_cost / 1e6,
+                                     logger=AppContext.initLogger(self.cargs.verbose_level, None, None, True))
+        if self.cargs.verbose_level is None:
+            # no snapshot printing
+            self.context._logger_level = AppLogLevel.WARNING.value
+        if not self.context.init_context():
+            raise AppBaseError('Gateway context init failed!')
+        self._thread = threading.Thread(name='gateway', target=self.context.run_context)
+        self._thread.daemon = True
+        self._thread.start()
+        self.nodes.set_scale(1.0)
+        end = AppUtil.monotonic() + 30
+        while AppUtil.monotonic() < end:
+            if all(ciss.first_frame_time is not None for ciss in self.context._ciss.values()):
+                return True
+            time.sleep(0.1)
+        raise AppBaseError('No frames decoded from the virtual nodes!')
+
+    def stop(self):
+        if self.context is not None:
+            # the read threads check for the stop after the next frame
+            self.nodes.set_scale(1.0)
+            self.context.do_exit(0)
+        if self._thread is not None:
+            self._thread.join(5)
+        self.nodes.stop()
+        if self._config_file:
+            os.remove(self._config_file)
+        return True
+
+    def get_counters(self):
+        ctx = self.context
+        nodes = [ctx._ciss['cissSIM%d'% ix] for ix in range(len(self.nodes.ports))]
+        sent, overruns = self.nodes.get_counters()
+        return {'sent': sum(sent), 'overruns': sum(overruns),
+                'frames': sum(ciss.frames for ciss in nodes),
+                'decode_errors': sum(ciss.decode_errors for ciss in nodes),
+                'missed': ctx._scheduler.missed,
+                'tag_busy': ctx.stress_tagv2.busy,
+                'cpu': sum(os.times()[:2]),
+                'time': AppUtil.monotonic()}
+
+    def run_step(self, scale):
+        '''
+        Load at scale for the step duration, the frames in flight are
+        drained before the counters are taken
+        '''
+        self.nodes.set_scale(scale)
+        time.sleep(1.0)
+        self.context.stress_publishes = []
+        start = self.get_counters()
+        time.sleep(self.cargs.duration)
+        self.nodes.set_scale(0.0)
+        publishes = self.context.stress_publishes
+        self.context.stress_publishes = []
+        time.sleep(0.5)
+        end = self.get_counters()
+        delta = dict((key, end[key] - start[key]) for key in start)
+        wall = delta['time'] - 0.5
+        offered = delta['sent'] + delta['overruns']
+        target = self.nodes.frames_per_second() * scale * len(self.nodes.ports) * wall
+        result = {
+            'scale': scale,
+            'wall': wall,
+            'target': target / wall,
+            'offered': offered / wall,
+            'decoded': delta['frames'] / wall,
+            # frames lost by overruns or still in the terminal buffer
+            'loss': max(0.0, 100.0 * (offered - delta['frames']) / offered) if offered else 0.0,
+            'overruns': delta['overruns'],
+            'decode_errors': delta['decode_errors'],
+            'missed': delta['missed'],
+            'latency_max': max([age for age, duration in publishes]) if publishes else None,
+            'latency_mean': sum([age for age, duration in publishes]) / len(publishes) if publishes else None,
+            'publish_time': sum([duration for age, duration in publishes]),
+            'tag_busy': delta['tag_busy'],
+            'cpu': 100.0 * delta['cpu'] / delta['time']
+            }
+        result['generator_limit'] = result['offered'] < 0.9 * result['target']
+        result['ok'] = (result['loss'] <= self.cargs.max_loss and not result['missed'] and
+                        result['latency_max'] is not None and
+                        result['latency_max'] * 1000 <= self.cargs.max_latency)
+        self.results.append(result)
+        return result
+
+    def bottleneck(self, result):
+        '''
+        Stage limiting the throughput in the failed step
+        '''
+        if result['generator_limit']:
+            return 'load generator (%.0f of %.0f frames/s offered), result not valid'% (result['offered'], result['target'])
+        if result['loss'] > self.cargs.max_loss:
+            if result['cpu'] < 80:
+                cause = 'read loop paced, process CPU %.0f%%'% result['cpu']
+            else:
+                cause = 'CPU bound, process CPU %.0f%%'% result['cpu']
+            return 'serial read (frame loss %.2f%%, %d overruns, %d checksum errors, %s)'% (
+                result['loss'], result['overruns'], result['decode_errors'], cause)
+        if result['publish_time'] and result['tag_busy'] > 0.5 * result['publish_time']:
+            return 'TagV2 publish (busy %.0f%% of the step time)'% (100 * result['tag_busy'] / result['wall'])
+        return 'publisher (snapshot age max %s ms, %d ticks missed, process CPU %.0f%%)'% (
+            '-' if result['latency_max'] is None else '%.0f'% (result['latency_max'] * 1000),
+            result['missed'], result['cpu'])
+
+    def run(self):
+        print('%d virtual nodes, %s frames/s per node at scale 1'% (len(self.nodes.ports),
+              ', '.join('%s %g'% (stream, rate) for stream, rate in self.rates)))
+        print('%6s %10s %10s %10s %7s %9s %9s %6s %5s'% ('scale', 'target/s', 'offered/s', 'decoded/s', 'loss %',
+              'lat mean', 'lat max', 'missed', 'cpu %'))
+        scale = 1.0
+        last_ok = None
+        for step in range(self.cargs.steps):
+            result = self.run_step(scale)
+            print('%6.2f %10.0f %10.0f %10.0f %7.2f %9s %9s %6d %5.0f'% (scale, result['target'], result['offered'],
+                  result['decoded'], result['loss'],
+                  '-' if result['latency_mean'] is None else '%.1f'% (result['latency_mean'] * 1000),
+                  '-' if result['latency_max'] is None else '%.1f'% (result['latency_max'] * 1000),
+                  result['missed'], result['cpu']))
+            if not result['ok'] or result['generator_limit']:
+                break
+            last_ok = result
+            scale *= self.cargs.factor
+        else:
+            result = None
+        if last_ok is None:
+            print('saturated at the first step')
+        else:
+            print('saturation point: %d nodes at scale %.2f, %s, %.0f frames/s decoded'% (len(self.nodes.ports),
+                  last_ok['scale'], ', '.join('%s %g Hz'% (stream, rate * last_ok['scale']) for stream, rate in self.rates),
+                  last_ok['decoded']))
+        if result is not None:
+            print('bottleneck: %s'% self.bottleneck(result))
+        else:
+            print('no limit reached in %d steps'% self.cargs.steps)
+        return last_ok
+
+
+'''
+'''
+def main_argparse(assigned_args = None):
+    # type: (List)
+    """
+    Parse and execute the call from command-line.
+    Args:
+        assigned_args: List of strings to parse. The default is taken from sys.argv.
+    Returns:
+        Namespace list of args
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="appcmd", description=globals()['__doc__'], epilog="!!Note: .....")
+    parser.add_argument("-c", dest="config_file", metavar="Config File", default='sensor.json', help="Node configuration template!")
+    parser.add_argument("-n", dest="nodes", metavar="Nodes", type=int, default=1, help="Number of virtual nodes!")
+    parser.add_argument("-r", dest="rates", metavar="Stream=Rate", nargs='+', default=[],
+                        help="Frames per second of the streams at scale 1 (acc, mag, gyr, env, light)!")
+    parser.add_argument("-f", dest="factor", metavar="Factor", type=float, default=2.0, help="Scale factor per step!")
+    parser.add_argument("-d", dest="duration", metavar="Seconds", type=float, default=10, help="Duration of a step!")
+    parser.add_argument("-s", dest="steps", metavar="Steps", type=int, default=8, help="Max. number of steps!")
+    parser.add_argument("-i", dest="publish_interval", metavar="Seconds", type=int, default=1, help="Publish interval!")
+    parser.add_argument("--max-loss", dest="max_loss", metavar="Percent", type=float, default=0.1, help="Frame loss limit!")
+    parser.add_argument("--max-latency", dest="max_latency", metavar="ms", type=float, default=500,
+                        help="Snapshot age at publish limit!")
+    parser.add_argument("--tag-cost", dest="tag_cost", metavar="us", type=float, default=50, help="Fake TagV2 time per tag!")
+    parser.add_argument("--app", dest="app", action="store_true", help="Run AppCissContext instead of TpgCissContext!")
+    parser.add_argument("-v", "--verbose", dest="verbose_level", action="count", default=None, help="Turn on console DEBUG mode. Max = -vvv")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+
+    cargs = parser.parse_args(assigned_args)
+    rates = {}
+    streams = dict(CISS_STREAM_RATES)
+    for item in cargs.rates:
+        stream, sep, rate = item.partition('=')
+        if stream not in streams or not sep:
+            parser.error('Invalid stream rate %s'% item)
+        rates[stream] = float(rate)
+    cargs.rates = rates
+    return cargs
+
+'''
+'''
+def main(assigned_args = None):
+    # type: (List)
+    cargs = main_argparse(assigned_args)
+    test = CissStressTest(cargs)
+    try:
+        test.start()
+        test.run()
+    finally:
+        test.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,96 @@ Bosch CISS sensor
 
 '''
 Change log    
+0.24.10 - 2021-01-11 - cg
+    xyz magnitude only calculated in the batches, default batch 256
+    
+0.24.9 - 2021-01-07 - cg
+    Node capture methods, captures checked by the publisher
+    
+0.24.8 - 2020-12-28 - cg
+    Spectral windows in the snapshots, features computed by the publisher
+    
+0.24.7 - 2020-12-26 - cg
+    Pending snapshot requests cleared on reload
+    
+0.24.6 - 2020-12-24 - cg
+    Window statistics without all time min/max, empty windows have no statistics
+    
+0.24.5 - 2020-12-18 - cg
+    Aggregation tiers rebuilt on configuration reload
+    
+0.24.4 - 2020-12-16 - cg
+    Rate control sends only changed periods, one per read loop every 0.2 s,
+    spectral stages follow the streaming period
+    
+0.24.3 - 2020-12-14 - cg
+    Start without the serial device, wait for it in the read thread
+    
+0.24.2 - 2020-12-12 - cg
+    Sensor updates and snapshots under a node lock, current xyz magnitude
+    per sample, batches to tiers and software events in one step
+    
+0.24.1 - 2020-12-10 - cg
+    Configuration reload does not change the previous configuration, 
+    serial reconfiguration sent by the read thread
+    
+0.24.0 - 2020-12-06 - cg
+    Optional shared memory table of the latest values
+    
+0.23.0 - 2020-12-04 - cg
+    Optional inertial streaming rate control by serial backlog and decode load
+    
+0.22.0 - 2020-12-02 - cg
+    Optional pre/post trigger capture of the stream data
+    
+0.21.0 - 2020-11-26 - cg
+    Optional compressed history archive of the stream data
+    
+0.20.0 - 2020-11-24 - cg
+    Optional buffered CSV data log of the stream data
+    
+0.19.0 - 2020-11-20 - cg
+    Frame, decode error and connect counters, optional metrics exporter
+    
+0.18.0 - 2020-11-14 - cg
+    Per sensor publish intervals, snapshots requested by a deadline scheduler
+    
+0.17.0 - 2020-11-12 - cg
+    Publish consistent node snapshots taken by the read thread
+    
+0.16.0 - 2020-11-10 - cg
+    Lazy imports, startup phase report
+    
+0.15.0 - 2020-11-08 - cg
+    Slotted sensor objects, xyz axes share one ring buffer
+    
+0.14.0 - 2020-11-06 - cg
+    Add streaming anomaly detection
+    
+0.13.0 - 2020-11-04 - cg
+    Euclidean xyz magnitude and derived channels calculated in batches
+    
+0.12.0 - 2020-11-02 - cg
+    Add optional spectral features for xyz sensors
+    
+0.11.0 - 2020-10-30 - cg
+    Add aggregation tiers
+    
+0.10.0 - 2020-10-28 - cg
+    Add publish interval aligned statistic windows
+    
+0.9.0 - 2020-10-26 - cg
+    Add software threshold events while streaming
+    
+0.8.0 - 2020-10-24 - cg
+    Add event detection pipeline
+    
+0.7.0 - 2020-10-22 - cg
+    Add live configuration reload
+    
+0.6.0 - 2020-10-20 - cg
+    Add device hotplug watcher
+    
 0.4.0 - 2020-08-12 - cg 
     Add serial reconnect
     
@@ -17,7 +107,7 @@ Change log
 
 __author__ = "Christian G."
 __license__ = "MIT"
-__version__ = '0.5.0'
+__version__ = '0.24.10'
 __status__ = "beta"
     
 import sys
@@ -26,13 +116,30 @@ import threading
 import math
 
 from enum import Enum
-from collections import deque
+from collections import deque, namedtuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from .chgrcodebase import *
-from .CissUsbConnectord_v2_3_1 import CISSNode
+from .CissUsbConnectord_v2_3_1 import CISSNode, config_acc_range, calc_crc
+from .cissDeviceWatcher import CissDeviceWatcher
+from .cissAggregate import CissAggregate, CissTierCascade, CissRingBuffer
+from .cissSpectral import CissSpectralStage
+from .cissDerived import CissDerivedStage
+from .cissEvents import CissEvent, CissEventEngine, CissEventDispatcher, CissEventLog, decode_event_frame
+from .cissEvents import CissAnomalyDetector, CissEventKind
+from .cissScheduler import CissScheduler
+from .cissMetrics import CissMetrics
+from .cissDataLog import CissDataLog
+from .cissArchive import CissArchive
+from .cissCapture import CissCapture, CissCaptureWriter
+from .cissRateControl import CissRateController
+from .cissSharedValues import CissSharedValues
 
-if AppUtil.module_exists('statistics'):
-    import statistics  
+statistics = AppUtil.lazy_import('statistics')
 
 # Sensor Index 
 class SnIx(Enum):
@@ -57,8 +164,34 @@ class SnIx(Enum):
     def ix(self):  
         return self.value 
 
+# Shared configuration of sensors without own configuration, read only
+_NO_CONF = {}
+
+
 class CissSensor(AppBase):
-    _has_statistics_mod = AppUtil.module_exists('statistics')
+    _has_statistics_mod = AppModuleAvailable('statistics')
+    # value name -> attribute
+    _value_attrs = {
+        'timestamp': 'value_timestamp',
+        'current': 'value',
+        'min': 'value_min',
+        'max': 'value_max',
+        'mean': 'value_mean',
+        'std': 'value_std',
+        'event': 'value_event',
+        'anomaly': 'value_anomaly',
+        'anomaly_score': 'value_anomaly_score'
+        }
+    # values always part of get_value(), the others only if set
+    _value_base = ('timestamp', 'current', 'min', 'max', 'mean', 'std')
+    __slots__ = ('ciss_node', 'sensor_id', 'data_type', 'data_length', 'name', 'unit', 'publish', 
+                 'publish_interval', 'statistics', 'calc_stats', 'enabled', 'stream_enabled', 'stream_period', 
+                 'event_enabled', 'event_threshold', 
+                 'value', 'value_timestamp', 'value_min', 'value_max', 'value_mean', 'value_std', 
+                 'value_event', 'value_anomaly', 'value_anomaly_score', 
+                 '_window_stats', '_tier_periods', '_ext_conf', '_value_utime_diff', '_value_ucount', 
+                 '_def_data_size', '_max_data_size', '_data', '_window_acc', '_window', '_tiers', 
+                 '_on_sensor_update', '_event_engine', '_anomaly')
     
     def __init__(self, node, id='cissSensor', **kwargs):
         AppBase.__init__(self, id, **kwargs)
@@ -71,39 +204,57 @@ class CissSensor(AppBase):
         self.publish = kwargs.get('publish', 0)
         self.statistics = kwargs.get('statistics', 0)
         self.calc_stats = kwargs.get('calc_stats', False)
+        self._window_stats = kwargs.get('window_stats', False)
+        self._tier_periods = kwargs.get('tiers', None)
         self._ext_conf = kwargs.get('conf', None)  
         if not isinstance(self._ext_conf, dict):
-            self._ext_conf = dict()
+            self._ext_conf = _NO_CONF
         self.name = self._ext_conf.get('name', self.name)        
         self.unit = self._ext_conf.get('unit', self.unit)        
         self.enabled = self._ext_conf.get('enabled', True)
         self.publish = self._ext_conf.get('publish', self.publish)
+        # seconds, None uses the publish interval of the application
+        self.publish_interval = self._ext_conf.get('publish_interval', None)
         self.stream_enabled = self.str2bool(self._ext_conf.get('stream_enabled', "0"))
         self.stream_period = int(self._ext_conf.get('stream_period', 1000000))
         self.event_enabled = self.str2bool(self._ext_conf.get('event_enabled', "0"))
         self.event_threshold = self._ext_conf.get('event_threshold', 0)       
         self.value_timestamp = None
-        self._value = {
-            'timestamp': None,
-            'current': 0,
-            'min': 0,
-            'max': 0,
-            'mean': 0,
-            'std': 0            
-            }
         self.value = 0
+        self.value_min = 0
+        self.value_max = 0
+        self.value_mean = 0
+        self.value_std = 0
+        if self._window_stats:
+            # set when the first window is closed
+            self.value_min = self.value_max = self.value_mean = self.value_std = None
+        self.value_event = None
+        self.value_anomaly = None
+        self.value_anomaly_score = None
         self._value_utime_diff = None
         self._value_ucount = 0
         self.statistics = self._ext_conf.get('enable_statistics', self.statistics)
-        self._max_data_size = kwargs.get('max_data_size', 10)
-        self._max_data_size = max(self.statistics, self._max_data_size)
+        self._def_data_size = kwargs.get('max_data_size', 10)
+        self._max_data_size = max(self.statistics, self._def_data_size)
         
-        if self.statistics and not self._has_statistics_mod:
+        if self.statistics and not self._has_statistics_mod and not self._window_stats:
             self.statistics = 0
             self.log_error('Statistics Module not found! Disable Statistics')       
         
-        self._data = deque(maxlen=self._max_data_size)
+        # raw samples are only kept for statistics over the last samples
+        self._data = kwargs.get('data', None)
+        if self._data is None:
+            self._data = CissRingBuffer(1 if self._window_stats else self._max_data_size, 
+                                        kwargs.get('channels', 1)).view(0)
+        self._window_acc = CissAggregate(time.time())
+        self._window = None
+        self._tiers = None
+        self.set_tiers(self._tier_periods)
         self._on_sensor_update = None
+        self._event_engine = None
+        self.set_event_engine(self._ext_conf)
+        self._anomaly = None
+        self.set_anomaly_detector(self._ext_conf)
         self.log_info('Sensor %s enabled %s! statistics %d, max_values %d, publish %d!', 
                       self.name, self.enabled, self.statistics, self._max_data_size, self.publish)  
         self.log_debug('Sensor %s streaming %s! period %d! event %s, threshold %d!', 
@@ -125,32 +276,105 @@ class CissSensor(AppBase):
             timestamp = time.time()
         
         self.value = value
-        self._value['timestamp'] = timestamp
-        self._value['current'] = self.value
         
-        if self.value_timestamp is None:
-            self._value['max'] = self.value
-            self._value['min'] = self.value        
-        else:
-            self._value['max'] = max(self._value['max'], self.value)
-            self._value['min'] = min(self._value['min'], self.value)        
+        if self.value_timestamp is not None:
             self._value_utime_diff = timestamp - self.value_timestamp
+        # with window statistics min and max are set when the window is closed
+        if self._window_stats:
+            pass
+        elif self.value_timestamp is None:
+            self.value_max = value
+            self.value_min = value        
+        else:
+            if value > self.value_max:
+                self.value_max = value
+            elif value < self.value_min:
+                self.value_min = value
             
         self.value_timestamp = timestamp
         
-        self._data.append(self.value)        
-        # ToDo      
-        if self.calc_stats:  
-            self.calc_statistics()        
+        if self._tiers is not None:
+            self._tiers.add(value, timestamp)
+        if self._window_stats:
+            self._window_acc.add(value)
+        else:
+            self._data.append(self.value)        
+            # ToDo      
+            if self.calc_stats:  
+                self.calc_statistics()        
         
         self._value_ucount += 1
         
+        if self._event_engine is not None:
+            event = self._event_engine.update(value, timestamp)
+            if event is not None:
+                self.on_event(event, timestamp)
+        if self._anomaly is not None:
+            state = self._anomaly.update(value, timestamp)
+            if state is not None:
+                self.on_anomaly(state, timestamp)
+        
         if self._on_sensor_update:
             self._on_sensor_update(sensor=self)
             
         return value  
     
+    def update_batch(self, summary, values, timestamps, notify=True):
+        '''
+        Update with a batch of values, summary is the CissWindow of the values.
+        Tiers and software events take the batch in one step if it stays in
+        the tier window and the event state, the anomaly baseline is updated
+        per value. notify: call the update callback
+        '''
+        if not summary.count:
+            return None
+        value = values[-1]
+        timestamp = timestamps[-1]
+        self.value = float(value)
+        
+        if self._window_stats:
+            pass
+        elif not self._value_ucount:
+            self.value_max = summary.max
+            self.value_min = summary.min        
+        else:
+            self.value_max = max(self.value_max, summary.max)
+            self.value_min = min(self.value_min, summary.min)        
+        if summary.count > 1:
+            self._value_utime_diff = (summary.end - summary.start) / (summary.count - 1)
+        self.value_timestamp = timestamp
+        
+        if hasattr(values, 'tolist') and (self._tiers is not None or self._event_engine is not None 
+                                          or self._anomaly is not None or not self._window_stats):
+            values = values.tolist()
+        if self._tiers is not None:
+            self._tiers.add_batch(summary, values, timestamps)
+        if self._event_engine is not None and not self._event_engine.is_quiet(summary.min, summary.max):
+            for ix in range(len(values)):
+                event = self._event_engine.update(values[ix], timestamps[ix])
+                if event is not None:
+                    self.on_event(event, timestamps[ix])
+        if self._anomaly is not None:
+            for state, at in self._anomaly.update_batch(values, timestamps):
+                self.on_anomaly(state, at)
+        if self._window_stats:
+            self._window_acc.merge(summary)
+        else:
+            self._data.extend(values)
+            
+        self._value_ucount += summary.count
+        
+        if notify and self._on_sensor_update:
+            self._on_sensor_update(sensor=self)
+        return value
+    
     def calc_statistics(self):
+        if self._anomaly is not None:
+            score = self._anomaly.pop_score()
+            self.value_anomaly_score = score
+            self.value_anomaly = 1 if self._anomaly.state or score > self._anomaly.threshold else 0
+        if self._window_stats:
+            return self.roll_window()
         if not self.statistics:
             return True
         elif len(self._data) < 2:        
@@ -158,15 +382,201 @@ class CissSensor(AppBase):
             return False
         
         data = list(self._data)
-        self._value['mean'] = statistics.mean(data)
-        self._value['std'] = statistics.stdev(data)           
+        self.value_mean = statistics.mean(data)
+        self.value_std = statistics.stdev(data)           
+        return True
+    
+    def roll_window(self, timestamp=None):
+        '''
+        Close the running statistic window and start a new one. Called 
+        under the node lock, the read thread adds no value meanwhile. 
+        Without values in the window the statistics are None
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        window_acc = self._window_acc
+        self._window_acc = CissAggregate(timestamp)
+        self._window = window_acc.freeze(timestamp)
+        if not self._window.count:
+            self.value_min = self.value_max = self.value_mean = self.value_std = None
+            return False
+        self.value_min = self._window.min
+        self.value_max = self._window.max
+        self.value_mean = self._window.mean
+        self.value_std = self._window.std
+        return True
+    
+    def get_window(self):
+        return self._window
+    
+    def get_tiers(self):
+        return self._tiers
+    
+    def set_tiers(self, periods, active=None):
+        '''
+        Aggregation tiers of the periods (s), only with statistics of an
+        enabled sensor. Rebuilt if changed, returns True if changed
+        '''
+        self._tier_periods = periods
+        if active is None:
+            active = self.statistics and self.enabled
+        if not periods or not active:
+            changed = self._tiers is not None
+            self._tiers = None
+            return changed
+        if self._tiers is not None and self._tiers.periods == sorted(periods):
+            return False
+        self._tiers = CissTierCascade(periods)
+        return True
+    
+    def pop_tier_windows(self):
+        if self._tiers is None:
+            return []
+        return self._tiers.pop_closed()
+    
+    def reload_config(self, conf):
+        '''
+        Apply a new sensor configuration, returns the list of changed keys
+        '''
+        if not isinstance(conf, dict):
+            return []
+        changed = []
+        new_conf = {
+            'name': conf.get('name', self.name),
+            'unit': conf.get('unit', self.unit),
+            'enabled': conf.get('enabled', True),
+            'publish': conf.get('publish', self.publish),
+            'publish_interval': conf.get('publish_interval', None),
+            'stream_enabled': self.str2bool(conf.get('stream_enabled', "0")),
+            'stream_period': int(conf.get('stream_period', 1000000)),
+            'event_enabled': self.str2bool(conf.get('event_enabled', "0")),
+            'event_threshold': conf.get('event_threshold', 0)
+            }
+        for key, value in new_conf.items():
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                changed.append(key)
+        if self.set_statistics(conf.get('enable_statistics', 0)):
+            changed.append('statistics')
+        if self.set_event_engine(conf):
+            changed.append('sw_event')
+        if self.set_anomaly_detector(conf):
+            changed.append('anomaly')
+        if self.set_tiers(self._tier_periods):
+            changed.append('tiers')
+        self._ext_conf = conf
+        if changed:
+            self.log_info('Sensor %s reloaded %s', self.name, changed)
+        return changed
+    
+    def set_statistics(self, statistics):
+        if statistics and not self._has_statistics_mod and not self._window_stats:
+            statistics = 0
+        if statistics == self.statistics:
+            return False
+        self.statistics = statistics
+        max_data_size = max(self.statistics, self._def_data_size)
+        if max_data_size != self._max_data_size:
+            self._max_data_size = max_data_size
+            if not self._window_stats:
+                self._data.resize(self._max_data_size)
+        return True
+    
+    def set_event_engine(self, conf):
+        '''
+        Software event detection on streamed values, returns True if changed
+        '''
+        if not self.str2bool(conf.get('sw_event_enabled', "0")):
+            engine_conf = None
+        else:
+            rate = conf.get('event_rate', 0)
+            engine_conf = (self.event_threshold, conf.get('event_threshold_low', None),
+                           conf.get('event_hysteresis', 0), rate if rate else None)
+        if self._event_engine is None:
+            if engine_conf is None:
+                return False
+        elif self._event_engine.get_config() == engine_conf:
+            return False
+        if engine_conf is None:
+            self._event_engine = None
+            self.log_info('Sensor %s software events disabled', self.name)
+        else:
+            self._event_engine = CissEventEngine(*engine_conf)
+            self.log_info('Sensor %s software events high %s, low %s, hysteresis %s, rate %s', 
+                          self.name, *engine_conf)
+            if self.event_enabled:
+                self.log_warning('Sensor %s hardware event mode stops streaming, no software events!', self.name)
+        return True
+    
+    def set_anomaly_detector(self, conf):
+        '''
+        Anomaly detection on streamed values, returns True if changed
+        '''
+        if not self.str2bool(conf.get('anomaly_enabled', "0")):
+            detector_conf = None
+        else:
+            detector_conf = (conf.get('anomaly_method', 'zscore'), float(conf.get('anomaly_alpha', 0.01)),
+                             conf.get('anomaly_threshold', None), float(conf.get('anomaly_drift', 1.0)),
+                             conf.get('anomaly_warmup', None), float(conf.get('anomaly_hold', 10)),
+                             float(conf.get('anomaly_min_std', 1)))
+        if self._anomaly is None:
+            if detector_conf is None:
+                return False
+        elif self._anomaly.get_config() == detector_conf:
+            return False
+        if detector_conf is None:
+            self._anomaly = None
+            self.value_anomaly = None
+            self.value_anomaly_score = None
+            self.log_info('Sensor %s anomaly detection disabled', self.name)
+            return True
+        try:
+            self._anomaly = CissAnomalyDetector(*detector_conf)
+        except ValueError as e:
+            self._anomaly = None
+            self.log_error('Sensor %s invalid anomaly detection %s', self.name, e)
+            return True
+        self.value_anomaly = 0
+        self.value_anomaly_score = 0.0
+        self.log_info('Sensor %s anomaly detection %s, alpha %s, threshold %s', 
+                      self.name, self._anomaly.method, self._anomaly.alpha, self._anomaly.threshold)
+        return True
+    
+    def has_anomaly_detector(self):
+        return self._anomaly is not None
+    
+    def is_anomalous(self):
+        if self._anomaly is None:
+            return False
+        return self._anomaly.state != 0 or self.value_anomaly != 0
+    
+    def on_anomaly(self, state, timestamp):
+        if state:
+            self.value_anomaly = state
+            self.log_info('Sensor %s anomaly detected, score %.1f', self.name, self._anomaly.score)
+            if self.ciss_node is not None:
+                self.ciss_node.trigger_capture('anomaly-%s'% self.get_base_id(), timestamp)
+        else:
+            self.log_info('Sensor %s anomaly cleared', self.name)
+        return True
+    
+    def on_event(self, event, timestamp):
+        self.value_event = event
+        if self.ciss_node is not None and self.ciss_node._event_dispatcher is not None:
+            self.ciss_node._event_dispatcher.put_events([CissEvent(timestamp, self.ciss_node.get_base_id(), 
+                                                                   self.get_base_id(), event)])
         return True
     
     def get_value(self, what=None, type=None):
         if what is None:
-            return self._value
+            values = {}
+            for what, attr in self._value_attrs.items():
+                value = getattr(self, attr)
+                if value is not None or what in self._value_base:
+                    values[what] = value
+            return values
         else:
-            return self._value[what]
+            return getattr(self, self._value_attrs[what])
         return None
        
     def print_values(self):
@@ -174,6 +584,9 @@ class CissSensor(AppBase):
         
     def set_on_update_callback(self, callback):
         self._on_sensor_update = callback
+    
+    def is_xyz(self):
+        return False
               
     '''
     CISSNode function
@@ -189,26 +602,95 @@ class CissSensor(AppBase):
                           
 
 class CissXyzSensor(CissSensor):
+    _value_attrs = dict(CissSensor._value_attrs, 
+                        pitch='value_pitch', roll='value_roll', 
+                        rms_x='value_rms_x', rms_y='value_rms_y', rms_z='value_rms_z')
+    __slots__ = ('extra_conf', 'value_pitch', 'value_roll', 'value_rms_x', 'value_rms_y', 'value_rms_z',
+                 '_calc_stats_elem', '_x_sensor', '_y_sensor', '_z_sensor', '_spectral', '_derived',
+                 '_sample_period')
     
     def __init__(self, node, id='cissXyzSensor', **kwargs):
+        # channel 0 magnitude, 1..3 x, y, z
+        kwargs['channels'] = 4
         CissSensor.__init__(self, node, id, **kwargs)
+        buffer = self._data.buffer
+        self.value_pitch = None
+        self.value_roll = None
+        self.value_rms_x = None
+        self.value_rms_y = None
+        self.value_rms_z = None
         self.extra_conf = self._ext_conf.get('range', 0) 
         self._calc_stats_elem = kwargs.get('calc_stats_sub', True) 
         self._x_sensor = CissSensor(self.ciss_node, ("%s_%s"% (id,'x')), 
                                     sensor_id=self.sensor_id, data_type=self.data_type,
                                     unit=self.unit, name=("%s_%s"% (self.name,'x')), publish=self.publish,
                                     statistics=self.statistics, max_data_size=self._max_data_size, 
-                                    logger=self.get_logger())
+                                    window_stats=self._window_stats, tiers=self._tier_periods, 
+                                    data=buffer.view(1), logger=self.get_logger())
         self._y_sensor = CissSensor(self.ciss_node, ("%s_%s"% (id,'y')), 
                                     sensor_id=self.sensor_id, data_type=self.data_type,
                                     unit=self.unit, name=("%s_%s"% (self.name,'y')), publish=self.publish,
                                     statistics=self.statistics, max_data_size=self._max_data_size, 
-                                    logger=self.get_logger())
+                                    window_stats=self._window_stats, tiers=self._tier_periods, 
+                                    data=buffer.view(2), logger=self.get_logger())
         self._z_sensor = CissSensor(self.ciss_node, ("%s_%s"% (id,'z')), 
                                     sensor_id=self.sensor_id, data_type=self.data_type,
                                     unit=self.unit, name=("%s_%s"% (self.name,'z')), publish=self.publish,
                                     statistics=self.statistics, max_data_size=self._max_data_size, 
-                                    logger=self.get_logger())
+                                    window_stats=self._window_stats, tiers=self._tier_periods, 
+                                    data=buffer.view(3), logger=self.get_logger())
+        self._spectral = None
+        # streaming period in effect (us), changed by the rate control
+        self._sample_period = self.stream_period
+        self.set_spectral_stage()
+        self._derived = CissDerivedStage(int(self._ext_conf.get('derived_batch', 256)), 
+                                         self.str2bool(self._ext_conf.get('derived', "0")))
+        
+    def set_spectral_stage(self):
+        self._spectral = None
+        if not self._ext_conf.get('spectral', None) or not self.enabled:
+            return False
+        if not CissSpectralStage._has_numpy_mod:
+            self.log_error('NumPy Module not found! Disable spectral features for %s', self.name)
+            return False
+        self._spectral = CissSpectralStage('%s_spectral'% self.get_base_id(), conf=self._ext_conf['spectral'],
+                                           sample_rate=(1000000.0 / max(self._sample_period, 1)),
+                                           logger=self.get_logger())
+        return True
+    
+    def set_sample_period(self, period):
+        '''
+        Streaming period (us) in effect, the spectral stage is rebuilt
+        for the new sample rate
+        '''
+        if period == self._sample_period:
+            return False
+        self._sample_period = period
+        if self._spectral is not None:
+            self.set_spectral_stage()
+        return True
+    
+    def get_spectral_features(self, type):
+        if self._spectral is None:
+            return None
+        return self._spectral.get_features(type)
+    
+    def get_spectral_window(self):
+        '''
+        Latest full CissSpectralWindow, its features are computed on first use
+        '''
+        if self._spectral is None:
+            return None
+        return self._spectral.get_window()
+    
+    def set_tiers(self, periods, active=None):
+        active = self.statistics and self.enabled
+        changed = CissSensor.set_tiers(self, periods, active)
+        # axes are created after the tiers of the sensor
+        for type in ('x', 'y', 'z'):
+            if getattr(self, '_%s_sensor'% type, None) is not None:
+                changed = self.get_sensor(type).set_tiers(periods, active) or changed
+        return changed
         
     def update_value_ext(self, stream_data):
         if not self.enabled:
@@ -228,9 +710,55 @@ class CissXyzSensor(CissSensor):
             return None
         if self._z_sensor.update_value(value_z, timestamp) is None:
             return None       
-        # ToDo check performance impact
-        #return self.update_value(math.sqrt(value_x**2 + value_y**2 + value_z**2), timestamp)
-        return self.update_value((abs(value_x) + abs(value_y) + abs(value_z)), timestamp)
+        if timestamp is None:
+            timestamp = time.time()
+        if self._spectral is not None:
+            self._spectral.add(value_x, value_y, value_z, timestamp)
+        # the magnitude is only calculated in the batches, the current value
+        # is the last sample of the latest batch, flush_derived() in 
+        # calc_statistics() completes the statistics
+        if self._derived.add(value_x, value_y, value_z, timestamp):
+            self.flush_derived(notify=True)
+        return self.value
+    
+    def is_derived(self):
+        return self._derived.derived
+    
+    def flush_derived(self, notify=False):
+        '''
+        Calculate euclidean magnitude and derived channels of the buffered samples,
+        notify: call the update callback
+        '''
+        batch = self._derived.flush()
+        if batch is None:
+            return False
+        if self._derived.derived:
+            self.value_pitch = self._derived.pitch
+            self.value_roll = self._derived.roll
+        self.update_batch(*batch, notify=notify)
+        return True
+  
+    def reload_config(self, conf):
+        changed = CissSensor.reload_config(self, conf)
+        if not isinstance(conf, dict):
+            return changed
+        extra_conf = conf.get('range', 0)
+        if extra_conf != self.extra_conf:
+            self.extra_conf = extra_conf
+            changed.append('range')
+        for type in ('x', 'y', 'z'):
+            sensor = self.get_sensor(type)
+            sensor.name = ("%s_%s"% (self.name, type))
+            sensor.unit = self.unit
+            sensor.publish = self.publish
+            sensor.set_statistics(self.statistics)
+        self._derived.derived = self.str2bool(conf.get('derived', "0"))
+        if 'stream_period' in changed:
+            self._sample_period = self.stream_period
+        if 'stream_period' in changed or 'enabled' in changed \
+            or conf.get('spectral', None) != getattr(self._spectral, 'conf', None):
+            self.set_spectral_stage()
+        return changed
   
     def get_value(self, what=None, type=None):
         if type is None:            
@@ -239,6 +767,9 @@ class CissXyzSensor(CissSensor):
             return self.get_sensor(type).get_value(what)              
         return None
     
+    def is_xyz(self):
+        return True
+    
     def get_sensor(self, type):
         if type is 'x':
             return self._x_sensor
@@ -251,7 +782,13 @@ class CissXyzSensor(CissSensor):
         return None
     
     def calc_statistics(self):
-        if not CissSensor.calc_statistics(self):
+        self.flush_derived()
+        if self._derived.derived:
+            rms = self._derived.pop_rms()
+            if rms is not None:
+                self.value_rms_x, self.value_rms_y, self.value_rms_z = rms
+        # the windows of the axes are closed with the window of the sensor
+        if not CissSensor.calc_statistics(self) and not self._window_stats:
             return False
         if self._calc_stats_elem:
             self._x_sensor.calc_statistics()
@@ -260,18 +797,123 @@ class CissXyzSensor(CissSensor):
         return True    
 
 
+class CissSensorSnapshot(object):
+    '''
+    Copy of the sensor values, closed tier windows and the spectral window
+    taken at a publish tick, the spectral features are computed by the
+    first reader. Attributes not part of the snapshot (name,
+    unit, publish, ...) are read from the sensor.
+    '''
+    __slots__ = ('sensor', 'values', 'tier_windows', 'anomalous', 'spectral', 'children')
+    
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.values = sensor.get_value()
+        self.tier_windows = sensor.pop_tier_windows()
+        self.anomalous = sensor.is_anomalous()
+        self.spectral = None
+        self.children = None
+        if sensor.is_xyz():
+            self.spectral = sensor.get_spectral_window()
+            self.children = dict((type, CissSensorSnapshot(sensor.get_sensor(type))) for type in ('x', 'y', 'z'))
+        return
+    
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
+    
+    def get_value(self, what=None, type=None):
+        if type is not None:
+            return self.children[type].get_value(what)
+        if what is None:
+            return self.values
+        return self.values[what]
+    
+    def get_sensor(self, type):
+        return self.children[type]
+    
+    def get_spectral_features(self, type):
+        if self.spectral is None:
+            return None
+        return self.spectral.get_features(type)
+    
+    def get_spectral_window(self):
+        return self.spectral
+    
+    def pop_tier_windows(self):
+        windows = self.tier_windows
+        self.tier_windows = []
+        return windows
+    
+    def is_anomalous(self):
+        return self.anomalous
+
+
+# seq: snapshot counter, timestamp: tick time, interval: publish interval (s) of the sensors, 
+# None for all sensors, node: AppCissNode, sensors: sensor index -> CissSensorSnapshot
+CissNodeSnapshot = namedtuple('CissNodeSnapshot', ['seq', 'timestamp', 'interval', 'node', 'sensors'])
+
+
 class AppCissNode(AppBase, CISSNode):
+    # CISSNode streaming/event configuration per sensor
+    _sensor_group = {
+        SnIx.ACCL.value: 'acc',
+        SnIx.GYRO.value: 'gyr',
+        SnIx.MAGN.value: 'mag',
+        SnIx.TEMP.value: 'env',
+        SnIx.HUMI.value: 'env',
+        SnIx.PRES.value: 'env',
+        SnIx.LIGHT.value: 'light',
+        SnIx.NOISE.value: 'noise'
+        }
+    # sensor index, class, sensor id, data type, unit
+    _sensor_types = (
+        (SnIx.ACCL.value, CissXyzSensor, 0x80, 0x02, 'mg'),
+        (SnIx.MAGN.value, CissXyzSensor, 0x81, 0x03, 'uT'),
+        (SnIx.GYRO.value, CissXyzSensor, 0x82, 0x04, 'd/s'),
+        (SnIx.TEMP.value, CissSensor, 0x83, 0x05, 'C'),
+        (SnIx.HUMI.value, CissSensor, 0x83, 0x07, '%'),
+        (SnIx.PRES.value, CissSensor, 0x83, 0x06, 'hPas'),
+        (SnIx.LIGHT.value, CissSensor, 0x84, 0x08, 'lx'),
+        (SnIx.NOISE.value, CissSensor, 0x85, 0x09, '?')
+        )
      
     def __init__(self, id='cissNode', **kwargs):
         AppBase.__init__(self, id, **kwargs)
         self._ext_conf = kwargs.get('conf', {})  
         self.name = self._ext_conf.get('name', 'Dummy')
+        self._window_stats = kwargs.get('window_stats', False)
+        self._tiers = kwargs.get('tiers', None)
         
         self._serial_stop = False
         self._serial_port = self._ext_conf.get('com_port', '/dev/ttyACM0')
         self._serial_read_timeout = 1
         self._serial_thread = None
         self._serial_connected = False
+        self._device_watched = False
+        self._device_event = threading.Event()
+        # sensor updates of the read thread and snapshots of other threads
+        self._lock = threading.Lock()
+        self.first_frame_time = None
+        # counters of the read thread, read by the metrics exporter
+        self.frames = 0
+        self.decode_errors = 0
+        self.connects = 0
+        self.serial_errors = 0
+        self._snapshot = None
+        self._snapshot_requests = deque()
+        # serial configuration changes sent by the read thread
+        self._config_requests = deque()
+        # streaming groups with a rate control period not sent yet
+        self._rate_writes = deque()
+        self._rate_write_time = 0
+        self._snapshot_queue = kwargs.get('snapshot_queue', None)
+        self._publish_groups = {}
+        self._event_dispatcher = kwargs.get('event_dispatcher', None)
+        self._data_log = kwargs.get('data_log', None)
+        self._archive = kwargs.get('archive', None)
+        self._capture = kwargs.get('capture', None)
+        self._rate_control = kwargs.get('rate_control', None)
+        self._shared_values = kwargs.get('shared_values', None)
         
         self._stream_save_data = kwargs.get('stream_save_data', False)
         if self._stream_save_data:        
@@ -281,40 +923,9 @@ class AppCissNode(AppBase, CISSNode):
         if 'sensors' not in self._ext_conf or not isinstance(self._ext_conf['sensors'], dict):
             raise ValueError('Sensor configurations messing')
 
-        self._sensors = {
-            SnIx.ACCL.value: CissXyzSensor(self, SnIx.ACCL.value, sensor_id=0x80, 
-                                            data_type=0x02, unit='mg', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.ACCL.value),
-                                            logger=self.get_logger()), 
-            SnIx.MAGN.value: CissXyzSensor(self, SnIx.MAGN.value, sensor_id=0x81,
-                                            data_type=0x03, unit='uT', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.MAGN.value),
-                                            logger=self.get_logger()), 
-            SnIx.GYRO.value: CissXyzSensor(self, SnIx.GYRO.value, sensor_id=0x82,
-                                            data_type=0x04, unit='d/s', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.GYRO.value),
-                                            logger=self.get_logger()), 
-            SnIx.TEMP.value: CissSensor(self, SnIx.TEMP.value, sensor_id=0x83,
-                                            data_type=0x05, unit='C', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.TEMP.value),
-                                            logger=self.get_logger()), 
-            SnIx.HUMI.value: CissSensor(self, SnIx.HUMI.value, sensor_id=0x83,
-                                            data_type=0x07, unit='%', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.HUMI.value),
-                                            logger=self.get_logger()), 
-            SnIx.PRES.value: CissSensor(self, SnIx.PRES.value, sensor_id=0x83,
-                                            data_type=0x06, unit='hPas', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.PRES.value),
-                                            logger=self.get_logger()),
-            SnIx.LIGHT.value: CissSensor(self, SnIx.LIGHT.value, sensor_id=0x84,
-                                            data_type=0x08, unit='lx', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.LIGHT.value),
-                                            logger=self.get_logger()),
-            SnIx.NOISE.value: CissSensor(self, SnIx.NOISE.value, sensor_id=0x85,
-                                            data_type=0x09, unit='?', data_length=0,
-                                            conf=self._ext_conf['sensors'].get(SnIx.NOISE.value),
-                                            logger=self.get_logger())            
-            }  
+        self._sensors = self.create_sensors(self, self._ext_conf['sensors'], 
+                                            window_stats=self._window_stats, tiers=self._tiers,
+                                            logger=self.get_logger())
         self._serial_data_map = {}
         for ix, sensor in self._sensors.items():
             self._serial_data_map[sensor.data_type] = self._sensors[ix]            
@@ -322,8 +933,23 @@ class AppCissNode(AppBase, CISSNode):
         self.ser = serial.Serial(baudrate=19200, timeout=self._serial_read_timeout)
         self.ser.port = self._serial_port        
         CISSNode.__init__(self)  
+        for sensor in self.sensorlist:
+            if sensor.data_idx == 0x7A:
+                sensor.parser = self.parse_event_detection
         return 
     
+    @staticmethod
+    def create_sensors(node, sensors_conf, **kwargs):
+        '''
+        Create the sensor objects of a CISS node from the sensors configuration
+        '''
+        sensors = {}
+        for ix, sensor_class, sensor_id, data_type, unit in AppCissNode._sensor_types:
+            sensors[ix] = sensor_class(node, ix, sensor_id=sensor_id, 
+                                       data_type=data_type, unit=unit, data_length=0,
+                                       conf=sensors_conf.get(ix), **kwargs)
+        return sensors
+    
     '''
     CISSNode function
     '''
@@ -342,6 +968,13 @@ class AppCissNode(AppBase, CISSNode):
         printInformation = self._ext_conf.get('ini_print', True)
         printInformation_Conf = self._ext_conf.get('ini_print', True)         
 
+        self.apply_sensor_config()
+        
+        # opened by connect(), the read thread waits for a missing device
+        self.ser.port = self._serial_port
+        return True
+    
+    def apply_sensor_config(self):
 
         #sample_period_inert_us = self._ext_conf.get('sample_period_inert', 100000)
         #sample_period_env_us = self._ext_conf.get('sample_period_env', 1000000)/1000000 
@@ -406,18 +1039,145 @@ class AppCissNode(AppBase, CISSNode):
         self.eventlist["noise"].event_threshold = [int(self.get_sensor(SnIx.NOISE.value).event_threshold)]
         
         self.acc_range = int(self.get_sensor(SnIx.ACCL.value).extra_conf)
+        return True
+    
+    def set_tiers(self, periods):
+        '''
+        Aggregation tiers (s) of all sensors, returns True if changed
+        '''
+        self._tiers = periods
+        changed = False
+        with self._lock:
+            for ix, sensor in self._sensors.items():
+                changed = sensor.set_tiers(periods) or changed
+        return changed
+    
+    def is_event_mode(self):
+        for elem in self.eventlist.values():
+            if elem.event_enabled:
+                return True
+        return False
+    
+    def reload_config(self, conf):
+        '''
+        Apply a new node configuration, only changed sensor settings 
+        are sent to the CISS node. Returns dict of changed sensor keys.
+        '''
+        if conf.get('com_port', self._serial_port) != self._serial_port:
+            self.log_warning('Node %s com_port change requires a restart!', self.name)
+        changed = {}
+        with self._lock:
+            for ix, sensor in self._sensors.items():
+                keys = sensor.reload_config(conf['sensors'].get(ix))
+                if keys:
+                    changed[ix] = keys
+        # new dict, the previous configuration is shared with the context
+        self._ext_conf = dict(self._ext_conf, sensors=conf['sensors'])
+        if not changed:
+            self.log_info('Node %s configuration unchanged', self.name)
+            return changed
         
+        event_mode = self.is_event_mode()
+        self.apply_sensor_config()
+        if self._rate_control is not None:
+            if self._rate_control.level:
+                # nominal periods, also of the groups without changes
+                for ix in (SnIx.ACCL.value, SnIx.MAGN.value, SnIx.GYRO.value):
+                    self.get_sensor(ix).set_sample_period(self.get_sensor(ix).stream_period)
+                    if self.streaminglist[self._sensor_group[ix]].streaming_enabled:
+                        self._rate_writes.append(self._sensor_group[ix])
+            self._rate_control.reset()
+        if not self.is_connected():
+            self.log_info('Node %s not connected, configuration applied on reconnect', self.name)
+            return changed
+        if event_mode or self.is_event_mode():
+            stream_groups = set()
+            for ix, keys in changed.items():
+                if set(keys) & set(['stream_enabled', 'stream_period', 'event_enabled', 'event_threshold', 'range']):
+                    stream_groups.add(self._sensor_group[ix])
+            if stream_groups:
+                self.log_info('Node %s event configuration changed, reconfigure!', self.name)
+                self._config_requests.append((True, (), False))
+            return changed
+        
+        stream_groups = set()
+        acc_range = False
+        for ix, keys in changed.items():
+            if 'stream_enabled' in keys or 'stream_period' in keys:
+                stream_groups.add(self._sensor_group[ix])
+            if 'range' in keys:
+                acc_range = True
+        if stream_groups or acc_range:
+            self._config_requests.append((False, stream_groups, acc_range))
+        return changed
+    
+    def check_config_requests(self):
+        '''
+        Send the configuration changes of reload_config to the CISS node,
+        called from the read thread, the only thread using the serial port
+        '''
+        requests = self._config_requests
+        while requests:
+            try:
+                full, stream_groups, acc_range = requests.popleft()
+            except IndexError:
+                break
+            if full:
+                self.reconfigure_sensors()
+                continue
+            if acc_range:
+                config_acc_range(self.ser, self.acc_range)
+            for group in stream_groups:
+                if group not in self.streaminglist:
+                    continue
+                elem = self.streaminglist[group]
+                self.log_info('Node %s reconfigure %s streaming %s period %d', 
+                              self.name, group, elem.streaming_enabled, elem.streaming_period)
+                if elem.streaming_enabled:
+                    elem.configure(self.ser, 0)
+                else:
+                    elem.disable(self.ser)
+        return True
+    
+    def attach_device_watcher(self, watcher):
+        watcher.add_device(self._serial_port, self.on_device_change)
+        self._device_watched = True
+        return True
+    
+    def on_device_change(self, path, present):
+        if present:
+            self.log_info('Serial device %s attached!', path)
+            self._device_event.set()
+        else:
+            self.log_warning('Serial device %s detached!', path)
+            self._device_event.clear()
+        return True
+    
+    def check_device(self):
+        '''
+        Device event cleared before the check, an attach during the check
+        sets it again. Returns True if the device exists
+        '''
+        self._device_event.clear()
         if not os.path.exists(self._serial_port):
-            raise ValueError('Serial Port %s not found'% self._serial_port)
             return False
-
-        self.ser.port = self._serial_port
+        self._device_event.set()
         return True
     
+    def wait_for_device(self):
+        self.log_info('Waiting for serial device %s ...', self._serial_port)
+        while not self._serial_stop:
+            if self._device_event.wait(self._serial_read_timeout):
+                return True
+        return False
+    
     def update_sensor_values(self, stream_data, data_type):
         #self.log_debug('Update Sensors %d, [%s]', data_type, stream_data)
         if data_type in self._serial_data_map:
-            self._serial_data_map[data_type].update_value_ext(stream_data)
+            sensor = self._serial_data_map[data_type]
+            sensor.update_value_ext(stream_data)
+            if self._shared_values is not None:
+                self._shared_values.write_current(self.get_base_id(), sensor)
         else:
             for name, sensor in self._sensors.items():
                 sensor.update_value_ext(stream_data)        
@@ -435,14 +1195,33 @@ class AppCissNode(AppBase, CISSNode):
                 if not self.is_connected():
                     self.connect()                    
                     if not self.is_connected():
+                        if self._device_watched and not self._device_event.is_set():
+                            if not self.wait_for_device():
+                                break
+                            continue
                         self.set_error_str(AppErrorCode.ERROR.value, 'Failed to re-connect to Serial Port %s', self._serial_port)
                         break                    
                     self.reconfigure_sensors()
+                if self._config_requests:
+                    self.check_config_requests()
                 if not self.read_sensor_stream():
                     break
+                self.check_snapshot()
+                if self._rate_control is not None and self._rate_control.is_due():
+                    self.check_rate_control()
+                if self._rate_writes:
+                    self.check_rate_writes()
             except serial.SerialException as e:
+                self.serial_errors += 1
                 self.log_exception('Read Serial Stream Exception! Port %s', self._serial_port)
                 self.set_error_str(AppErrorCode.EXCEPTION.value, 'Failed to read Serial Port')
+                if self._device_watched and not self.check_device():
+                    self.close_serial()
+                    if not self.wait_for_device():
+                        break
+                    self.clear_error()
+                    retry = 0
+                    continue
                 if retry < 3:
                     retry = retry +  1
                     continue
@@ -459,6 +1238,65 @@ class AppCissNode(AppBase, CISSNode):
         if self.has_error(): return False      
         else: return True
         
+    def check_rate_control(self):
+        '''
+        Evaluate the backlog and decode load, called from the read thread
+        '''
+        level = self._rate_control.update(self.ser.in_waiting)
+        if level is not None:
+            self.apply_rate_level()
+        return True
+    
+    def apply_rate_level(self):
+        '''
+        Inertial streaming periods of the rate control level, sampling
+        rate only, streaming stays enabled
+        '''
+        if self.is_event_mode():
+            return False
+        for ix in (SnIx.ACCL.value, SnIx.MAGN.value, SnIx.GYRO.value):
+            group = self._sensor_group[ix]
+            elem = self.streaminglist[group]
+            if not elem.streaming_enabled:
+                continue
+            period = self._rate_control.get_period(self.get_sensor(ix).stream_period)
+            if period == elem.streaming_period:
+                continue
+            elem.streaming_period = period
+            self.get_sensor(ix).set_sample_period(period)
+            self.log_info('Node %s %s streaming period %d us', self.name, group, period)
+            if group not in self._rate_writes:
+                self._rate_writes.append(group)
+        return True
+    
+    def check_rate_writes(self):
+        '''
+        Send the next pending streaming period, sampling rate only. The CISS
+        node needs 0.2 s between two commands, the read thread goes on
+        reading instead of sleeping like StreamingConfig.configure()
+        '''
+        now = AppUtil.monotonic()
+        if now < self._rate_write_time:
+            return False
+        elem = self.streaminglist[self._rate_writes.popleft()]
+        conf_buff = bytearray([0xfe, elem.cfg_length, elem.cfg_id, 2])
+        while len(conf_buff) - 2 < elem.cfg_length:
+            conf_buff.append(elem.streaming_period >> ((len(conf_buff) - 4) * 8) & 0xff)
+        conf_buff.append(calc_crc(conf_buff))
+        self.ser.write(bytes(conf_buff))
+        self._rate_write_time = now + 0.2
+        return True
+    
+    def get_stream_period(self, ix):
+        '''
+        Streaming period (us) the node is configured with, changed by the
+        rate control
+        '''
+        group = self._sensor_group.get(ix, None)
+        if group not in self.streaminglist:
+            return None
+        return self.streaminglist[group].streaming_period
+    
     def read_sensor_thread(self, loop_delay):
         self.log_info('Sensor read stream started!')
         if not self.read_sensor_stream_until(0, 0, loop_delay):
@@ -480,11 +1318,128 @@ class AppCissNode(AppBase, CISSNode):
             return self._serial_thread.is_alive()
         else:
             return False
+    
+    def get_capture(self):
+        return self._capture
+    
+    def trigger_capture(self, reason='manual', timestamp=None):
+        '''
+        Capture the stream data around timestamp (now if None), False 
+        without capture
+        '''
+        if self._capture is None:
+            return False
+        return self._capture.trigger(reason, timestamp)
+    
+    def check_capture(self):
+        '''
+        Finish a capture the read thread did not finish (no stream data),
+        called from the publisher
+        '''
+        if self._capture is None:
+            return False
+        return self._capture.check()
+    
+    def finish_capture(self):
+        if self._capture is None:
+            return False
+        return self._capture.finish()
         
     def calc_statistics(self):
-        for id, sensor in self._sensors.items():
-            sensor.calc_statistics()
+        with self._lock:
+            for id, sensor in self._sensors.items():
+                sensor.calc_statistics()
         return True        
+    
+    def set_publish_interval(self, interval):
+        '''
+        Group the sensors by publish interval, interval (ms) is used for
+        sensors without own interval, 0 leaves them out. 
+        Returns dict interval (s) -> list of sensor index
+        '''
+        groups = {}
+        for ix, sensor in self._sensors.items():
+            sensor_interval = sensor.publish_interval
+            if sensor_interval is None:
+                if not interval:
+                    continue
+                sensor_interval = interval / 1000.0
+            groups.setdefault(float(sensor_interval), []).append(ix)
+        self._publish_groups = groups
+        return groups
+    
+    def get_publish_groups(self):
+        return self._publish_groups
+    
+    def request_snapshot(self, interval=None):
+        '''
+        Request a snapshot of the sensors of a publish interval (all if None),
+        taken by the read thread after the next frame
+        '''
+        self._snapshot_requests.append((interval, AppUtil.monotonic()))
+        return True
+    
+    def clear_snapshot_requests(self):
+        '''
+        Drop the pending requests, e.g. of publish intervals before a reload
+        '''
+        self._snapshot_requests.clear()
+        return True
+    
+    def check_snapshot(self, overdue=0):
+        '''
+        Take the requested snapshots pending for more than overdue intervals
+        and put them into the snapshot queue. Returns the number taken.
+        '''
+        requests = self._snapshot_requests
+        count = 0
+        while requests:
+            interval, requested = requests[0]
+            if overdue and AppUtil.monotonic() - requested < overdue * (interval or 0):
+                break
+            try:
+                requests.popleft()
+            except IndexError:
+                break
+            if interval is not None and interval not in self._publish_groups:
+                continue
+            snapshot = self.take_snapshot(interval)
+            if self._snapshot_queue is not None:
+                self._snapshot_queue.put(snapshot)
+            count += 1
+        return count
+    
+    def take_snapshot(self, interval=None, timestamp=None):
+        '''
+        Close the statistic windows and build a new snapshot of the sensors
+        of a publish interval (all if None). Taken under the node lock, the
+        read thread does not update the sensors meanwhile. The new snapshot
+        replaces the current one with a single reference assignment, readers
+        never see a partly updated snapshot.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if interval is None:
+                ids = self._sensors.keys()
+            else:
+                ids = self._publish_groups.get(interval, [])
+            sensors = {}
+            for ix in ids:
+                sensor = self._sensors[ix]
+                sensor.calc_statistics()
+                sensors[ix] = CissSensorSnapshot(sensor)
+            seq = self._snapshot.seq + 1 if self._snapshot is not None else 1
+            self._snapshot = CissNodeSnapshot(seq, timestamp, interval, self, sensors)
+            if self._shared_values is not None:
+                self._shared_values.write_snapshot(self._snapshot)
+        return self._snapshot
+    
+    def get_snapshot(self):
+        '''
+        Latest snapshot, None if none taken yet
+        '''
+        return self._snapshot
        
     def get_sensors(self):
         return self._sensors    
@@ -499,19 +1454,19 @@ class AppCissNode(AppBase, CISSNode):
     def get_sensor_value(self, short_name, what=None, type=None):
         return self.get_sensor(short_name).get_value(what, type)
     
-    def print_sensor_values(self, all=True):
+    def print_sensor_values(self, all=True, snapshot=None):
+        sensors = self._sensors if snapshot is None else snapshot.sensors
         if all:
-            for id, sensor in self._sensors.items():
-                sensor.print_values()            
-                if isinstance(sensor, CissXyzSensor):
-                    sensor.get_sensor('x').print_values()
-                    sensor.get_sensor('y').print_values()
-                    sensor.get_sensor('z').print_values()
+            for id, sensor in sensors.items():
+                print("[%s] %s"%  (sensor.name, sensor.get_value()))
+                if sensor.is_xyz():
+                    for type in ('x', 'y', 'z'):
+                        print("[%s] %s"%  (sensor.get_sensor(type).name, sensor.get_value(None, type)))
         else:
             tmp = {}
-            for id, sensor in self._sensors.items():
+            for id, sensor in sensors.items():
                 tmp[sensor.name] = sensor.get_value('current')      
-                if isinstance(sensor, CissXyzSensor):
+                if sensor.is_xyz():
                     tmp[sensor.get_sensor('x').name] = sensor.get_value('current', 'x')
                     tmp[sensor.get_sensor('y').name] = sensor.get_value('current','y')
                     tmp[sensor.get_sensor('z').name] = sensor.get_value('current','z')
@@ -544,12 +1499,19 @@ class AppCissNode(AppBase, CISSNode):
             else:
                 continue
             buffer = self.ser.read(length+1)
+            if self._rate_control is not None:
+                start = AppUtil.monotonic()
             payload = self.conv_data(buffer)
             payload.insert(0, length)
             out = ""
             if self.check_payload(payload) == 1:
                 payload_found = 1
+                self.frames += 1
                 self.parse_payload(payload)   
+            else:
+                self.decode_errors += 1
+            if self._rate_control is not None:
+                self._rate_control.add_busy(AppUtil.monotonic() - start)
                               
         return True
     
@@ -591,10 +1553,20 @@ class AppCissNode(AppBase, CISSNode):
                 mask = self.sensorlist[t].parse(payload[0:self.sensorlist[t].data_length])
                 #self.log_debug('Paylod Type %d, lenght %d, Data [%s]', t, len(mask), str(mask))
                 if len(mask):
-                    tempDict = self.save_to_dict(self.sensorid, mask, time.time())
+                    timestamp = time.time()
+                    tempDict = self.save_to_dict(self.sensorid, mask, timestamp)
+                    if self.first_frame_time is None:
+                        self.first_frame_time = tempDict.get('timestamp', None)
                     if self._stream_data is not None:
                         self._stream_data.append(tempDict)
-                    self.update_sensor_values(tempDict, data_type)
+                    if self._data_log is not None:
+                        self._data_log.write(self.sensorid, timestamp, mask)
+                    if self._archive is not None:
+                        self._archive.write(self.sensorid, timestamp, mask)
+                    if self._capture is not None:
+                        self._capture.write(timestamp, mask)
+                    with self._lock:
+                        self.update_sensor_values(tempDict, data_type)
                 payload = payload[self.sensorlist[t].data_length:]
             else:
                 break
@@ -627,6 +1599,18 @@ class AppCissNode(AppBase, CISSNode):
         #self.log_debug('write_to_dict %s', tempDict)
         return tempDict
 
+    '''
+    Overwrite CISSNode function
+    '''
+    def parse_event_detection(self, data):
+        events = decode_event_frame(self.get_base_id(), data, time.time())
+        if self._event_dispatcher is not None:
+            self._event_dispatcher.put_events(events)
+        else:
+            for event in events:
+                self.log_info('Event %s %s %d', event.node, event.sensor, event.kind)
+        return []
+
     '''
     Overwrite CISSNode function
     '''
@@ -635,8 +1619,12 @@ class AppCissNode(AppBase, CISSNode):
         if self._serial_stop:
             self.log_error('Serial Port in stop mode! Skipping ...')
             return False
+        if not self.check_device():
+            self.log_warning('Serial Port %s not found!', self._serial_port)
+            return False
         self.ser.open()    
         self._serial_connected = True
+        self.connects += 1
         return         
     
     '''
@@ -649,22 +1637,50 @@ class AppCissNode(AppBase, CISSNode):
         except Exception as e:
             self.log_exception("Exception in disable_sensors")
         
-        self.ser.close()
+        self.close_serial()
+        return       
+    
+    def close_serial(self):
+        try:
+            self.ser.close()
+        except Exception as e:
+            self.log_exception('Exception closing Serial Port %s', self._serial_port)
         self.ser.is_open = False
         self._serial_connected = False
-        return       
+        return True
     
     def is_connected(self):
         #self.log_debug('Serial port is open %s', self.ser.is_open)
         return self.ser.is_open and self._serial_connected
     
+    '''
+    Overwrite CISSNode function, nothing to disable without the device
+    '''
+    def disable_sensors(self):
+        if not self.is_connected():
+            return False
+        return CISSNode.disable_sensors(self)
+    
+    '''
+    Overwrite CISSNode function, configured on connect without the device
+    '''
+    def config_sensors(self):
+        if not self.is_connected():
+            return False
+        return CISSNode.config_sensors(self)
+    
     def reconfigure_sensors(self):
         self.log_info('Reconfigure Sensors')
         if not self.is_connected():
             self.log_error('Serial Port not opened! %s', self._serial_port)
             return False
+        # the current configuration is sent completely
+        self._config_requests.clear()
+        self._rate_writes.clear()
+        # disabled with the previous event flag, enabled with the new one
         self.disable_sensors()
         time.sleep(1)
+        self.flgEventEnabled = int(self.is_event_mode())
         self.config_sensors()
         return True
     
@@ -687,27 +1703,353 @@ class AppCissContext(AppContext):
         self._run = False       
         self._ciss = {}  
         self._use_threading = True
+        self._device_watcher = None
+        self._event_dispatcher = None
+        self._event_log = None
+        self._data_log = None
+        self._archive = None
+        self._capture_writer = None
+        self._capture_events = None
+        self._shared_values = None
+        self._metrics = None
+        self._reload_pending = False
+        self._scheduler = CissScheduler()
+        self._snapshot_queue = queue.Queue()
+        # max. seconds to wait for the read threads to take the requested snapshots
+        self._snapshot_wait = 1.0
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.signal_reload)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.signal_capture)
                  
         
     def init_context(self):
         self.log_info('Init Context! ...')
         
-        self._ext_conf = AppContext.import_file(self._config_file, 'json', def_path='/conf')        
-        if 'ciss_nodes' not in self._ext_conf:
-            self.log_error('Missing Ciss Node configuration!')
+        self._ext_conf = self.load_config()
+        if self._ext_conf is None:
             return False
-        if self._console_args.com_port is not None and 'cissACM0' in self._ext_conf['ciss_nodes']:
-            self.log_info('Overwrite serial com port to %s', self._console_args.com_port)
-            self._ext_conf['ciss_nodes']['cissACM0']['com_port'] = self._console_args.com_port
-        else:
-            self.log_info('Using configuration file for ciss sensor serial port')
+        self.startup_mark('config')
+        
+        self._event_dispatcher = CissEventDispatcher(logger=self.get_logger())
+        if self._ext_conf.get('event_log', 'detectedEvents.csv'):
+            self._event_log = CissEventLog(self._ext_conf.get('event_log', 'detectedEvents.csv'), 
+                                           logger=self.get_logger())
+            self._event_dispatcher.add_handler(self._event_log.write_events)
+        self._event_dispatcher.start()
+        self.startup_mark('event pipeline')
+        
+        data_log_conf = self._ext_conf.get('data_log', None)
+        if data_log_conf:
+            self._data_log = CissDataLog(data_log_conf.get('file', 'dataStream.csv'),
+                                         max_rows=data_log_conf.get('max_rows', 100000),
+                                         flush_rows=data_log_conf.get('flush_rows', 1000),
+                                         flush_interval=data_log_conf.get('flush_interval', 1.0),
+                                         max_size=data_log_conf.get('max_size_mb', 0),
+                                         rotate_daily=data_log_conf.get('rotate_daily', False),
+                                         max_files=data_log_conf.get('max_files', 10),
+                                         logger=self.get_logger())
+            self._data_log.start()
+        
+        archive_conf = self._ext_conf.get('archive', None)
+        if archive_conf:
+            self._archive = CissArchive(archive_conf.get('file', 'ciss_archive.cza'),
+                                        compress=archive_conf.get('compress', False),
+                                        chunk_samples=archive_conf.get('chunk_samples', 1024),
+                                        chunk_age=archive_conf.get('chunk_age', 60),
+                                        max_rows=archive_conf.get('max_rows', 100000),
+                                        flush_interval=archive_conf.get('flush_interval', 5.0),
+                                        max_size=archive_conf.get('max_size_mb', 0),
+                                        rotate_daily=archive_conf.get('rotate_daily', False),
+                                        max_files=archive_conf.get('max_files', 10),
+                                        logger=self.get_logger())
+            self._archive.start()
+            
+        capture_conf = self._ext_conf.get('capture', None)
+        if capture_conf:
+            self._capture_writer = CissCaptureWriter(capture_conf.get('path', 'captures'),
+                                                     max_files=capture_conf.get('max_files', 100),
+                                                     max_queue=capture_conf.get('max_queue', 10),
+                                                     logger=self.get_logger())
+            self._capture_writer.start()
+            # event sensors triggering a capture, None all
+            self._capture_events = capture_conf.get('events', None)
+            self._event_dispatcher.add_handler(self.on_capture_events)
+            
+        shared_conf = self._ext_conf.get('shared_values', None)
+        if shared_conf:
+            self._shared_values = CissSharedValues(shared_conf.get('path', '/dev/shm/ciss_values'),
+                                                   frames=shared_conf.get('frames', True),
+                                                   logger=self.get_logger())
             
+        rate_conf = self._ext_conf.get('rate_control', None)
         for id, node in self._ext_conf['ciss_nodes'].items():
-            self._ciss[id] = AppCissNode(id, conf=node, logger=self.get_logger())
-        time.sleep(1)
+            rate_control = None
+            if rate_conf:
+                rate_control = CissRateController(id, logger=self.get_logger(), **rate_conf)
+            capture = None
+            if self._capture_writer is not None:
+                capture = CissCapture(id, self._capture_writer,
+                                      seconds_before=capture_conf.get('seconds_before', 5),
+                                      seconds_after=capture_conf.get('seconds_after', 5),
+                                      rate=capture_conf.get('rate', 400),
+                                      logger=self.get_logger())
+            self._ciss[id] = AppCissNode(id, conf=node, event_dispatcher=self._event_dispatcher, 
+                                         snapshot_queue=self._snapshot_queue, data_log=self._data_log,
+                                         archive=self._archive, capture=capture, rate_control=rate_control,
+                                         shared_values=self._shared_values,
+                                         window_stats=(self._ext_conf.get('statistics_window', 'publish') == 'publish'),
+                                         tiers=self._ext_conf.get('aggregation_tiers', None),
+                                         logger=self.get_logger())
+            self.startup_mark('node %s'% id)
+        if self._shared_values is not None:
+            self._shared_values.create(self._ciss)
+            self.startup_mark('shared values')
+            
+        if self._ext_conf.get('device_watch', True):
+            self._device_watcher = CissDeviceWatcher(logger=self.get_logger())
+            for id, ciss in self._ciss.items():
+                ciss.attach_device_watcher(self._device_watcher)
+            self._device_watcher.start()
+            self.startup_mark('device watcher')
+            
+        if self._ext_conf.get('metrics', None):
+            self._metrics = CissMetrics(logger=self.get_logger())
+            self.init_metrics(self._metrics)
+            self._metrics.start(self._ext_conf['metrics'])
+            self.startup_mark('metrics')
 
         return True
     
+    def init_metrics(self, metrics):
+        '''
+        Describe the metrics and add the collectors
+        '''
+        metrics.describe('node_frames_total', 'counter', 'Frames received with valid checksum')
+        metrics.describe('node_decode_errors_total', 'counter', 'Frames dropped with checksum error')
+        metrics.describe('node_connects_total', 'counter', 'Serial port opens, reconnects after the first one')
+        metrics.describe('node_serial_errors_total', 'counter', 'Serial read exceptions')
+        metrics.describe('node_connected', 'gauge', 'Serial port open')
+        metrics.describe('node_read_thread_up', 'gauge', 'Read thread alive')
+        metrics.describe('node_snapshots_total', 'counter', 'Snapshots taken')
+        metrics.describe('node_snapshot_requests', 'gauge', 'Snapshot requests not taken yet')
+        metrics.describe('sensor_samples_total', 'counter', 'Samples received')
+        metrics.describe('snapshot_queue_depth', 'gauge', 'Snapshots not published yet')
+        metrics.describe('publish_ticks_missed_total', 'counter', 'Publish ticks skipped by overruns')
+        metrics.describe('event_queue_depth', 'gauge', 'Events not dispatched yet')
+        metrics.describe('events_dispatched_total', 'counter', 'Events dispatched')
+        metrics.describe('events_dropped_total', 'counter', 'Events dropped with full queue')
+        metrics.describe('thread_up', 'gauge', 'Worker thread alive')
+        metrics.describe('data_log_rows_total', 'counter', 'Data log rows written')
+        metrics.describe('data_log_dropped_total', 'counter', 'Data log rows dropped with full buffer')
+        metrics.describe('archive_samples_total', 'counter', 'Samples written to the archive')
+        metrics.describe('archive_bytes_total', 'counter', 'Bytes written to the archive')
+        metrics.describe('archive_dropped_total', 'counter', 'Archive rows dropped with full buffer')
+        metrics.describe('node_rate_level', 'gauge', 'Streaming rate control level, period * factor ** level')
+        metrics.describe('node_rate_changes_total', 'counter', 'Streaming rate changes')
+        metrics.describe('node_serial_backlog_bytes', 'gauge', 'Serial buffer bytes at the last rate control interval')
+        metrics.describe('node_decode_load', 'gauge', 'Read thread decode time per rate control interval')
+        metrics.describe('shared_values_writes_total', 'counter', 'Shared memory record writes')
+        metrics.describe('capture_triggers_total', 'counter', 'Capture triggers')
+        metrics.describe('captures_total', 'counter', 'Captures completed')
+        metrics.describe('captures_written_total', 'counter', 'Capture files written')
+        metrics.describe('captures_dropped_total', 'counter', 'Captures dropped with full writer queue')
+        metrics.add_collector(self.collect_metrics)
+        return True
+    
+    def collect_metrics(self):
+        '''
+        Metric samples (name, labels, value), called by the exporter thread
+        '''
+        for id, ciss in list(self._ciss.items()):
+            labels = {'node': id}
+            yield ('node_frames_total', labels, ciss.frames)
+            yield ('node_decode_errors_total', labels, ciss.decode_errors)
+            yield ('node_connects_total', labels, ciss.connects)
+            yield ('node_serial_errors_total', labels, ciss.serial_errors)
+            yield ('node_connected', labels, int(ciss.is_connected()))
+            yield ('node_read_thread_up', labels, int(ciss.thread_is_alive()))
+            snapshot = ciss.get_snapshot()
+            yield ('node_snapshots_total', labels, snapshot.seq if snapshot is not None else 0)
+            yield ('node_snapshot_requests', labels, len(ciss._snapshot_requests))
+            for ix, sensor in list(ciss.get_sensors().items()):
+                yield ('sensor_samples_total', {'node': id, 'sensor': sensor.name}, sensor._value_ucount)
+            if ciss._rate_control is not None:
+                yield ('node_rate_level', labels, ciss._rate_control.level)
+                yield ('node_rate_changes_total', labels, ciss._rate_control.changes)
+                yield ('node_serial_backlog_bytes', labels, ciss._rate_control.backlog)
+                yield ('node_decode_load', labels, float(ciss._rate_control.load))
+        yield ('snapshot_queue_depth', None, self._snapshot_queue.qsize())
+        yield ('publish_ticks_missed_total', None, self._scheduler.missed)
+        if self._event_dispatcher is not None:
+            yield ('event_queue_depth', None, self._event_dispatcher.get_queue_size())
+            yield ('events_dispatched_total', None, self._event_dispatcher.events_dispatched)
+            yield ('events_dropped_total', None, self._event_dispatcher.events_dropped)
+            yield ('thread_up', {'thread': 'event_dispatcher'}, int(self._event_dispatcher.is_alive()))
+        if self._device_watcher is not None:
+            yield ('thread_up', {'thread': 'device_watcher'}, int(self._device_watcher.is_alive()))
+        if self._data_log is not None:
+            yield ('data_log_rows_total', None, self._data_log.rows_written)
+            yield ('data_log_dropped_total', None, self._data_log.rows_dropped)
+            yield ('thread_up', {'thread': 'data_log'}, int(self._data_log.is_alive()))
+        if self._archive is not None:
+            yield ('archive_samples_total', None, self._archive.samples_written)
+            yield ('archive_bytes_total', None, self._archive.bytes_written)
+            yield ('archive_dropped_total', None, self._archive.rows_dropped)
+            yield ('thread_up', {'thread': 'archive'}, int(self._archive.is_alive()))
+        if self._shared_values is not None:
+            yield ('shared_values_writes_total', None, self._shared_values.writes)
+        if self._capture_writer is not None:
+            for id, ciss in list(self._ciss.items()):
+                capture = ciss.get_capture()
+                if capture is not None:
+                    yield ('capture_triggers_total', {'node': id}, capture.triggers)
+                    yield ('captures_total', {'node': id}, capture.captures)
+            yield ('captures_written_total', None, self._capture_writer.captures_written)
+            yield ('captures_dropped_total', None, self._capture_writer.captures_dropped)
+            yield ('thread_up', {'thread': 'capture_writer'}, int(self._capture_writer.is_alive()))
+    
+    def load_config(self):
+        ext_conf = AppContext.import_file(self._config_file, 'json', def_path='/conf')        
+        if 'ciss_nodes' not in ext_conf:
+            self.log_error('Missing Ciss Node configuration!')
+            return None
+        if self._console_args.com_port is not None and 'cissACM0' in ext_conf['ciss_nodes']:
+            self.log_info('Overwrite serial com port to %s', self._console_args.com_port)
+            ext_conf['ciss_nodes']['cissACM0']['com_port'] = self._console_args.com_port
+        else:
+            self.log_info('Using configuration file for ciss sensor serial port')
+        return ext_conf
+    
+    def reload_context(self):
+        self.log_info('Reload configuration %s! ...', self._config_file)
+        try:
+            ext_conf = self.load_config()
+        except Exception as e:
+            self.log_exception('Failed to load configuration %s', self._config_file)
+            return False
+        if ext_conf is None:
+            return False
+        tiers = ext_conf.get('aggregation_tiers', None)
+        if tiers != self._ext_conf.get('aggregation_tiers', None):
+            self.log_info('Aggregation tiers changed to %s', tiers)
+        for id, node in ext_conf['ciss_nodes'].items():
+            if id not in self._ciss:
+                self.log_warning('New Ciss Node %s requires a restart!', id)
+                continue
+            self._ciss[id].set_tiers(tiers)
+            self._ciss[id].reload_config(node)
+        for id in self._ciss.keys():
+            if id not in ext_conf['ciss_nodes']:
+                self.log_warning('Removed Ciss Node %s requires a restart!', id)
+        self._ext_conf = ext_conf
+        return True
+    
+    def check_startup(self):
+        '''
+        Report the startup phases once the first frame is decoded
+        '''
+        if self._startup_reported:
+            return False
+        first_frames = [ciss.first_frame_time for ciss in self._ciss.values() if ciss.first_frame_time is not None]
+        if not first_frames:
+            return False
+        self.startup_mark('first frame', min(first_frames))
+        return self.startup_report()
+    
+    def check_reload(self):
+        if not self._reload_pending:
+            return False
+        self._reload_pending = False
+        if not self.reload_context():
+            return False
+        self.schedule_snapshots()
+        return True
+    
+    def get_publish_interval(self):
+        '''
+        Default publish interval (ms) of the sensors
+        '''
+        return 5000
+    
+    def schedule_snapshots(self):
+        '''
+        One scheduler entry per node and publish interval
+        '''
+        self._scheduler.clear()
+        for id, ciss in self._ciss.items():
+            ciss.clear_snapshot_requests()
+            for interval, ids in ciss.set_publish_interval(self.get_publish_interval()).items():
+                self._scheduler.add((id, interval), interval)
+                self.log_info('Node %s publish every %.3f s: %s', id, interval, sorted(ids))
+        return True
+    
+    def collect_snapshots(self, pending):
+        '''
+        Wait for the requested snapshots of the read threads, at most until
+        the next due time. Requests pending for two intervals (no data from
+        the node) are taken by this thread, under the node lock like the
+        snapshots of the read threads.
+        '''
+        timeout = AppUtil.monotonic() + self._snapshot_wait
+        next_due = self._scheduler.next_due()
+        if next_due is not None and next_due < timeout:
+            timeout = next_due
+        while pending > 0:
+            remaining = timeout - AppUtil.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                snapshot = self._snapshot_queue.get(True, remaining)
+            except queue.Empty:
+                break
+            pending -= 1
+            self.on_snapshot(snapshot)
+        for id, ciss in self._ciss.items():
+            if ciss.check_snapshot(2):
+                self.log_debug('Node %s no data, snapshot taken by publisher', id)
+        while True:
+            try:
+                snapshot = self._snapshot_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.on_snapshot(snapshot)
+        return True
+    
+    def on_snapshot(self, snapshot):
+        snapshot.node.print_sensor_values(True, snapshot)
+        return True
+    
+    def signal_reload(self, signum, frame):
+        self._reload_pending = True
+    
+    def signal_capture(self, signum, frame):
+        self.trigger_capture()
+    
+    def trigger_capture(self, node=None, reason='manual', timestamp=None):
+        '''
+        Capture the stream data of a node (all if None)
+        '''
+        for id, ciss in self._ciss.items():
+            if node is None or id == node:
+                ciss.trigger_capture(reason, timestamp)
+        return True
+    
+    def on_capture_events(self, events):
+        '''
+        Event dispatcher handler, hardware and software threshold events
+        trigger a capture of their node
+        '''
+        for event in events:
+            if self._capture_events and event.sensor not in self._capture_events:
+                continue
+            try:
+                kind = CissEventKind(event.kind).name.lower()
+            except ValueError:
+                kind = str(event.kind)
+            self.trigger_capture(event.node, '%s-%s'% (event.sensor, kind), event.timestamp)
+        return True
+    
     def run_context(self):
         self.log_info('Run Context! ...')
         
@@ -726,20 +2068,24 @@ class AppCissContext(AppContext):
     def run_threading_loop(self):
         self._run = True
         
-        max_interval_time = 5000 # 5 seconds
-         
+        self.schedule_snapshots()
         for id, ciss in self._ciss.items():
            ciss.start_read_thread()    
                         
         while self._run is True: 
-            time.sleep(max_interval_time/1000)
+            # sleeps until the next publish interval is due, wakes up every second for reload and exit
+            due = self._scheduler.wait(1.0)
+            self.check_reload()
+            self.check_startup()
             for id, ciss in self._ciss.items(): 
+                ciss.check_capture()
                 if not ciss.thread_is_alive() and self._run is True:
                     self.log_error('Sensor %s Read Thread not alive! Restart', ciss.name)
                     ciss.start_read_thread()
                     continue
-                ciss.calc_statistics()          
-                ciss.print_sensor_values(True)                 
+            for id, interval in due:
+                self._ciss[id].request_snapshot(interval)
+            self.collect_snapshots(len(due))
         
         return True
     
@@ -752,9 +2098,12 @@ class AppCissContext(AppContext):
         if not max_interval_count: max_interval_count = 1
         
         while self._run is True:             
+            self.check_reload()
+            self.check_startup()
             for id, ciss in self._ciss.items():           
                 ciss.read_sensor_stream_until(max_interval_count, max_interval_time, 0.01)
-                ciss.calc_statistics()
+                ciss.check_capture()
+                ciss.take_snapshot()
                 if print_all < 10:
                     ciss.print_sensor_values(False)
                 else:
@@ -769,9 +2118,26 @@ class AppCissContext(AppContext):
     
     def do_exit(self, reason):
         self._run = False
+        if self._device_watcher:
+            self._device_watcher.stop()
         if self._ciss:
             for id, ciss in self._ciss.items():
                 ciss.do_exit()          
+                ciss.finish_capture()
+        if self._event_dispatcher:
+            self._event_dispatcher.stop()
+        if self._event_log:
+            self._event_log.close()
+        if self._data_log:
+            self._data_log.stop()
+        if self._archive:
+            self._archive.stop()
+        if self._capture_writer:
+            self._capture_writer.stop()
+        if self._shared_values:
+            self._shared_values.close()
+        if self._metrics:
+            self._metrics.stop()
         return True
 
 '''
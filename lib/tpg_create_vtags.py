@@ -6,6 +6,30 @@ Based on configuration file for initial setup.
 
 '''
 Change log
+0.8.1 - 2020-12-18 - cg
+    Aggregation tiers set on reload
+    
+0.8.0 - 2020-12-04 - cg
+    Add streaming period tags of the rate control
+    
+0.7.1 - 2020-11-10 - cg
+    Import requests on first use
+    
+0.7.0 - 2020-11-06 - cg
+    Add anomaly tags
+    
+0.6.0 - 2020-11-04 - cg
+    Add derived xyz channel tags
+    
+0.5.0 - 2020-11-02 - cg
+    Add spectral feature tags
+    
+0.4.0 - 2020-10-30 - cg
+    Add aggregation tier tags
+    
+0.3.0 - 2020-10-24 - cg
+    Add sensor event tags
+    
 0.2.0 - 2020-10-10 - cg
     Resturcture +TpgEquipmentApp
     
@@ -15,15 +39,20 @@ Change log
 
 __author__ = "Christian G."
 __license__ = "MIT"
-__version__ = '0.2.0'
+__version__ = '0.8.1'
 __status__ = "beta"
 
 import sys
-import requests
 import json
 
 from .chgrcodebase import *
 
+# only needed to create the equipment
+requests = AppUtil.lazy_import('requests')
+from .cissAggregate import tier_name
+from .cissSpectral import spectral_value_names
+from .cissDerived import CISS_DERIVED_NAMES
+
     
 class AppTpgContext(AppContext):
     def __init__(self, args, **kwargs):
@@ -68,6 +97,8 @@ class TpgEquipmentApp(AppBase):
         self._mx_api_token = kwargs.get('mxapitoken', None) 
         self._equipment_name = kwargs.get('equname', None)
         self._nodes = kwargs.get('nodes', None)
+        self._tiers = kwargs.get('tiers', None)
+        self._rate_control = kwargs.get('rate_control', False)
         self._api_url = 'https://localhost/api/v1/mxc/custom/equipments'
         
         if not self._mx_api_token:
@@ -78,6 +109,16 @@ class TpgEquipmentApp(AppBase):
             raise AppBaseError('Missing Node Tag information')
         return 
     
+    def set_nodes(self, nodes):
+        if not nodes:
+            raise AppBaseError('Missing Node Tag information')
+        self._nodes = nodes
+        return True
+    
+    def set_tiers(self, tiers):
+        self._tiers = tiers
+        return True
+    
     def tpg_build_rest_header(self):
         rest_header = {
             "mx-api-token": self._mx_api_token,
@@ -130,9 +171,20 @@ class TpgEquipmentApp(AppBase):
                     self.log_info('Sensor %s disabled. Skipping', sensor['name'])
                     continue
                 self.tpg_build_new_equ_tag(vtags, sensor, node['name'], sensor['name'], excludeTags)              
+                if sensor.get('event_enabled', 0) or sensor.get('sw_event_enabled', 0):
+                    self.tpg_add_equ_tags(vtags, node['name'], sensor['name'], ['event'], excludeTags)
+                if sensor.get('anomaly_enabled', 0):
+                    self.tpg_add_equ_tags(vtags, node['name'], sensor['name'], ['anomaly', 'anomaly_score'], excludeTags)
+                if (sid == 'Accl' or sid == 'Gyro' or sid == 'Magn') and self._rate_control:
+                    self.tpg_add_equ_tags(vtags, node['name'], sensor['name'], ['stream_period'], excludeTags)
+                if (sid == 'Accl' or sid == 'Gyro' or sid == 'Magn') and sensor.get('derived', 0):
+                    self.tpg_add_equ_tags(vtags, node['name'], sensor['name'], CISS_DERIVED_NAMES, excludeTags)
                 if sid == 'Accl' or sid == 'Gyro' or sid == 'Magn':
                     for tag_name in [('%s_x'% sensor['name']), ('%s_y'% sensor['name']), ('%s_z'% sensor['name'])]:
                         self.tpg_build_new_equ_tag(vtags, sensor, node['name'], tag_name, excludeTags)  
+                        if sensor.get('spectral', None):
+                            self.tpg_add_equ_tags(vtags, node['name'], tag_name, 
+                                                  spectral_value_names(sensor['spectral']), excludeTags)
                         
         self.log_info('Equipment %d tags created!', len(vtags['equipmentTags']))
         #print(json.dumps(vtags, indent=4, sort_keys=False))        
@@ -141,8 +193,14 @@ class TpgEquipmentApp(AppBase):
     def tpg_build_new_equ_tag(self, vtags, sensor, node_name, sensor_name, excludeTags=[]):
         if sensor['enable_statistics']: 
             value_list = ['current', 'min', 'max', 'mean', 'std']
+            if self._tiers:
+                for period in self._tiers:
+                    value_list.extend(self.tpg_tier_value_names(tier_name(period)))
         else:
             value_list = ['current']
+        return self.tpg_add_equ_tags(vtags, node_name, sensor_name, value_list, excludeTags)
+    
+    def tpg_add_equ_tags(self, vtags, node_name, sensor_name, value_list, excludeTags=[]):
         for what in value_list:
             tag_name = self.tpg_publish_tag_name(node_name, sensor_name, what)
             if tag_name in excludeTags:
@@ -229,6 +287,10 @@ class TpgEquipmentApp(AppBase):
         return True
     
     
+    @staticmethod
+    def tpg_tier_value_names(name):
+        return ['%s_%s'% (what, name) for what in ('min', 'max', 'mean', 'std')]
+    
     @staticmethod
     def tpg_publish_tag_name(node_name, sensor_name, which):
         tag_name = ('%s-%s-%s'% (node_name, sensor_name, which))
@@ -0,0 +1,99 @@
+'''
+Archive files with a partly written chunk at the end (power loss),
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.cissArchive import CissArchive, CissArchiveReader, synthetic_rows
+from lib.cissHistory import CissHistoryIndex
+
+
+class TornTailTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.path, 'ciss_archive.cza')
+        rows = [row for row in synthetic_rows('CissSIM0', 1.0, rate=50.0) if row[2][0] != '']
+        self.first, self.second = rows[:20], rows[20:50]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, rows, chunk_samples=10):
+        archive = CissArchive(self.file_name, max_rows=len(rows), chunk_samples=chunk_samples)
+        for row in rows:
+            archive.write(*row)
+        archive.flush()
+        archive.close()
+        return archive
+
+    def tear_tail(self):
+        '''
+        Append the first chunk of another archive, cut in the payload
+        '''
+        other = os.path.join(self.path, 'other.cza')
+        archive = CissArchive(other, max_rows=len(self.second))
+        for row in self.second:
+            archive.write(*row)
+        archive.flush()
+        archive.close()
+        chunk = next(CissArchiveReader(other).chunks())
+        with open(other, 'rb') as f:
+            data = f.read(chunk.offset + chunk.length // 2)
+        with open(self.file_name, 'ab') as f:
+            f.write(data)
+        os.remove(other)
+        return len(data)
+
+    def samples(self):
+        return list(CissArchiveReader(self.file_name).samples('CissSIM0', 'ax'))
+
+    def test_append_after_torn_tail(self):
+        self.write(self.first)
+        size = os.path.getsize(self.file_name)
+        self.assertEqual(self.tear_tail() + size, os.path.getsize(self.file_name))
+        self.assertEqual(len(self.samples()), len(self.first))
+
+        self.write(self.second)
+        samples = self.samples()
+        self.assertEqual(len(samples), len(self.first) + len(self.second))
+        self.assertEqual([timestamp for timestamp, value in samples],
+                         [int(timestamp * 1000) for node, timestamp, values in self.first + self.second])
+
+    def test_torn_chunk_header(self):
+        self.write(self.first)
+        size = os.path.getsize(self.file_name)
+        with open(self.file_name, 'ab') as f:
+            f.write(b'CZ\x01')
+        self.write(self.second)
+        self.assertEqual(len(self.samples()), len(self.first) + len(self.second))
+        self.assertEqual(CissArchiveReader(self.file_name).valid_size(), os.path.getsize(self.file_name))
+        self.assertTrue(os.path.getsize(self.file_name) > size)
+
+    def indexed_timestamps(self, index):
+        reader = CissArchiveReader(self.file_name)
+        timestamps = []
+        for t0, ix in index.find(('CissSIM0', 0)):
+            decoded = reader.read(index.chunk(('CissSIM0', 0), ix))
+            self.assertNotEqual(decoded, None)
+            timestamps.extend(decoded[0])
+        return timestamps
+
+    def test_history_index_after_torn_tail(self):
+        self.write(self.first)
+        self.tear_tail()
+        index = CissHistoryIndex(self.file_name, write_index=False)
+        index.update()
+        self.assertEqual(len(self.indexed_timestamps(index)), len(self.first))
+
+        self.write(self.second)
+        index.update()
+        self.assertEqual(self.indexed_timestamps(index),
+                         [int(timestamp * 1000) for node, timestamp, values in self.first + self.second])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+'''
+Device attach and detach in a fake device directory,
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lib.cissDeviceWatcher import CissDeviceWatcher
+
+
+class DeviceWatcherTest(unittest.TestCase):
+    use_inotify = True
+    timeout = 5.0
+
+    def setUp(self):
+        if self.use_inotify and CissDeviceWatcher._libc is None:
+            self.skipTest('inotify not available')
+        self.path = tempfile.mkdtemp()
+        # like /dev/serial/by-id, missing without any device
+        self.device_dir = os.path.join(self.path, 'serial', 'by-id')
+        self.device = os.path.join(self.device_dir, 'usb-Bosch_CISS-if00')
+        self.changes = []
+        self.changed = threading.Event()
+        self.watcher = CissDeviceWatcher(use_inotify=self.use_inotify, poll_interval=0.2)
+        self.watcher.add_device(self.device, self.on_change)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.path)
+
+    def on_change(self, path, present):
+        self.changes.append((path, present))
+        self.changed.set()
+
+    def wait_change(self, present):
+        self.assertTrue(self.changed.wait(self.timeout), 'no device change')
+        self.changed.clear()
+        self.assertEqual(self.changes[-1], (self.device, present))
+
+    def attach(self):
+        if not os.path.isdir(self.device_dir):
+            os.makedirs(self.device_dir)
+        with open(self.device, 'w'):
+            pass
+
+    def test_attach_detach(self):
+        self.assertFalse(self.watcher.is_present(self.device))
+        self.attach()
+        self.wait_change(True)
+        self.assertTrue(self.watcher.is_present(self.device))
+        os.remove(self.device)
+        self.wait_change(False)
+        self.attach()
+        self.wait_change(True)
+
+    def test_directory_removed(self):
+        self.attach()
+        self.wait_change(True)
+        # the last device unplugged removes the directory
+        shutil.rmtree(os.path.join(self.path, 'serial'))
+        self.wait_change(False)
+        self.attach()
+        self.wait_change(True)
+        os.remove(self.device)
+        self.wait_change(False)
+
+
+class DeviceWatcherPollTest(DeviceWatcherTest):
+    use_inotify = False
+
+
+if __name__ == '__main__':
+    unittest.main()
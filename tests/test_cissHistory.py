@@ -0,0 +1,49 @@
+'''
+Index files of the history next to archives sharing a name prefix,
+python -m unittest discover -s tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.cissArchive import CissArchive, synthetic_rows
+from lib.cissHistory import CissHistory
+
+
+class IndexFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.rows = [row for row in synthetic_rows('CissSIM0', 0.5, rate=50.0) if row[2][0] != '']
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def archive(self, name):
+        file_name = os.path.join(self.path, name)
+        archive = CissArchive(file_name, max_rows=len(self.rows), chunk_samples=10)
+        for row in self.rows:
+            archive.write(*row)
+        archive.flush()
+        archive.close()
+        return file_name
+
+    def test_refresh_keeps_other_archives(self):
+        file_name = self.archive('ciss_archive.cza')
+        other = self.archive('ciss_archive_b.cza')
+        CissHistory(other).refresh()
+        self.assertTrue(os.path.exists(other + '.idx'))
+        # index of a rotated file that was removed
+        stale = os.path.join(self.path, 'ciss_archive-20201201-120000.cza.idx')
+        with open(stale, 'wb') as f:
+            f.write(b'')
+
+        self.assertEqual(CissHistory(file_name).refresh(), [file_name])
+        self.assertTrue(os.path.exists(file_name + '.idx'))
+        self.assertTrue(os.path.exists(other + '.idx'))
+        self.assertFalse(os.path.exists(stale))
+
+
+if __name__ == '__main__':
+    unittest.main()